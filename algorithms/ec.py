@@ -43,8 +43,14 @@ def genome_mutation(candidate):
     locations along the candidate and reverses the values within that
     slice. Insertion is done by popping one item and insert it back at random
     position.
+
+    When the candidate has been evaluated, its tour and fitness are kept as
+    `parent` on the mutant, so that the evaluation can be limited to the slice
+    that changed (see `assembly.chic.score_evaluate_M_delta`).
     """
     size = len(candidate)
+    parent = (array.array('i', candidate), candidate.fitness.values[0]) \
+                if candidate.fitness.valid else None
     prob = random.random()
     if prob > .5:    # Inversion
         p = random.randint(0, size-1)
@@ -54,13 +60,15 @@ def genome_mutation(candidate):
         q += 1
         s = candidate[p:q]
         x = candidate[:p] + s[::-1] + candidate[q:]
-        return creator.Individual(x),
+        mutant = creator.Individual(x)
     else:            # Insertion
         p = random.randint(0, size-1)
         q = random.randint(0, size-1)
         cq = candidate.pop(q)
         candidate.insert(p, cq)
-        return candidate,
+        mutant = candidate
+    mutant.parent = parent
+    return mutant,
 
 
 def genome_mutation_orientation(candidate):
@@ -159,11 +167,48 @@ def eaSimpleConverge(population, toolbox, cxpb, mutpb, ngen, stats=None,
     return population
 
 
+# Evaluation function of the worker, set once when the pool starts
+_evaluate = None
+
+
+def _init_evaluate(evaluate):
+    global _evaluate
+    _evaluate = evaluate
+
+
+def _evaluate_tour(tour):
+    return _evaluate(tour)
+
+
+class EvaluatePool (object):
+    """
+    Persistent pool for fitness evaluation. The evaluation function, along with
+    the (often large) arrays bound to it, is handed to each worker once at
+    start-up, where it is inherited through fork and shared copy-on-write. Each
+    batch then only sends the tours, in chunks of several tours per task.
+    """
+    def __init__(self, evaluate, cpus):
+        self.cpus = cpus
+        self.pool = multiprocessing.Pool(cpus, initializer=_init_evaluate,
+                                         initargs=(evaluate,))
+
+    def map(self, evaluate, tours):
+        """
+        Drop-in for `toolbox.map`; `evaluate` is the one given at start-up.
+        """
+        tours = list(tours)
+        chunksize = max(1, len(tours) // (self.cpus * 4))
+        return self.pool.map(_evaluate_tour, tours, chunksize=chunksize)
+
+    def terminate(self):
+        self.pool.terminate()
+
+
 def GA_run(toolbox, ngen=500, npop=100, seed=666, cpus=1, callback=None):
     logging.debug("GA setup: ngen={0} npop={1} cpus={2} seed={3}".\
                     format(ngen, npop, cpus, seed))
     if cpus > 1:
-        pool = multiprocessing.Pool(cpus)
+        pool = EvaluatePool(toolbox.evaluate, cpus)
         toolbox.register("map", pool.map)
     random.seed(seed)
     pop = toolbox.population(n=npop)
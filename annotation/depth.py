@@ -7,12 +7,14 @@ and optimize against the truth, to determine the cutoff for incorporating
 RNA-seq into annotation pipelines.
 """
 
+import os
 import sys
 import os.path as op
 import numpy as np
 import logging
 
 from itertools import groupby
+from multiprocessing import Pool
 
 from jcvi.formats.sizes import Sizes
 from jcvi.formats.base import BaseFile, must_open
@@ -109,6 +111,7 @@ def merge(args):
     (255).
     """
     p = OptionParser(merge.__doc__)
+    p.set_cpus()
     opts, args = p.parse_args(args)
 
     if len(args) < 2:
@@ -124,20 +127,40 @@ def merge(args):
     b = BinFile(binfiles[0])
     ar = b.mmarray
     fastasize, = ar.shape
-    logging.debug("Initialize array of uint16 with size {0}".format(fastasize))
-
-    merged_ar = np.zeros(fastasize, dtype=np.uint16)
-    for binfile in binfiles:
-        b = BinFile(binfile)
-        merged_ar += b.array
+    for binfile in binfiles[1:]:
+        assert BinFile(binfile).mmarray.shape == ar.shape, \
+            "`{0}` differs in size from `{1}`".format(binfile, binfiles[0])
+
+    # Each worker sums a block of all the arrays straight into the output
+    tmpfile = mergedbin + ".tmp"
+    merged_ar = np.memmap(tmpfile, dtype=np.uint8, mode="w+",
+                          shape=(fastasize,))
+    del merged_ar
+    blocksize = 10000000
+    blocks = [(binfiles, tmpfile, i, min(i + blocksize, fastasize))
+                for i in xrange(0, fastasize, blocksize)]
+    logging.debug("Merge {0} arrays of size {1} in {2} blocks".\
+                format(len(binfiles), fastasize, len(blocks)))
+    pool = Pool(opts.cpus)
+    pool.map(merge_block, blocks)
+    pool.close()
+    pool.join()
+
+    os.rename(tmpfile, mergedbin)
+    logging.debug("Merged array written to `{0}`".format(mergedbin))
 
-    logging.debug("Resetting the count max to 255.")
-    merged_ar[merged_ar > 255] = 255
 
-    logging.debug("Compact array back to uint8 with size {0}".format(fastasize))
-    merged_ar = np.array(merged_ar, dtype=np.uint8)
-    merged_ar.tofile(mergedbin)
-    logging.debug("Merged array written to `{0}`".format(mergedbin))
+def merge_block(arg):
+    """
+    Sum [start, end) of all binfiles into outfile, capped at 255.
+    """
+    binfiles, outfile, start, end = arg
+    merged = np.zeros(end - start, dtype=np.uint32)
+    for binfile in binfiles:
+        merged += BinFile(binfile).mmarray[start:end]
+    out = np.memmap(outfile, dtype=np.uint8, mode="r+")
+    out[start:end] = np.minimum(merged, 255)
+    out.flush()
 
 
 def query(args):
@@ -161,28 +184,39 @@ def query(args):
     print "\t".join((ctgID, baseID, str(ar[oi])))
 
 
-def update_array(ar, coveragefile, sizes, offsets):
-    fp = open(coveragefile)
+def iter_coverage(coveragefile, offsets, chunksize=1 << 26):
+    """
+    Parse the three-column per-base coverage file (ctgID, baseID, count) in
+    chunks of about chunksize bytes, and yield (array offset, count) arrays.
+    """
+    fp = must_open(coveragefile)
     logging.debug("Parse file `{0}`".format(coveragefile))
-    for k, rows in groupby(fp, key=(lambda x: x.split()[0])):
-        rows = list(rows)
-        offset = offsets[k]
-        ctglen = len(rows)
-
-        if ctglen < 100000:
-            sys.stdout.write(".")
-        else:
-            print k, offset
+    while True:
+        rows = fp.readlines(chunksize)
+        if not rows:
+            break
+        tokens = "".join(rows).split()
+        ctgs = np.array(tokens[0::3])
+        bases = np.fromstring(" ".join(tokens[1::3]), dtype=np.int64, sep=" ")
+        counts = np.fromstring(" ".join(tokens[2::3]), dtype=np.int64, sep=" ")
+
+        # Rows come grouped by contig, look up offset once per run
+        starts = np.concatenate(([0],
+                        np.flatnonzero(ctgs[1:] != ctgs[:-1]) + 1))
+        runs = np.diff(np.append(starts, len(ctgs)))
+        base_offsets = np.repeat([offsets[x] for x in ctgs[starts]], runs)
+        yield base_offsets + bases - 1, counts
+    fp.close()
 
-        #assert ctglen == sizes[k]
-        for i, row in enumerate(rows):
-            ctgID, baseID, count = row.split()
-            oi = offset + i
-            newcount = ar[oi] + int(count)
-            if newcount > 255:
-                newcount = 255
 
-            ar[oi] = newcount
+def update_array(ar, coveragefile, sizes, offsets):
+    """
+    Add the counts in coveragefile to ar (uint8, may be memory-mapped),
+    saturating at 255.
+    """
+    for idx, counts in iter_coverage(coveragefile, offsets):
+        counts += ar[idx]
+        ar[idx] = np.minimum(counts, 255)
 
 
 def get_offsets(fastafile):
@@ -216,11 +250,14 @@ def count(args):
 
     fastasize, sizes, offsets = get_offsets(fastafile)
     logging.debug("Initialize array of uint8 with size {0}".format(fastasize))
-    ar = np.zeros(fastasize, dtype=np.uint8)
+    tmpfile = countsfile + ".tmp"
+    ar = np.memmap(tmpfile, dtype=np.uint8, mode="w+", shape=(fastasize,))
 
     update_array(ar, coveragefile, sizes, offsets)
 
-    ar.tofile(countsfile)
+    ar.flush()
+    del ar
+    os.rename(tmpfile, countsfile)
     logging.debug("Array written to `{0}`".format(countsfile))
 
 
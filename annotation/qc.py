@@ -12,7 +12,7 @@ testing. Several aspects of annotation QC are implemented in this script.
 import sys
 
 from jcvi.formats.gff import Gff, get_piles, make_index, import_feats, \
-            populate_children, to_range
+            populate_children, to_range, FeatureNotFoundError
 from jcvi.formats.base import must_open
 from jcvi.formats.sizes import Sizes
 from jcvi.utils.range import range_minmax, range_chain, range_overlap
@@ -150,7 +150,6 @@ def trimUTR(args):
     `python -m jcvi.formats.gff fixboundaries` on the resultant GFF3
     to adjust the boundaries of all parent 'gene' features
     """
-    import gffutils
     from jcvi.formats.base import SetFile
 
     p = OptionParser(trimUTR.__doc__)
@@ -226,7 +225,7 @@ def trimUTR(args):
                                                 extras.add(exon)
                         else:
                             refc = None
-                    except gffutils.exceptions.FeatureNotFoundError:
+                    except FeatureNotFoundError:
                         pass
                 start, end = get_cds_minmax(gff, cid, level=1)
                 if cid in trimrange:
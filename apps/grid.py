@@ -27,6 +27,26 @@ class Parallel(object):
         p.map(sh, self.cmds)
 
 
+def imap_bounded(pool, func, args, bound):
+    """
+    Like pool.imap_unordered(), but at most `bound` tasks are in flight or
+    waiting to be consumed, so workers stall instead of piling up results
+    when the consumer falls behind.
+    """
+    from threading import BoundedSemaphore
+
+    slots = BoundedSemaphore(bound)
+
+    def tasks():
+        for arg in args:
+            slots.acquire()
+            yield arg
+
+    for res in pool.imap_unordered(func, tasks()):
+        slots.release()
+        yield res
+
+
 class Dependency (object):
     """
     Used by MakeManager.
@@ -14,8 +14,10 @@ import logging
 import numpy as np
 
 from math import log, sqrt, pi, exp
-from itertools import product, combinations
+from itertools import product, combinations, permutations, izip
 from functools import partial
+from multiprocessing import Pool
+from tempfile import mkdtemp
 
 from Bio import SeqIO
 from Bio import AlignIO
@@ -25,6 +27,7 @@ from jcvi.formats.base import LineFile, must_open
 from jcvi.graphics.base import plt, savefig, AbstractLayout, markup
 from jcvi.utils.table import write_csv
 from jcvi.utils.cbook import gene_name
+from jcvi.apps.grid import imap_bounded
 from jcvi.apps.base import OptionParser, ActionDispatcher, mkdir, sh, \
             Popen, getpath, iglob
 
@@ -45,13 +48,15 @@ class AbstractCommandline:
 class YnCommandline(AbstractCommandline):
     """Little commandline for yn00.
     """
-    def __init__(self, ctl_file, command=PAML_BIN("yn00")):
+    def __init__(self, ctl_file, work_dir=".", command=PAML_BIN("yn00")):
         self.ctl_file = ctl_file
+        self.work_dir = work_dir
         self.parameters = []
         self.command = command
 
     def __str__(self):
-        return self.command + " %s >/dev/null" % self.ctl_file
+        return "cd %s && %s %s >/dev/null" % \
+            (self.work_dir, self.command, self.ctl_file)
 
 
 class MrTransCommandline(AbstractCommandline):
@@ -466,6 +471,63 @@ def prepare(args):
         fw2.close()
 
 
+# Scratch directory of each calc worker, set up by init_calc()
+_work_dir = None
+
+
+def init_calc(root):
+    global _work_dir
+    _work_dir = mkdtemp(prefix="worker", dir=root)
+
+
+def calc_pair(arg):
+    """
+    Align one pair and compute Ks in the scratch directory of this worker.
+    Returns the pair index, the pair name and the output line (None if it
+    failed).
+    """
+    i, (p_rec_1, p_rec_2, n_rec_1, n_rec_2), msa, method = arg
+    work_dir = _work_dir
+    pair_name = "%s;%s" % (p_rec_1.name, p_rec_2.name)
+
+    print >>sys.stderr, "--------", p_rec_1.name, p_rec_2.name
+    if msa == "clustalw":
+        align_fasta = clustal_align_protein((p_rec_1, p_rec_2), work_dir)
+    elif msa == "muscle":
+        align_fasta = muscle_align_protein((p_rec_1, p_rec_2), work_dir)
+    outfmt = "paml" if method == "yn00" else "fasta"
+    mrtrans_fasta = run_mrtrans(align_fasta, (n_rec_1, n_rec_2), work_dir,
+                                outfmt=outfmt)
+    line = None
+    if mrtrans_fasta and method == "ng86":
+        seqs = [str(x.seq) for x in SeqIO.parse(mrtrans_fasta, "fasta")]
+        if len(seqs) != 2:
+            return i, pair_name, line
+        ks, ka = ng86([seqs])
+        line = ",".join((pair_name, "NA", "NA",
+                         format_subs(ks[0]), format_subs(ka[0])))
+    elif mrtrans_fasta:
+        ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng = \
+                find_synonymous(mrtrans_fasta, work_dir)
+        if ds_subs_yn is not None:
+            line = ",".join(str(x) for x in (pair_name,
+                    ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng))
+    return i, pair_name, line
+
+
+def read_checkpoint(checkpoint):
+    done = {}
+    if not op.exists(checkpoint):
+        return done
+    for row in open(checkpoint):
+        if not row.endswith("\n"):  # Cut short when interrupted
+            continue
+        pair_name, line = row.rstrip("\n").split("\t")
+        done[pair_name] = line or None
+    logging.debug("Resume with {} pairs from `{}`".format(len(done), checkpoint))
+    return done
+
+
 def calc(args):
     """
     %prog calc [prot.fasta] cds.fasta > out.ks
@@ -484,6 +546,13 @@ def calc(args):
         3. Convert the output to Fasta format.
         4. Use this alignment info to align gene sequences using PAL2NAL
         5. Run PAML yn00 to calculate synonymous mutation rates.
+
+    With --method=ng86, step 5 is replaced by the in-process Nei-Gojobori
+    estimator, which leaves the yn_ks and yn_ka columns as NA.
+
+    Pairs are processed in parallel, each worker in its own scratch directory
+    under `workdir/syn_analysis`. Completed pairs are checkpointed there, so
+    an interrupted run picks up where it stopped when run again.
     """
     from jcvi.formats.fasta import translate
 
@@ -493,8 +562,12 @@ def calc(args):
                       "e.g. ESTs [default: %default]")
     p.add_option("--msa", default="clustalw", choices=("clustalw", "muscle"),
                  help="software used to align the proteins [default: %default]")
+    p.add_option("--method", default="yn00", choices=("yn00", "ng86"),
+                 help="yn00 reports both YN00 and NG86 estimates, ng86 "\
+                      "computes NG86 in-process only [default: %default]")
     p.add_option("--workdir", default=os.getcwd(), help="Work directory")
     p.set_outfile()
+    p.set_cpus()
 
     opts, args = p.parse_args(args)
 
@@ -518,45 +591,69 @@ def calc(args):
             translate_args += ["--longest"]
         dna_file, protein_file = translate(translate_args)
 
-    prot_iterator = SeqIO.parse(open(protein_file), "fasta")
-    dna_iterator = SeqIO.parse(open(dna_file), "fasta")
-    for p_rec_1, p_rec_2, n_rec_1, n_rec_2 in \
-            zip(prot_iterator, prot_iterator, dna_iterator, dna_iterator):
-
-        print >>sys.stderr, "--------", p_rec_1.name, p_rec_2.name
-        if opts.msa == "clustalw":
-            align_fasta = clustal_align_protein((p_rec_1, p_rec_2), work_dir)
-        elif opts.msa == "muscle":
-            align_fasta = muscle_align_protein((p_rec_1, p_rec_2), work_dir)
-        mrtrans_fasta = run_mrtrans(align_fasta, (n_rec_1, n_rec_2), work_dir)
-        if mrtrans_fasta:
-            ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng = \
-                    find_synonymous(mrtrans_fasta, work_dir)
-            if ds_subs_yn is not None:
-                pair_name = "%s;%s" % (p_rec_1.name, p_rec_2.name)
-                output_h.write("%s\n" % (",".join(str(x) for x in (pair_name,
-                        ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng))))
-                output_h.flush()
+    checkpoint = op.join(work_dir, "checkpoint")
+    done = read_checkpoint(checkpoint)
+    skipped = {}
+
+    def tasks():
+        prot_iterator = SeqIO.parse(open(protein_file), "fasta")
+        dna_iterator = SeqIO.parse(open(dna_file), "fasta")
+        for i, recs in enumerate(izip(prot_iterator, prot_iterator,
+                                      dna_iterator, dna_iterator)):
+            pair_name = "%s;%s" % (recs[0].name, recs[1].name)
+            if pair_name in done:
+                skipped[i] = done[pair_name]
+                continue
+            yield i, recs, opts.msa, opts.method
+
+    # Results come back in any order; hold them until their turn
+    checkpoint_h = open(checkpoint, "a")
+    pool = Pool(processes=opts.cpus, initializer=init_calc,
+                initargs=(work_dir,))
+    pending = {}
+    nextid = 0
+    for i, pair_name, line in imap_bounded(pool, calc_pair, tasks(),
+                                           4 * opts.cpus):
+        print >> checkpoint_h, "\t".join((pair_name, line or ""))
+        checkpoint_h.flush()
+        pending[i] = line
+        nextid = write_ready(output_h, pending, skipped, nextid)
+    pool.close()
+    pool.join()
+    checkpoint_h.close()
+    write_ready(output_h, pending, skipped, nextid)
 
     # Clean-up
-    sh("rm -rf 2YN.t 2YN.dN 2YN.dS rst rub rst1 syn_analysis")
+    sh("rm -rf {}".format(work_dir))
+
+
+def write_ready(output_h, pending, skipped, nextid):
+    """
+    Write out lines in input order, starting at index nextid, for as long as
+    they are available. Returns the next index still missing.
+    """
+    while nextid in pending or nextid in skipped:
+        line = pending.pop(nextid) if nextid in pending else skipped.pop(nextid)
+        if line:
+            output_h.write("%s\n" % line)
+            output_h.flush()
+        nextid += 1
+    return nextid
 
 
 def find_synonymous(input_file, work_dir):
     """Run yn00 to find the synonymous subsitution rate for the alignment.
     """
-    cwd = os.getcwd()
-    os.chdir(work_dir)
-    # create the .ctl file
+    # create the .ctl file, yn00 runs inside work_dir
     ctl_file = "yn-input.ctl"
-    output_file = "nuc-subs.yn"
-    ctl_h = open(ctl_file, "w")
+    output_file = op.join(work_dir, "nuc-subs.yn")
+    ctl_h = open(op.join(work_dir, ctl_file), "w")
     ctl_h.write("seqfile = %s\noutfile = %s\nverbose = 0\n" %
-                (op.basename(input_file), output_file))
+                (op.basename(input_file), op.basename(output_file)))
     ctl_h.write("icode = 0\nweighting = 0\ncommonf3x4 = 0\n")
     ctl_h.close()
 
-    cl = YnCommandline(ctl_file)
+    cl = YnCommandline(ctl_file, work_dir=work_dir)
     print >>sys.stderr, "\tyn00:", cl
     r, e = cl.run()
     ds_value_yn = None
@@ -588,10 +685,134 @@ def find_synonymous(input_file, work_dir):
         h = open(output_file)
         print >>sys.stderr, "yn00 didn't work: \n%s" % h.read()
 
-    os.chdir(cwd)
     return ds_value_yn, dn_value_yn, ds_value_ng, dn_value_ng
 
 
+# Nei-Gojobori (1986) estimator, computed in-process from codon alignments
+Bases = "TCAG"
+BaseCode = np.full(256, -1, dtype=np.int8)
+BaseCode[np.frombuffer(Bases + Bases.lower(), dtype=np.uint8)] = \
+            np.tile(np.arange(len(Bases)), 2)
+BaseCode[np.frombuffer("Uu", dtype=np.uint8)] = 0
+
+_codon_tables = {}
+
+
+def codon_tables(table_id=1):
+    """
+    Tables for NG86 counting, indexed by codon 16 * i + 4 * j + k in TCAG
+    order. Returns whether the codon is a stop, its synonymous sites, and
+    the synonymous and nonsynonymous differences between two codons averaged
+    over the mutational pathways that do not pass through a stop codon.
+    """
+    if table_id in _codon_tables:
+        return _codon_tables[table_id]
+
+    from Bio.Data.CodonTable import unambiguous_dna_by_id
+
+    forward = unambiguous_dna_by_id[table_id].forward_table
+    codons = ["".join(x) for x in product(Bases, repeat=3)]
+    aa = [forward.get(x) for x in codons]   # None for stop codons
+    index = dict((x, i) for i, x in enumerate(codons))
+
+    stop = np.array([x is None for x in aa])
+    S = np.zeros(64)
+    for c, codon in enumerate(codons):
+        for pos in xrange(3):
+            for b in Bases:
+                if b == codon[pos]:
+                    continue
+                mutant = codon[:pos] + b + codon[pos + 1:]
+                if aa[index[mutant]] == aa[c]:
+                    S[c] += 1. / 3
+
+    SD = np.zeros((64, 64))
+    ND = np.zeros((64, 64))
+    for c1, c2 in product(xrange(64), repeat=2):
+        if stop[c1] or stop[c2] or c1 == c2:
+            continue
+        a, b = codons[c1], codons[c2]
+        diffs = [pos for pos in xrange(3) if a[pos] != b[pos]]
+        npaths = sd = nd = 0
+        for path in permutations(diffs):
+            cur, syn = a, 0
+            for pos in path:
+                nxt = cur[:pos] + b[pos] + cur[pos + 1:]
+                if stop[index[nxt]]:
+                    break
+                syn += aa[index[nxt]] == aa[index[cur]]
+                cur = nxt
+            else:
+                npaths += 1
+                sd += syn
+                nd += len(diffs) - syn
+        if npaths:
+            SD[c1, c2], ND[c1, c2] = float(sd) / npaths, float(nd) / npaths
+        else:
+            ND[c1, c2] = len(diffs)
+
+    _codon_tables[table_id] = stop, S, SD, ND
+    return _codon_tables[table_id]
+
+
+def encode_codons(seq, stop):
+    """
+    Convert a CDS string to codon indices, -1 for codons with gaps,
+    ambiguous bases, or stops.
+    """
+    seq = seq[:len(seq) // 3 * 3]
+    code = BaseCode[np.frombuffer(seq, dtype=np.uint8)].reshape(-1, 3)
+    codons = 16 * code[:, 0].astype(int) + 4 * code[:, 1] + code[:, 2]
+    codons[(code < 0).any(axis=1)] = -1
+    codons[(codons >= 0) & stop[codons]] = -1
+    return codons
+
+
+def jukes_cantor(p):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d = -.75 * np.log(1 - 4 * p / 3)
+    d[~(p < .75)] = np.nan
+    return d
+
+
+def ng86(pairs, table_id=1):
+    """
+    Nei-Gojobori (1986) Ks and Ka for a batch of codon-aligned CDS pairs,
+    e.g. the output of run_mrtrans(outfmt="fasta"). Codons that are gapped,
+    ambiguous or stops in either sequence are skipped, as in yn00. Returns
+    two arrays, Ks and Ka, with nan where the estimate is undefined.
+    """
+    stop, S, SD, ND = codon_tables(table_id)
+    ca, cb, sizes = [], [], []
+    for a, b in pairs:
+        a, b = encode_codons(a, stop), encode_codons(b, stop)
+        n = min(len(a), len(b))
+        ca.append(a[:n])
+        cb.append(b[:n])
+        sizes.append(n)
+
+    npairs = len(sizes)
+    ids = np.repeat(np.arange(npairs), sizes)
+    ca, cb = np.concatenate(ca), np.concatenate(cb)
+    valid = (ca >= 0) & (cb >= 0)
+    ids, ca, cb = ids[valid], ca[valid], cb[valid]
+
+    ncodons = np.bincount(ids, minlength=npairs)
+    syn_sites = np.bincount(ids, weights=(S[ca] + S[cb]) / 2,
+                            minlength=npairs)
+    nonsyn_sites = 3 * ncodons - syn_sites
+    sd = np.bincount(ids, weights=SD[ca, cb], minlength=npairs)
+    nd = np.bincount(ids, weights=ND[ca, cb], minlength=npairs)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ps, pn = sd / syn_sites, nd / nonsyn_sites
+    return jukes_cantor(ps), jukes_cantor(pn)
+
+
+def format_subs(x):
+    return "NA" if np.isnan(x) else "{0:.4f}".format(x)
+
+
 def extract_subs_value(text):
     """Extract a subsitution value from a line of text.
 
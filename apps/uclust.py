@@ -8,23 +8,25 @@ The VCLUST implementation borrows ideas and code from PyRAD. PyRAD link:
 <https://github.com/dereneaton/pyrad>
 """
 
+import os
 import os.path as op
 import shutil
 import sys
 import logging
+import zipfile
 import numpy as np
 import scipy
-import scipy.stats
 import scipy.optimize
+import scipy.special
 
 from collections import defaultdict
 from copy import deepcopy
-from functools import partial
 from itertools import groupby
+from multiprocessing import Pool
 from subprocess import Popen, PIPE, STDOUT
-from tempfile import mkdtemp
+from tempfile import mkdtemp, mkstemp
 
-from jcvi.formats.base import BaseFile, FileMerger, must_open, split
+from jcvi.formats.base import BaseFile, FileMerger, must_open, file_stamp
 from jcvi.formats.fasta import parse_fasta
 from jcvi.formats.fastq import fasta
 from jcvi.utils.orderedcollections import DefaultOrderedDict
@@ -40,6 +42,8 @@ BASES = "ACTGN_-"  # CAUTION: DO NOT CHANGE THIS LINE
 REAL = BASES[:4]
 GAPS = BASES[-2:]
 NBASES = len(BASES)
+BASECODE = np.full(256, -1, dtype=np.int8)
+BASECODE[np.frombuffer(BASES, dtype=np.uint8)] = np.arange(NBASES)
 ACHEADER = """
 TAXON     CHR   POS     REF_NT  REF_ALLELE      ALT_ALLELE      REF_COUNT
 ALT_COUNT       OTHER_COUNT     TOTAL_READS     A       G       C       T
@@ -53,26 +57,180 @@ getsize = lambda name: (0 if ";" not in name else \
             int(name.split(";")[1].replace("size=", "")))
 
 
-class ClustFile (BaseFile):
+def parse_stacks(rows):
+    nstacks = 0
+    for tag, contents in groupby(rows, lambda row: row[0] == '/'):
+        if tag:
+            continue
+        data = Clust()
+        for name, seq in grouper(contents, 2):
+            name, seq = name.strip(), seq.strip()
+            nrep = getsize(name)
+            data.append((name, seq, nrep))
+        yield data
+        nstacks += 1
+        if nstacks % 10000 == 0:
+            logging.debug("{0} stacks parsed".format(nstacks))
+
+
+def read_until(fp, end):
+    """
+    Lines of fp from the current position up to byte offset end.
+    """
+    pos = fp.tell()
+    for row in fp:
+        if pos >= end:
+            break
+        pos += len(row)
+        yield row
+
 
+def _map_shard(arg):
+    func, filename, start, end, args = arg
+    return func(ClustFile(filename).iter_range(start, end), *args)
+
+
+class ClustFile (BaseFile):
+    """
+    Stacks of name and sequence lines separated by `//`. The byte offsets of
+    the stacks are indexed on first use and cached to `clustfile.idx.npz`,
+    keyed on the size and mtime of the file. The index gives random access
+    to stacks by number or by the name of their first read, and splits the
+    file into shards for a process pool without writing it out.
+    """
     def __init__(self, filename):
         super(ClustFile, self).__init__(filename)
+        self.idxfile = filename + ".idx.npz"
+        self._index = None
+        self._names = None
 
     def __iter__(self):
-        nstacks = 0
-        fp = must_open(self.filename)
-        for tag, contents in groupby(fp, lambda row: row[0] == '/'):
-            if tag:
-                continue
-            data = Clust()
-            for name, seq in grouper(contents, 2):
-                name, seq = name.strip(), seq.strip()
-                nrep = getsize(name)
-                data.append((name, seq, nrep))
-            yield data
-            nstacks += 1
-            if nstacks % 10000 == 0:
-                logging.debug("{0} stacks parsed".format(nstacks))
+        return self.iter_range()
+
+    def iter_range(self, start=0, end=None):
+        if start == 0 and end is None:
+            fp = rows = must_open(self.filename)
+        else:
+            fp = open(self.filename)
+            fp.seek(start)
+            rows = read_until(fp, end)
+        try:
+            for data in parse_stacks(rows):
+                yield data
+        finally:
+            fp.close()
+
+    @property
+    def index(self):
+        """
+        Start and end byte offsets of the stacks, and the names of their
+        first reads.
+        """
+        if self._index is None:
+            if not self.load_index():
+                self.build_index()
+                self.save_index()
+        return self._index
+
+    def build_index(self):
+        starts, ends, names = [], [], []
+        pos = 0
+        instack = False
+        for row in open(self.filename):
+            if row[0] == '/':
+                if instack:
+                    ends.append(pos)
+                    instack = False
+            elif not instack:
+                starts.append(pos)
+                names.append(row.split(";")[0].strip().lstrip(">"))
+                instack = True
+            pos += len(row)
+        if instack:
+            ends.append(pos)
+
+        self._index = np.array(starts, dtype=np.int64), \
+                      np.array(ends, dtype=np.int64), np.array(names)
+        logging.debug("Indexed {0} stacks in `{1}`".\
+                        format(len(starts), self.filename))
+
+    def save_index(self):
+        starts, ends, names = self._index
+        stamp = np.array(file_stamp(self.filename), dtype=np.int64)
+        np.savez(self.idxfile, stamp=stamp, starts=starts, ends=ends,
+                 names=names)
+        logging.debug("Stack index written to `{0}`".format(self.idxfile))
+
+    def load_index(self):
+        if not op.exists(self.idxfile):
+            return False
+
+        stamp = np.array(file_stamp(self.filename), dtype=np.int64)
+        try:
+            npz = np.load(self.idxfile)
+            if not np.array_equal(npz["stamp"], stamp):
+                logging.debug("Index `{0}` is stale".format(self.idxfile))
+                return False
+            self._index = npz["starts"], npz["ends"], npz["names"]
+            npz.close()
+        except (IOError, KeyError, ValueError, zipfile.BadZipfile) as e:
+            logging.error("Cannot load index `{0}`: {1}".\
+                            format(self.idxfile, e))
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.index[0])
+
+    def __getitem__(self, i):
+        starts, ends, names = self.index
+        fp = open(self.filename)
+        fp.seek(starts[i])
+        rows = fp.read(ends[i] - starts[i]).splitlines(True)
+        fp.close()
+        return next(parse_stacks(rows))
+
+    def get(self, name):
+        """
+        Stack whose first read is called name (without `>` and size).
+        """
+        if self._names is None:
+            self._names = dict((x, i) for i, x in enumerate(self.index[2]))
+        return self[self._names[name]]
+
+    def shards(self, n):
+        """
+        Split the stacks into at most n byte ranges [start, end) of about
+        the same size.
+        """
+        starts, ends, names = self.index
+        nstacks = len(starts)
+        if not nstacks:
+            return []
+        size = ends[-1] - starts[0]
+        targets = starts[0] + size * np.arange(1, n) / n
+        cuts = np.unique(np.searchsorted(starts, targets))
+        bounds = [0] + [x for x in cuts if 0 < x < nstacks] + [nstacks]
+        return [(starts[a], ends[b - 1]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def map(self, func, cpus=1, args=()):
+        """
+        Call func(stacks, *args) on each shard in a pool of cpus processes.
+        func must be a module-level function. Results come back in file order.
+        With one cpu the file is read through once, without the index.
+        """
+        if cpus <= 1:
+            return [func(iter(self), *args)]
+
+        jobs = [(func, self.filename, a, b, args) for a, b in self.shards(cpus)]
+        if cpus > 1 and len(jobs) > 1:
+            p = Pool(processes=min(cpus, len(jobs)))
+            results = p.map(_map_shard, jobs)
+            p.close()
+            p.join()
+        else:
+            results = [_map_shard(x) for x in jobs]
+        return results
 
 
 class Clust (list):
@@ -283,6 +441,8 @@ def mcluster(args):
 
 
 def makeloci(clustSfile, store, prefix, minsamp=3, pctid=95):
+    # Serial on purpose: loci are numbered along the file, and each stack
+    # needs the read profiles of all samples in `store`
     C = ClustFile(clustSfile)
     pf = clustSfile.rsplit(".", 1)[0]
     locifile = pf + ".loci"
@@ -521,6 +681,7 @@ def consensus(args):
                  help="Number of haplotypes per locus")
     add_consensus_options(p)
     p.set_verbose()
+    p.set_cpus()
     opts, args = p.parse_args(args)
 
     if len(args) != 1:
@@ -531,13 +692,55 @@ def consensus(args):
     mindepth = opts.mindepth
     minlength = opts.minlength
     verbose = opts.verbose
+    cpus = 1 if verbose else opts.cpus
 
     C = ClustFile(clustSfile)
     output = []
     bins = []
     indices = []
     start = end = 0  # Index into base count array
-    for data in C:
+    for shard_output, shard_bins in C.map(consensus_stacks, cpus=cpus,
+                                args=(mindepth, minlength, verbose)):
+        for fname, shortcon in shard_output:
+            start = end
+            end += len(shortcon)
+            indices.append((fname, start, end))
+        output.extend(shard_output)
+        bins.extend(shard_bins)
+
+    consensfile = pf + ".consensus"
+    consens = open(consensfile, 'w')
+    for k, v in output:
+        print >> consens, "\n".join((k, v))
+    consens.close()
+    logging.debug("Consensus sequences written to `{0}`".format(consensfile))
+
+    binfile = consensfile + ".bin"
+    bins = np.array(bins, dtype=np.uint32)
+    ulimit = 65535
+    bins[bins > ulimit] = ulimit
+    bins = np.array(bins, dtype=np.uint16)  # Compact size
+    bins.tofile(binfile)
+    logging.debug("Allele counts written to `{0}`".format(binfile))
+
+    idxfile = consensfile + ".idx"
+    fw = open(idxfile, "w")
+    for fname, start, end in indices:
+        print >> fw, "\t".join(str(x) for x in (fname, start, end))
+    fw.close()
+    logging.debug("Serializing indices to `{0}`".format(idxfile))
+
+    return consensfile, binfile, idxfile
+
+
+def consensus_stacks(stacks, mindepth, minlength, verbose=False):
+    """
+    Call consensus on stacks, returns the (name, consensus) list and the
+    base counts along the consensus sequences.
+    """
+    output = []
+    bins = []
+    for data in stacks:
         names, seqs, nreps = zip(*data)
         total_nreps = sum(nreps)
         # Depth filter
@@ -559,9 +762,6 @@ def consensus(args):
         if len(data) == 1:   # No computation needed
             output.append((fname, seq))
             bins.extend(RAD)
-            start = end
-            end += len(seq)
-            indices.append((fname, start, end))
             continue
 
         shortcon, shortRAD = compute_consensus(fname, cons_seq, \
@@ -579,49 +779,31 @@ def consensus(args):
         output.append((fname, shortcon))
         bins.extend(shortRAD)
 
-        start = end
-        end += len(shortcon)
-        indices.append((fname, start, end))
+    return output, bins
 
-    consensfile = pf + ".consensus"
-    consens = open(consensfile, 'w')
-    for k, v in output:
-        print >> consens, "\n".join((k, v))
-    consens.close()
-    logging.debug("Consensus sequences written to `{0}`".format(consensfile))
-
-    binfile = consensfile + ".bin"
-    bins = np.array(bins, dtype=np.uint32)
-    ulimit = 65535
-    bins[bins > ulimit] = ulimit
-    bins = np.array(bins, dtype=np.uint16)  # Compact size
-    bins.tofile(binfile)
-    logging.debug("Allele counts written to `{0}`".format(binfile))
 
-    idxfile = consensfile + ".idx"
-    fw = open(idxfile, "w")
-    for fname, start, end in indices:
-        print >> fw, "\t".join(str(x) for x in (fname, start, end))
-    fw.close()
-    logging.debug("Serializing indices to `{0}`".format(idxfile))
-
-    return consensfile, binfile, idxfile
+def stack_array(S):
+    """
+    Counts of BASES at each column of the aligned reads, weighted by nrep,
+    as a (ncols, NBASES) array.
+    """
+    S, nreps = zip(*S)
+    rows, cols = len(S), len(S[0])
+    codes = BASECODE[np.frombuffer("".join(S), dtype=np.uint8)]
+    assert len(codes) == rows * cols, "reads differ in length"
+    assert (codes >= 0).all(), "unexpected base in {0}".format(S)
+    codes = codes.reshape(rows, cols) + NBASES * np.arange(cols)
+    weights = np.repeat(np.array(nreps, dtype=np.int64), cols)
+    counts = np.bincount(codes.ravel(), weights=weights,
+                         minlength=cols * NBASES)
+    return counts.astype(np.int64).reshape(cols, NBASES)
 
 
 def stack(S):
     """
     From list of bases at a site D,  make counts of bases
     """
-    S, nreps = zip(*S)
-    S = np.array([list(x) for x in S])
-    rows, cols = S.shape
-    counts = []
-    for c in xrange(cols):
-        freq = [0] * NBASES
-        for b, nrep in zip(S[:, c], nreps):
-            freq[BASES.index(b)] += nrep
-        counts.append(freq)
-    return counts
+    return stack_array(S).tolist()
 
 
 def get_left_right(seq):
@@ -653,80 +835,104 @@ def cons(f, mindepth):
             S.append([seq, nrep])
 
         # Make list for each site in sequences
-        res = stack(S)
-        yield [x[:4] for x in res if sum(x[:4]) >= mindepth]
+        res = stack_array(S)[:, :4]
+        yield res[res.sum(axis=1) >= mindepth]
 
 
 def makeP(N):
     # Make list of freq. for BASES
-    sump = float(sum([sum(i) for i in N]))
+    N = np.asarray(N, dtype=float).reshape(-1, 4)
+    sump = N.sum()
     if sump:
-        p1 = sum([i[0] for i in N]) / sump
-        p2 = sum([i[1] for i in N]) / sump
-        p3 = sum([i[2] for i in N]) / sump
-        p4 = sum([i[3] for i in N]) / sump
-    else:
-        p1 = p2 = p3 = p4 = 0.0
-    return [p1, p2, p3, p4]
+        return list(N.sum(axis=0) / sump)
+    return [0.0] * 4
 
 
 def makeC(N):
     """
-    Makes a dictionary with counts of base counts [x,x,x,x]:x,
+    Unique base count patterns [x,x,x,x] and how often each occurs,
     speeds up Likelihood calculation
     """
-    C = defaultdict(int)
-    for d in N:
-        C[tuple(d)] += 1
+    N = np.asarray(N, dtype=np.int64).reshape(-1, 4)
+    N = N[N.any(axis=1)]
+    if not len(N):
+        return N, np.zeros(0, dtype=np.int64)
+    patterns, counts = np.unique(N, axis=0, return_counts=True)
+    return patterns, counts
 
-    return [i for i in C.items() if (0, 0, 0, 0) not in i]
+
+def log_binom_coef(n, k):
+    gammaln = scipy.special.gammaln
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def binom_pmf(logcoef, k, n, p):
+    # Same as scipy.stats.binom.pmf(k, n, p), with precomputed log coefficient
+    xlogy, xlog1py = scipy.special.xlogy, scipy.special.xlog1py
+    with np.errstate(invalid="ignore"):
+        return np.exp(logcoef + xlogy(k, p) + xlog1py(n - k, -p))
+
+
+class HELikelihood (object):
+    """
+    Likelihood of heterozygosity (H) and error rate (E) over all count
+    patterns N (one per row), with the terms that do not depend on E
+    computed once up front.
+    """
+    def __init__(self, P, N):
+        P = np.asarray(P, dtype=float)
+        N = np.asarray(N, dtype=float).reshape(-1, 4)
+        self.N = N
+        self.s = s = N.sum(axis=1)[:, None]
+        # Homozygous, all but base i are errors
+        self.P1 = P
+        self.k1 = s - N
+        self.c1 = log_binom_coef(s, self.k1)
+        # Heterozygous, all but bases l < j are errors, and l vs j is 50:50
+        l, j = np.triu_indices(4, 1)
+        four = 1. - (P ** 2).sum()
+        self.P2 = 2. * P[l] * P[j] / four
+        self.k2 = s - N[:, l] - N[:, j]
+        self.c2 = log_binom_coef(s, self.k2)
+        Nl, Nlj = N[:, l], N[:, l] + N[:, j]
+        self.three = binom_pmf(log_binom_coef(Nlj, Nl), Nl, Nlj, .5)
+
+    def L1(self, E):
+        return (self.P1 * binom_pmf(self.c1, self.k1, self.s, E)).sum(axis=1)
+
+    def L2(self, E):
+        two = binom_pmf(self.c2, self.k2, self.s, (2. * E) / 3.)
+        return (self.P2 * two * self.three).sum(axis=1)
+
+    def totlik(self, E, H):
+        return ((1 - H) * self.L1(E)) + (H * self.L2(E))
 
 
 def L1(E, P, N):
     # Probability of homozygous
-    h = []
-    s = sum(N)
-    for i, l in enumerate(N):
-        p = P[i]
-        b = scipy.stats.binom.pmf(s - l, s, E)
-        h.append(p * b)
-    return sum(h)
+    return HELikelihood(P, N).L1(E)
 
 
 def L2(E, P, N):
     # Probability of heterozygous
-    h = []
-    s = sum(N)
-    for l, i in enumerate(N):
-        for j, k in enumerate(N):
-            if j > l:
-                one = 2. * P[l] * P[j]
-                two = scipy.stats.binom.pmf(s - i - k, s, (2. * E) / 3.)
-                three = scipy.stats.binom.pmf(i, k + i, 0.5)
-                four = 1. - (sum([q ** 2. for q in P]))
-                h.append(one * two * (three / four))
-    return sum(h)
+    return HELikelihood(P, N).L2(E)
 
 
 def totlik(E, P, H, N):
     # Total probability
-    lik = ((1 - H) * L1(E, P, N)) + (H * L2(E, P, N))
-    return lik
+    return HELikelihood(P, N).totlik(E, H)
 
 
-def LL(x0, P, C):
+def LL(x0, lik, counts):
     # Log likelihood score given values [H, E]
     H, E = x0
-    L = []
     if H <= 0. or E <= 0.:
-        r = np.exp(100)
-    else:
-        for i in C:
-            ll = totlik(E, P, H, i[0])
-            if ll > 0:
-                L.append(i[1] * np.log(ll))
-        r = -sum(L)
-    return r
+        return np.exp(100)
+
+    ll = lik.totlik(E, H)
+    with np.errstate(invalid="ignore"):
+        ok = ll > 0
+    return -(counts[ok] * np.log(ll[ok])).sum()
 
 
 def estimateHE(args):
@@ -749,16 +955,19 @@ def estimateHE(args):
         logging.debug("File `{0}` found. Computation skipped.".format(HEfile))
         return HEfile
 
-    D = []
+    D = [np.zeros((0, 4), dtype=np.int64)]
     for d in cons(clustSfile, opts.mindepth):
-        D.extend(d)
+        D.append(d)
+    D = np.concatenate(D)
 
     logging.debug("Computing base frequencies ...")
     P = makeP(D)
-    C = makeC(D)
-    logging.debug("Solving log-likelihood function ...")
+    N, counts = makeC(D)
+    logging.debug("Solving log-likelihood function over {0} count patterns".\
+                    format(len(N)))
+    lik = HELikelihood(P, N)
     x0 = [.01, .001]  # initital values
-    H, E = scipy.optimize.fmin(LL, x0, args=(P, C))
+    H, E = scipy.optimize.fmin(LL, x0, args=(lik, counts))
 
     fw = must_open(HEfile, "w")
     print >> fw, H, E
@@ -795,20 +1004,18 @@ def sortalign(stringnames):
 
 
 def parallel_musclewrap(clustfile, cpus, minsamp=0):
-    musclewrap_minsamp = partial(musclewrap, minsamp=minsamp)
     if cpus == 1:
-        return musclewrap_minsamp(clustfile)
-
-    from jcvi.apps.grid import Jobs
+        return musclewrap(clustfile, minsamp=minsamp)
 
+    # Shard by offset ranges, each shard aligned into its own file
     outdir = mkdtemp(dir=".")
-    fs = split([clustfile, outdir, str(cpus), "--format=clust"])
-    g = Jobs(musclewrap_minsamp, fs.names)
-    g.run()
-
-    clustnames = [x.replace(".clust", ".clustS") for x in fs.names]
+    C = ClustFile(clustfile)
+    clustnames = C.map(musclewrap_shard, cpus=cpus, args=(outdir, minsamp))
     clustSfile = clustfile.replace(".clust", ".clustS")
-    FileMerger(clustnames, outfile=clustSfile).merge()
+    if clustnames:
+        FileMerger(clustnames, outfile=clustSfile).merge()
+    else:
+        open(clustSfile, "w").close()
     shutil.rmtree(outdir)
 
 
@@ -833,12 +1040,26 @@ def filter_samples(names, seqs, sep='.'):
     return filtered_names, filtered_seqs, seen
 
 
+def musclewrap_shard(stacks, outdir, minsamp=0):
+    fd, clustSfile = mkstemp(suffix=".clustS", dir=outdir)
+    os.close(fd)
+    fw = open(clustSfile, "w")
+    align_stacks(stacks, fw, minsamp=minsamp)
+    fw.close()
+    return clustSfile
+
+
 def musclewrap(clustfile, minsamp=0):
-    cnts = 0
     C = ClustFile(clustfile)
     clustSfile = clustfile.replace(".clust", ".clustS")
     fw = open(clustSfile, 'w')
-    for data in C:
+    align_stacks(C, fw, minsamp=minsamp)
+    fw.close()
+
+
+def align_stacks(stacks, fw, minsamp=0):
+    cnts = 0
+    for data in stacks:
         STACK = Clust()
         names = []
         seqs = []
@@ -865,17 +1086,14 @@ def musclewrap(clustfile, minsamp=0):
             print >> fw, STACK
         cnts += 1
 
-    fw.close()
 
+def stack_depths(stacks):
+    return [sum(nrep for name, seq, nrep in data) for data in stacks]
 
-def makestats(clustSfile, statsfile, mindepth):
+
+def makestats(clustSfile, statsfile, mindepth, cpus=1):
     C = ClustFile(clustSfile)
-    depth = []
-    for data in C:
-        d = 0
-        for name, seq, nrep in data:
-            d += nrep
-        depth.append(d)
+    depth = [d for shard in C.map(stack_depths, cpus=cpus) for d in shard]
     namecheck = op.basename(clustSfile).split(".")[0]
     if depth:
         me = round(np.mean(depth), 3)
@@ -1018,7 +1236,7 @@ def cluster(args):
 
     statsfile = pf + ".stats"
     if need_update(clustSfile, statsfile):
-        makestats(clustSfile, statsfile, mindepth=mindepth)
+        makestats(clustSfile, statsfile, mindepth=mindepth, cpus=cpus)
 
 
 def align(args):
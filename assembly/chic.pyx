@@ -103,3 +103,256 @@ def score_evaluate_Q(array.array[int] tour,
                 c = tour_Q[a, b, ic]
                 s += c / (GR[ic] + dist)
     return s,
+
+
+# Sparse variants, which take the ContactMatrix objects from CLMFile instead of
+# dense arrays. Only the stored pairs are visited, using the position of each
+# contig in the tour; the result is the same as the dense versions.
+
+
+def score_evaluate_M_sparse(array.array[int] tour,
+                            np.ndarray[INT, ndim=1] tour_sizes=None,
+                            tour_M=None):
+    cdef np.ndarray[INT, ndim=1] sizes_oo = tour_sizes[tour]
+    cdef np.ndarray[INT, ndim=1] sizes_cum = np.cumsum(sizes_oo) - sizes_oo // 2
+    cdef np.ndarray[INT, ndim=1] indptr = tour_M.indptr
+    cdef np.ndarray[INT, ndim=1] indices = tour_M.indices
+    cdef np.ndarray[INT, ndim=1] data = tour_M.data
+    cdef np.ndarray[INT, ndim=1] pos = np.empty(tour_M.N, dtype=int)
+
+    cdef double s = 0.0
+    cdef int size = len(tour)
+    cdef int a, ia, ib, k
+    cdef double dist
+    pos.fill(-1)
+    for ia in range(size):
+        pos[tour[ia]] = ia
+    for ia in range(size):
+        a = tour[ia]
+        for k in range(indptr[a], indptr[a + 1]):
+            ib = pos[indices[k]]
+            if ib <= ia or data[k] == 0:
+                continue
+            dist = sizes_cum[ib] - sizes_cum[ia]
+            if dist > LIMIT:
+                continue
+            s += data[k] / dist
+    return s,
+
+
+def score_evaluate_P_sparse(array.array[int] tour,
+                            np.ndarray[INT, ndim=1] tour_sizes=None,
+                            tour_P=None):
+    cdef np.ndarray[INT, ndim=1] sizes_oo = tour_sizes[tour]
+    cdef np.ndarray[INT, ndim=1] sizes_cum = np.cumsum(sizes_oo)
+    cdef np.ndarray[INT, ndim=1] indptr = tour_P.indptr
+    cdef np.ndarray[INT, ndim=1] indices = tour_P.indices
+    cdef np.ndarray[INT, ndim=2] data = tour_P.data
+    cdef np.ndarray[INT, ndim=1] pos = np.empty(tour_P.N, dtype=int)
+
+    cdef double s = 0.0
+    cdef int size = len(tour)
+    cdef int a, c, ia, ib, k
+    cdef double dist
+    pos.fill(-1)
+    for ia in range(size):
+        pos[tour[ia]] = ia
+    for ia in range(size):
+        a = tour[ia]
+        for k in range(indptr[a], indptr[a + 1]):
+            ib = pos[indices[k]]
+            if ib <= ia:
+                continue
+            dist = sizes_cum[ib - 1] - sizes_cum[ia]
+            if dist > LIMIT:
+                continue
+            c = data[k, 0]
+            if c == 0:
+                continue
+            s += c / (data[k, 1] + dist)
+    return s,
+
+
+def score_evaluate_Q_sparse(array.array[int] tour,
+                            np.ndarray[INT, ndim=1] tour_sizes=None,
+                            tour_Q=None,
+                            np.ndarray[INT, ndim=1] tour_signs=None):
+    cdef np.ndarray[INT, ndim=1] sizes_oo = tour_sizes[tour]
+    cdef np.ndarray[INT, ndim=1] sizes_cum = np.cumsum(sizes_oo)
+    cdef np.ndarray[INT, ndim=1] indptr = tour_Q.indptr
+    cdef np.ndarray[INT, ndim=1] indices = tour_Q.indices
+    cdef np.ndarray[np.int32_t, ndim=3] data = tour_Q.data
+    cdef np.ndarray[INT, ndim=1] pos = np.empty(tour_Q.N, dtype=int)
+    assert data.shape[2] == BB, "Q must have {} distance bins".format(BB)
+
+    cdef double s = 0.0
+    cdef int size = len(tour)
+    cdef int a, b, o, ia, ib, ic, k
+    cdef double dist
+    pos.fill(-1)
+    for ia in range(size):
+        pos[tour[ia]] = ia
+    for ia in range(size):
+        a = tour[ia]
+        for k in range(indptr[a], indptr[a + 1]):
+            b = indices[k]
+            ib = pos[b]
+            if ib <= ia:
+                continue
+            dist = sizes_cum[ib - 1] - sizes_cum[ia]
+            if dist > LIMIT:
+                continue
+            # Orientations are stored as ++, +-, -+, --
+            o = (tour_signs[a] < 0) * 2 + (tour_signs[b] < 0)
+            for ic in range(BB):
+                s += data[k, o, ic] / (GR[ic] + dist)
+    return s,
+
+
+# Delta evaluation: when two tours only differ in the slice [lo, hi), and that
+# slice holds the same contigs in both, only the pairs that touch the slice can
+# change their distance. The GA mutations in algorithms.ec record the parent
+# tour and score on the mutant, so the new score is the parent score plus the
+# difference over those pairs.
+
+
+cdef double segment_score_M(array.array[int] tour, int lo, int hi,
+                            INT[:] pos, INT[:] sizes_sum, INT[:] tour_sizes,
+                            INT[:] indptr, INT[:] indices, INT[:] data):
+    cdef double s = 0.0
+    cdef int a, b, ia, ib, k
+    cdef double dist
+    for ia in range(lo, hi):
+        a = tour[ia]
+        for k in range(indptr[a], indptr[a + 1]):
+            b = indices[k]
+            ib = pos[b]
+            if ib < 0 or data[k] == 0:
+                continue
+            if lo <= ib < hi and ib <= ia:  # count pairs within slice once
+                continue
+            # distance between mid-points
+            dist = (sizes_sum[ib] - tour_sizes[b] // 2) - \
+                   (sizes_sum[ia] - tour_sizes[a] // 2)
+            if dist < 0:
+                dist = -dist
+            if dist > LIMIT:
+                continue
+            s += data[k] / dist
+    return s
+
+
+def score_evaluate_M_delta(tour, np.ndarray[INT, ndim=1] tour_sizes=None,
+                           tour_M=None):
+    """
+    Same score as score_evaluate_M_sparse(), computed from `tour.parent` when
+    the mutant carries its parent tour and score.
+    """
+    parent = getattr(tour, "parent", None)
+    if parent is None:
+        return score_evaluate_M_sparse(tour, tour_sizes, tour_M)
+
+    ptour, pscore = parent
+    s = delta_M(tour, ptour, tour_sizes, tour_M)
+    if s is None:
+        return score_evaluate_M_sparse(tour, tour_sizes, tour_M)
+    return pscore + s,
+
+
+def delta_M(array.array[int] new, array.array[int] old,
+            np.ndarray[INT, ndim=1] tour_sizes, tour_M):
+    """
+    Score change from `old` to `new`, or None if they are not permutations
+    of each other within the changed slice, or the slice is long.
+    """
+    cdef int size = len(new)
+    cdef int lo = 0, hi = size
+    cdef int a, i
+    cdef INT c = 0
+    if len(old) != size:
+        return None
+    while lo < size and new[lo] == old[lo]:
+        lo += 1
+    if lo == size:
+        return 0
+    while new[hi - 1] == old[hi - 1]:
+        hi -= 1
+    if 2 * (hi - lo) > size:
+        return None
+
+    cdef np.ndarray[INT, ndim=1] pos = np.empty(tour_M.N, dtype=int)
+    cdef np.ndarray[INT, ndim=1] sizes_sum = np.empty(size, dtype=int)
+    pos.fill(-1)
+    for i in range(size):
+        a = new[i]
+        pos[a] = i
+        c += tour_sizes[a]
+        sizes_sum[i] = c
+    cdef np.ndarray[INT, ndim=1] indptr = tour_M.indptr
+    cdef np.ndarray[INT, ndim=1] indices = tour_M.indices
+    cdef np.ndarray[INT, ndim=1] data = tour_M.data
+    cdef double s = segment_score_M(new, lo, hi, pos, sizes_sum, tour_sizes,
+                                    indptr, indices, data)
+
+    # Same contigs in the slice, so the state outside of it is shared
+    c = sizes_sum[lo - 1] if lo else 0
+    for i in range(lo, hi):
+        a = old[i]
+        if not lo <= pos[a] < hi:
+            return None
+    for i in range(lo, hi):
+        a = old[i]
+        pos[a] = i
+        c += tour_sizes[a]
+        sizes_sum[i] = c
+    return s - segment_score_M(old, lo, hi, pos, sizes_sum, tour_sizes,
+                               indptr, indices, data)
+
+
+def tour_state(array.array[int] tour, np.ndarray[INT, ndim=1] tour_sizes,
+               int N):
+    """
+    Position of each contig in the tour (-1 if absent) and the cumulative
+    sizes along the tour, as used by score_contig_Q().
+    """
+    pos = np.empty(N, dtype=int)
+    pos.fill(-1)
+    pos[np.array(tour, dtype=int)] = np.arange(len(tour))
+    return pos, np.cumsum(tour_sizes[tour])
+
+
+def score_contig_Q(int a, np.ndarray[INT, ndim=1] pos,
+                   np.ndarray[INT, ndim=1] sizes_cum, tour_Q,
+                   np.ndarray[INT, ndim=1] tour_signs):
+    """
+    Part of score_evaluate_Q_sparse() from the pairs that involve contig `a`.
+    Flipping `a` only changes these pairs.
+    """
+    cdef np.ndarray[INT, ndim=1] indptr = tour_Q.indptr
+    cdef np.ndarray[INT, ndim=1] indices = tour_Q.indices
+    cdef np.ndarray[np.int32_t, ndim=3] data = tour_Q.data
+    assert data.shape[2] == BB, "Q must have {} distance bins".format(BB)
+
+    cdef double s = 0.0
+    cdef int b, o, ia, ib, ic, k
+    cdef double dist
+    ia = pos[a]
+    if ia < 0:
+        return s
+    for k in range(indptr[a], indptr[a + 1]):
+        b = indices[k]
+        ib = pos[b]
+        if ib < 0:
+            continue
+        if ib > ia:
+            dist = sizes_cum[ib - 1] - sizes_cum[ia]
+            o = (tour_signs[a] < 0) * 2 + (tour_signs[b] < 0)
+        else:
+            # Q[b, a] in orientation (b, a) is Q[a, b] with both flipped
+            dist = sizes_cum[ia - 1] - sizes_cum[ib]
+            o = (tour_signs[a] > 0) * 2 + (tour_signs[b] > 0)
+        if dist > LIMIT:
+            continue
+        for ic in range(BB):
+            s += data[k, o, ic] / (GR[ic] + dist)
+    return s
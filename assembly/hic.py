@@ -84,7 +84,41 @@ class ContigOrdering(LineFile):
                      gapsize=gapsize, gaptype=gaptype, evidence=evidence)
 
 
-class CLMFile:
+class ContactMatrix(object):
+    """
+    Contig-pair values in compressed sparse row layout. Row i holds the pairs
+    (i, indices[k]) with values data[k], for k in [indptr[i], indptr[i + 1]).
+    Each value can itself be an array, so data can have extra dimensions.
+    """
+    def __init__(self, N, rows, cols, data):
+        order = np.lexsort((cols, rows))
+        self.N = N
+        self.indptr = np.zeros(N + 1, dtype=int)
+        self.indptr[1:] = np.cumsum(np.bincount(rows, minlength=N))
+        self.indices = np.array(cols[order], dtype=int)
+        self.data = data[order]
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def __getitem__(self, ij):
+        i, j = ij
+        a, b = self.indptr[i], self.indptr[i + 1]
+        k = a + np.searchsorted(self.indices[a:b], j)
+        if k < b and self.indices[k] == j:
+            return self.data[k]
+        return np.zeros(self.data.shape[1:], dtype=self.data.dtype)
+
+    def toarray(self):
+        A = np.zeros((self.N, self.N) + self.data.shape[1:],
+                     dtype=self.data.dtype)
+        rows = np.repeat(np.arange(self.N), np.diff(self.indptr))
+        A[rows, self.indices] = self.data
+        return A
+
+
+class CLMFile(object):
     '''CLM file (modified) has the following format:
 
     tig00046211+ tig00063795+       1       53173
@@ -129,6 +163,7 @@ class CLMFile:
         self.contigs = set(_tigs)
         self.sizes = np.array(_sizes)
         self.tig_to_size = dict(tigs)
+        self.tigs = _tigs
 
         # Initially all contigs are considered active
         self.active = set(_tigs)
@@ -167,6 +202,43 @@ class CLMFile:
             strandedness, md, mh = min(dists, key=lambda x: x[-1])
             orientations[(at, bt)] = (strandedness, len(md), mh)
         self.orientations = orientations
+        self.index_contacts()
+
+    def index_contacts(self):
+        """
+        Collect the pairwise contacts into arrays over all contigs, from which
+        the sparse M, P and Q for the active contigs are cut out. Pairs are
+        stored in both directions, Q keeps the link histograms of all four
+        orientations in the order ++, +-, -+, --.
+        """
+        tig_to_gidx = dict((x, i) for (i, x) in enumerate(self.tigs))
+
+        def pair_arrays(pairs, dtype=int):
+            if not pairs:
+                return np.zeros(0, dtype=int), np.zeros(0, dtype=int), \
+                       np.zeros(0, dtype=dtype)
+            (rows, cols), data = zip(*pairs.keys()), pairs.values()
+            return np.array(rows), np.array(cols), np.array(data, dtype=dtype)
+
+        mpairs, ppairs, qpairs = {}, {}, {}
+        for (at, bt), links in self.contacts.items():
+            ai, bi = tig_to_gidx[at], tig_to_gidx[bt]
+            mpairs[(ai, bi)] = mpairs[(bi, ai)] = links
+        for (at, bt), (strandedness, md, mh) in self.orientations.items():
+            ai, bi = tig_to_gidx[at], tig_to_gidx[bt]
+            ppairs[(ai, bi)] = ppairs[(bi, ai)] = (md, mh)
+        empty = [0] * BB
+        for (at, bt), k in self.contacts_oriented.items():
+            ai, bi = tig_to_gidx[at], tig_to_gidx[bt]
+            qpairs[(ai, bi)] = [k.get((ao, bo), empty) \
+                        for ao, bo in ((1, 1), (1, -1), (-1, 1), (-1, -1))]
+
+        self.contact_pairs = {
+            "M": pair_arrays(mpairs),
+            "P": pair_arrays(ppairs),
+            "Q": pair_arrays(qpairs, dtype=np.int32),
+        }
+        self._matrices = {}
 
     def calculate_densities(self):
         """
@@ -256,23 +328,24 @@ class CLMFile:
     def evaluate_tour_M(self, tour):
         """ Use Cythonized version to evaluate the score of a current tour
         """
-        from .chic import score_evaluate_M
-        return score_evaluate_M(tour, self.active_sizes, self.M)
+        from .chic import score_evaluate_M_sparse
+        return score_evaluate_M_sparse(tour, self.active_sizes, self.M)
 
     def evaluate_tour_P(self, tour):
         """ Use Cythonized version to evaluate the score of a current tour,
         with better precision on the distance of the contigs.
         """
-        from .chic import score_evaluate_P
-        return score_evaluate_P(tour, self.active_sizes, self.P)
+        from .chic import score_evaluate_P_sparse
+        return score_evaluate_P_sparse(tour, self.active_sizes, self.P)
 
     def evaluate_tour_Q(self, tour):
         """ Use Cythonized version to evaluate the score of a current tour,
         taking orientation into consideration. This may be the most accurate
         evaluation under the right condition.
         """
-        from .chic import score_evaluate_Q
-        return score_evaluate_Q(tour, self.active_sizes, self.Q)
+        from .chic import score_evaluate_Q_sparse
+        return score_evaluate_Q_sparse(tour, self.active_sizes, self.Q,
+                                       np.asarray(self.signs, dtype=int))
 
     def flip_log(self, method, score, score_flipped, tag):
         logging.debug("{}: {} => {} {}"\
@@ -316,13 +389,20 @@ class CLMFile:
         """ Test flipping every single contig sequentially to see if score
         improves.
         """
+        from .chic import tour_state, score_contig_Q
+
         n_accepts = n_rejects = 0
         any_tag_ACCEPT = False
+        Q = self.Q
+        pos, sizes_cum = tour_state(tour, self.active_sizes, self.N)
         for i, t in enumerate(tour):
             if i == 0:
                 score, = self.evaluate_tour_Q(tour)
+            # Only the pairs involving t change when t is flipped
+            before = score_contig_Q(t, pos, sizes_cum, Q, self.signs)
             self.signs[t] = -self.signs[t]
-            score_flipped, = self.evaluate_tour_Q(tour)
+            score_flipped = score - before + \
+                            score_contig_Q(t, pos, sizes_cum, Q, self.signs)
             if score_flipped > score:
                 n_accepts += 1
                 tag = ACCEPT
@@ -382,13 +462,31 @@ class CLMFile:
 
         return tour
 
+    @property
+    def active(self):
+        return self._active
+
+    @active.setter
+    def active(self, contigs):
+        """
+        Changing the active contigs resets the cached sizes and matrices, note
+        that the set must be re-assigned (e.g. `self.active -= remove`) rather
+        than modified in place.
+        """
+        self._active = contigs
+        self._active_contigs = list(contigs)
+        self._matrices = {}
+
     @property
     def active_contigs(self):
-        return list(self.active)
+        return self._active_contigs
 
     @property
     def active_sizes(self):
-        return np.array([self.tig_to_size[x] for x in self.active])
+        if "sizes" not in self._matrices:
+            self._matrices["sizes"] = np.array([self.tig_to_size[x] \
+                                        for x in self.active_contigs])
+        return self._matrices["sizes"]
 
     @property
     def N(self):
@@ -400,7 +498,24 @@ class CLMFile:
 
     @property
     def tig_to_idx(self):
-        return dict((x, i) for (i, x) in enumerate(self.active))
+        return dict((x, i) for (i, x) in enumerate(self.active_contigs))
+
+    def contact_matrix(self, kind):
+        """
+        Sparse matrix of the active contigs, built once per active set.
+        """
+        if kind in self._matrices:
+            return self._matrices[kind]
+
+        tig_to_idx = self.tig_to_idx
+        gidx_to_idx = np.array([tig_to_idx.get(x, -1) for x in self.tigs],
+                               dtype=int)
+        rows, cols, data = self.contact_pairs[kind]
+        rows, cols = gidx_to_idx[rows], gidx_to_idx[cols]
+        keep = (rows >= 0) & (cols >= 0)
+        matrix = ContactMatrix(self.N, rows[keep], cols[keep], data[keep])
+        self._matrices[kind] = matrix
+        return matrix
 
     @property
     def M(self):
@@ -408,16 +523,7 @@ class CLMFile:
         Contact frequency matrix. Each cell contains how many inter-contig links
         between i-th and j-th contigs.
         """
-        N = self.N
-        tig_to_idx = self.tig_to_idx
-        M = np.zeros((N, N), dtype=int)
-        for (at, bt), links in self.contacts.items():
-            if not (at in tig_to_idx and bt in tig_to_idx):
-                continue
-            ai = tig_to_idx[at]
-            bi = tig_to_idx[bt]
-            M[ai, bi] = M[bi, ai] = links
-        return M
+        return self.contact_matrix("M")
 
     @property
     def O(self):
@@ -447,38 +553,18 @@ class CLMFile:
         shortest. This offers better precision for the distance between big
         contigs.
         """
-        N = self.N
-        tig_to_idx = self.tig_to_idx
-        P = np.zeros((N, N, 2), dtype=int)
-        for (at, bt), (strandedness, md, mh) in self.orientations.items():
-            if not (at in tig_to_idx and bt in tig_to_idx):
-                continue
-            ai = tig_to_idx[at]
-            bi = tig_to_idx[bt]
-            P[ai, bi, 0] = P[bi, ai, 0] = md
-            P[ai, bi, 1] = P[bi, ai, 1] = mh
-        return P
+        return self.contact_matrix("P")
 
     @property
     def Q(self):
         """
         Contact frequency matrix when contigs are already oriented. This is s a
         similar matrix as M, but rather than having the number of links in the
-        cell, it points to an array that has the actual distances.
+        cell, it points to an array that has the actual distances. Each cell
+        holds the arrays of all four orientations, and the one that matches the
+        current signs is picked at evaluation time.
         """
-        N = self.N
-        tig_to_idx = self.tig_to_idx
-        signs = self.signs
-        Q = np.ones((N, N, BB), dtype=int) * -1  # Use -1 as the sentinel
-        for (at, bt), k in self.contacts_oriented.items():
-            if not (at in tig_to_idx and bt in tig_to_idx):
-                continue
-            ai = tig_to_idx[at]
-            bi = tig_to_idx[bt]
-            ao = signs[ai]
-            bo = signs[bi]
-            Q[ai, bi] = k[(ao, bo)]
-        return Q
+        return self.contact_matrix("Q")
 
 
 def hmean_int(a, a_min=5778, a_max=1149851):
@@ -514,10 +600,10 @@ def golden_array(a, phi=1.61803398875, lb=LB, ub=UB):
 def prune_tour_worker(arg):
     """ Worker thread for CLMFile.prune_tour()
     """
-    from .chic import score_evaluate_M
+    from .chic import score_evaluate_M_sparse
 
     t, stour, tour_score, active_sizes, M = arg
-    stour_score, = score_evaluate_M(stour, active_sizes, M)
+    stour_score, = score_evaluate_M_sparse(stour, active_sizes, M)
     delta_score = tour_score - stour_score
     log10d = np.log10(delta_score) if delta_score > 1e-9 else -9
     return t, log10d
@@ -781,7 +867,7 @@ def optimize_ordering(fwtour, clm, phase, cpus):
     """
     Optimize the ordering of contigs by Genetic Algorithm (GA).
     """
-    from .chic import score_evaluate_M
+    from .chic import score_evaluate_M_delta
 
     # Prepare input files
     tour_contigs = clm.active_contigs
@@ -803,7 +889,7 @@ def optimize_ordering(fwtour, clm, phase, cpus):
 
     callbacki = partial(callback, phase=phase, oo=oo)
     toolbox = GA_setup(tour)
-    toolbox.register("evaluate", score_evaluate_M,
+    toolbox.register("evaluate", score_evaluate_M_delta,
                      tour_sizes=tour_sizes, tour_M=tour_M)
     tour, tour_fitness = GA_run(toolbox, ngen=1000, npop=100, cpus=cpus,
                                 callback=callbacki)
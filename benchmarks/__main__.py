@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Performance benchmarks for the core parsers and algorithms, with regression tracking against a saved baseline
+"""
+
+from jcvi.benchmarks.suite import main
+
+
+if __name__ == '__main__':
+    main()
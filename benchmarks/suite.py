@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Time the core parsers and algorithms on synthetic inputs of several scales.
+Each case runs in its own process so that its peak RSS can be reported, and
+the results are written as JSON that can be compared against a baseline.
+"""
+
+import os
+import os.path as op
+import sys
+import array
+import json
+import logging
+import platform
+import resource
+
+import numpy as np
+
+from multiprocessing import Pool
+from timeit import default_timer
+
+from jcvi import __version__
+from jcvi.apps.base import OptionParser, ActionDispatcher, mkdir
+
+
+Scales = {"small": 10000, "medium": 100000, "large": 1000000}
+Nchrs = 12
+ChrSize = 10 ** 7
+
+
+def simulate_bed(filename, n, rs):
+    seqids = rs.randint(1, Nchrs + 1, size=n)
+    starts = rs.randint(0, ChrSize, size=n)
+    ends = starts + rs.randint(100, 5000, size=n)
+    strands = rs.choice(["+", "-"], size=n)
+    fw = open(filename, "w")
+    for i in xrange(n):
+        print >> fw, "chr{0:02d}\t{1}\t{2}\tgene{3:07d}\t0\t{4}".\
+                format(seqids[i], starts[i], ends[i], i, strands[i])
+    fw.close()
+
+
+def simulate_gff(filename, n, rs):
+    """
+    Genes with one mRNA, and exons and CDS in pairs, about `n` lines total.
+    """
+    ngenes = max(n / 8, 1)
+    seqids = rs.randint(1, Nchrs + 1, size=ngenes)
+    starts = np.sort(rs.randint(0, ChrSize, size=ngenes))
+    strands = rs.choice(["+", "-"], size=ngenes)
+    fw = open(filename, "w")
+    print >> fw, "##gff-version 3"
+    for i in xrange(ngenes):
+        seqid, start, strand = "chr{0:02d}".format(seqids[i]), starts[i], \
+                                strands[i]
+        gene, mrna = "gene{0:07d}".format(i), "gene{0:07d}.1".format(i)
+        end = start + 3000
+
+        def feature(ftype, a, b, attributes, phase="."):
+            print >> fw, "\t".join(str(x) for x in (seqid, "sim", ftype,
+                            a, b, ".", strand, phase, attributes))
+
+        feature("gene", start, end, "ID={0};Name={0}".format(gene))
+        feature("mRNA", start, end, "ID={0};Parent={1}".format(mrna, gene))
+        for j in xrange(3):
+            a, b = start + j * 1000, start + j * 1000 + 600
+            feature("exon", a, b, "ID={0}.exon{1};Parent={0}".format(mrna, j))
+            feature("CDS", a, b, "ID={0}.cds{1};Parent={0}".format(mrna, j),
+                    phase="0")
+    fw.close()
+
+
+def simulate_blast(filename, n, rs):
+    """
+    Collinear blocks of 50 hits, plus 20% random hits.
+    """
+    nblocks, blocksize = max(int(n * .8) / 50, 1), 50
+    ngenes = max(n / 2, 1)
+    walk = np.tile(np.arange(blocksize), nblocks)
+    qi = np.repeat(rs.randint(0, ngenes, size=nblocks), blocksize) + walk
+    si = np.repeat(rs.randint(0, ngenes, size=nblocks), blocksize) + walk
+    nrandom = n - len(qi)
+    qi = np.concatenate((qi, rs.randint(0, ngenes, size=nrandom)))
+    si = np.concatenate((si, rs.randint(0, ngenes, size=nrandom)))
+    order = np.argsort(qi, kind="mergesort")
+    pctid = rs.uniform(70, 100, size=n)
+    scores = rs.uniform(50, 1000, size=n)
+    fw = open(filename, "w")
+    for i in order:
+        print >> fw, "a{0:07d}\tb{1:07d}\t{2:.2f}\t300\t10\t0\t1\t300\t1\t300"\
+                     "\t1e-50\t{3:.1f}".format(qi[i], si[i], pctid[i], scores[i])
+    fw.close()
+
+
+def simulate_fasta(filename, n, rs, width=60):
+    """
+    Total of `n` * 100 bases, spread over `Nchrs` sequences.
+    """
+    size = max(n * 100 / Nchrs, 1)
+    fw = open(filename, "w")
+    for i in xrange(Nchrs):
+        seq = np.array(list("ACGT"))[rs.randint(0, 4, size=size)].tostring()
+        print >> fw, ">chr{0:02d}".format(i + 1)
+        for j in xrange(0, size, width):
+            print >> fw, seq[j: j + width]
+    fw.close()
+
+
+def simulate_fastq(filename, n, rs, readlen=100):
+    bases = np.array(list("ACGT"))
+    quals = np.array([chr(x) for x in xrange(35, 74)])
+    fw = open(filename, "w")
+    for i in xrange(n):
+        print >> fw, "@read{0:08d}".format(i)
+        print >> fw, bases[rs.randint(0, 4, size=readlen)].tostring()
+        print >> fw, "+"
+        print >> fw, quals[rs.randint(0, len(quals), size=readlen)].tostring()
+    fw.close()
+
+
+def simulate_clm(pf, n, rs):
+    """
+    Calls `assembly.hic.simulate`, which writes `pf.clm` and `pf.ids` in the
+    current directory.
+    """
+    from jcvi.assembly.hic import simulate
+
+    np.random.seed(rs.randint(0, 2 ** 31))
+    contigs = min(max(n / 100, 20), 2000)
+    simulate([pf, "--genomesize={0}".format(n * 100),
+              "--genes={0}".format(max(n / 10, 10)),
+              "--contigs={0}".format(contigs), "--coverage=2"])
+
+
+Inputs = (
+    ("bed", simulate_bed),
+    ("gff3", simulate_gff),
+    ("blast", simulate_blast),
+    ("fasta", simulate_fasta),
+    ("fastq", simulate_fastq),
+)
+
+
+def synthesize(workdir, scale, seed=42):
+    """
+    Write all inputs for the scale, unless they are already in `workdir`.
+    Same seed gives the same files.
+    """
+    n = Scales[scale]
+    mkdir(workdir)
+    files = {}
+    for i, (ext, simulator) in enumerate(Inputs):
+        filename = op.join(workdir, "{0}.{1}".format(scale, ext))
+        files[ext] = filename
+        if op.exists(filename):
+            continue
+        logging.debug("Synthesize `{0}` ({1} records)".format(filename, n))
+        simulator(filename, n, np.random.RandomState(seed + i))
+
+    clm = op.join(workdir, scale + ".clm")
+    files["clm"] = clm
+    if not op.exists(clm):
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            simulate_clm(scale, n, np.random.RandomState(seed + len(Inputs)))
+        finally:
+            os.chdir(cwd)
+
+    return files
+
+
+# Each case takes the input files and the scale, and returns a function to be
+# timed, together with the number of items processed by each call.
+
+
+def case_bed(files, n):
+    from jcvi.formats.bed import Bed
+    return lambda: Bed(files["bed"]), n
+
+
+def case_gff(files, n):
+    from jcvi.formats.gff import Gff
+
+    def run():
+        for g in Gff(files["gff3"]):
+            g.accn
+    nlines = sum(1 for x in open(files["gff3"]) if x[0] != '#')
+    return run, nlines
+
+
+def case_blast(files, n):
+    from jcvi.formats.blast import Blast
+
+    def run():
+        for b in Blast(files["blast"]):
+            pass
+    return run, n
+
+
+def case_blast_array(files, n):
+    from jcvi.formats.blast import BlastArray
+
+    # Time the parse, not the load of the .npz cache
+    return lambda: BlastArray(files["blast"], cache=False), n
+
+
+def case_synteny_scan(files, n):
+    from jcvi.compara.synteny import synteny_scan
+
+    points = []
+    for row in open(files["blast"]):
+        atoms = row.split("\t")
+        points.append((int(atoms[0][1:]), int(atoms[1][1:]), float(atoms[-1])))
+    return lambda: synteny_scan(list(points), 20, 20, 5), len(points)
+
+
+def case_range_union(files, n):
+    from jcvi.utils.range import range_union
+
+    ranges = []
+    for row in open(files["bed"]):
+        seqid, start, end = row.split("\t")[:3]
+        ranges.append((seqid, int(start) + 1, int(end)))
+    return lambda: range_union(list(ranges)), len(ranges)
+
+
+def _clm_setup(files):
+    from jcvi.assembly.hic import CLMFile
+
+    clm = CLMFile(files["clm"])
+    clm.signs = np.ones(clm.N, dtype=int)
+    return clm, array.array('i', range(clm.N)), clm.active_sizes
+
+
+def _score_case(method, ntours=20):
+    def case(files, n):
+        clm, tour = _clm_setup(files)[:2]
+        evaluate = getattr(clm, "evaluate_tour_" + method)
+
+        def run():
+            for i in xrange(ntours):
+                evaluate(tour)
+        return run, ntours
+    case.__name__ = "case_score_evaluate_" + method
+    return case
+
+
+case_score_evaluate_M = _score_case("M")
+case_score_evaluate_P = _score_case("P")
+case_score_evaluate_Q = _score_case("Q")
+
+
+def case_score_evaluate(files, n):
+    from jcvi.assembly.hic import score_evaluate
+
+    clm, tour, sizes = _clm_setup(files)
+    M = clm.M.toarray()
+    return lambda: score_evaluate(tour, sizes, M), 1
+
+
+def _slices(files, n, width=1000, seed=7):
+    from jcvi.formats.fasta import FaidxFasta
+
+    rs = np.random.RandomState(seed)
+    sizes = dict(FaidxFasta(files["fasta"]).itersizes())
+    seqids = sorted(sizes)
+    slices = []
+    for i in xrange(max(n / 10, 1)):
+        seqid = seqids[rs.randint(0, len(seqids))]
+        start = rs.randint(1, max(sizes[seqid] - width, 1) + 1)
+        slices.append(dict(chr=seqid, start=start,
+                           stop=min(start + width - 1, sizes[seqid]),
+                           strand=rs.choice(["+", "-"])))
+    return slices
+
+
+def case_fasta_slice(files, n):
+    from jcvi.formats.fasta import Fasta
+
+    f = Fasta(files["fasta"])
+    slices = _slices(files, n)
+
+    def run():
+        for s in slices:
+            f.sequence(s)
+    return run, len(slices)
+
+
+def case_faidx_slice(files, n):
+    from jcvi.formats.fasta import FaidxFasta
+
+    f = FaidxFasta(files["fasta"])
+    slices = _slices(files, n)
+
+    def run():
+        for s in slices:
+            f.sequence(s)
+    return run, len(slices)
+
+
+def case_fastq(files, n):
+    from jcvi.formats.fastq import iter_fastq
+
+    def run():
+        for rec in iter_fastq(files["fastq"]):
+            pass
+    return run, n
+
+
+def case_fastq_blocks(files, n):
+    from jcvi.formats.fastq import iter_fastq_blocks
+
+    def run():
+        for blk in iter_fastq_blocks(files["fastq"]):
+            blk.is_high_qv("5")
+    return run, n
+
+
+Cases = (
+    ("bed", case_bed),
+    ("gff", case_gff),
+    ("blast", case_blast),
+    ("blast_array", case_blast_array),
+    ("synteny_scan", case_synteny_scan),
+    ("range_union", case_range_union),
+    ("score_evaluate", case_score_evaluate),
+    ("score_evaluate_M", case_score_evaluate_M),
+    ("score_evaluate_P", case_score_evaluate_P),
+    ("score_evaluate_Q", case_score_evaluate_Q),
+    ("fasta_slice", case_fasta_slice),
+    ("faidx_slice", case_faidx_slice),
+    ("fastq", case_fastq),
+    ("fastq_blocks", case_fastq_blocks),
+)
+CaseDict = dict(Cases)
+
+
+def maxrss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac, and in kilobytes elsewhere
+    return rss / (1024. ** 2 if sys.platform == "darwin" else 1024.)
+
+
+def run_case(args):
+    """
+    Set up and time one case, in a fresh worker process.
+    """
+    name, files, scale, repeat = args
+    logger = logging.getLogger()
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    record = dict(name=name, scale=scale)
+    try:
+        fn, items = CaseDict[name](files, Scales[scale])
+        timings = []
+        for i in xrange(repeat):
+            t0 = default_timer()
+            fn()
+            timings.append(default_timer() - t0)
+    except ImportError as e:
+        record.update(skipped=str(e))
+        return record
+    finally:
+        logger.setLevel(level)
+
+    seconds = min(timings)
+    record.update(items=items, seconds=seconds,
+                  throughput=items / seconds if seconds else None,
+                  maxrss_mb=maxrss_mb())
+    return record
+
+
+def main():
+
+    actions = (
+        ('run', 'synthesize inputs and time the benchmark cases'),
+        ('compare', 'compare benchmark results against a baseline'),
+            )
+    p = ActionDispatcher(actions)
+    p.dispatch(globals())
+
+
+def key(record):
+    return record["name"], record["scale"]
+
+
+def print_records(records, baseline=None, tolerance=.2, fw=sys.stdout):
+    """
+    Print the records as a table, and return the records that are slower than
+    the baseline by more than `tolerance`.
+    """
+    base = dict((key(x), x) for x in (baseline or []) if "seconds" in x)
+    regressions = []
+    print >> fw, "\t".join(("name", "scale", "items", "seconds", "items/s",
+                            "maxrss_mb", "vs_baseline"))
+    for r in records:
+        if "skipped" in r:
+            print >> fw, "\t".join((r["name"], r["scale"],
+                                    "skipped: " + r["skipped"]))
+            continue
+        ratio = ""
+        b = base.get(key(r))
+        if b and b["seconds"]:
+            x = r["seconds"] / b["seconds"]
+            ratio = "{0:.2f}x".format(x)
+            if x > 1 + tolerance:
+                ratio += " REGRESSION"
+                regressions.append(r)
+        print >> fw, "\t".join(str(x) for x in (r["name"], r["scale"],
+                    r["items"], "{0:.4f}".format(r["seconds"]),
+                    "{0:.0f}".format(r["throughput"] or 0),
+                    "{0:.1f}".format(r["maxrss_mb"]), ratio))
+    return regressions
+
+
+def load_records(jsonfile):
+    fp = open(jsonfile)
+    data = json.load(fp)
+    fp.close()
+    return data["results"]
+
+
+def compare(args):
+    """
+    %prog compare results.json baseline.json
+
+    Compare benchmark results against a baseline. Exits with non-zero status if
+    any case is slower than the baseline by more than the tolerance.
+    """
+    p = OptionParser(compare.__doc__)
+    p.add_option("--tolerance", default=.2, type="float",
+                 help="Allowed slowdown relative to baseline")
+    opts, args = p.parse_args(args)
+
+    if len(args) != 2:
+        sys.exit(not p.print_help())
+
+    results, baseline = args
+    regressions = print_records(load_records(results),
+                                baseline=load_records(baseline),
+                                tolerance=opts.tolerance)
+    if regressions:
+        logging.error("{0} regressions found".format(len(regressions)))
+        sys.exit(1)
+
+
+def run(args):
+    """
+    %prog run
+
+    Synthesize deterministic inputs (BED, GFF3, BLAST, FASTA, FASTQ, CLM) and
+    time the core parsers and algorithms on them. The results are written to
+    a JSON file that can be used as the baseline of later runs.
+    """
+    p = OptionParser(run.__doc__)
+    p.add_option("--scales", default="small",
+                 help="Scales to run, any of {0}".format(",".join(sorted(Scales,
+                      key=Scales.get))))
+    p.add_option("--cases", default=",".join(x for x, y in Cases),
+                 help="Cases to run")
+    p.add_option("--repeat", default=3, type="int",
+                 help="Time each case this many times and keep the best")
+    p.add_option("--workdir", default="bench_work",
+                 help="Directory to keep the synthesized inputs")
+    p.add_option("--seed", default=42, type="int",
+                 help="Random seed for the inputs")
+    p.add_option("--baseline",
+                 help="JSON file from an earlier run to compare against")
+    p.add_option("--tolerance", default=.2, type="float",
+                 help="Allowed slowdown relative to baseline")
+    p.set_outfile(outfile="benchmarks.json")
+    opts, args = p.parse_args(args)
+
+    if len(args) != 0:
+        sys.exit(not p.print_help())
+
+    scales = opts.scales.split(",")
+    cases = opts.cases.split(",")
+    for x in scales:
+        assert x in Scales, "Scale `{0}` not in {1}".format(x, sorted(Scales))
+    for x in cases:
+        assert x in CaseDict, "Case `{0}` not in {1}".format(x, sorted(CaseDict))
+
+    records = []
+    for scale in scales:
+        files = synthesize(opts.workdir, scale, seed=opts.seed)
+        for name in cases:
+            logging.debug("Run `{0}` at scale `{1}`".format(name, scale))
+            pool = Pool(processes=1)
+            records.append(pool.apply(run_case,
+                                      ((name, files, scale, opts.repeat),)))
+            pool.close()
+            pool.join()
+
+    baseline = load_records(opts.baseline) if opts.baseline else None
+    regressions = print_records(records, baseline=baseline,
+                                tolerance=opts.tolerance, fw=sys.stderr)
+
+    fw = open(opts.outfile, "w")
+    json.dump(dict(version=__version__, python=platform.python_version(),
+                   platform=platform.platform(), seed=opts.seed,
+                   results=records), fw, indent=2, sort_keys=True)
+    fw.close()
+    logging.debug("Results written to `{0}`".format(opts.outfile))
+
+    if regressions:
+        logging.error("{0} regressions found".format(len(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,11 +24,13 @@ import sys
 import logging
 import os.path as op
 
+import numpy as np
+
 from collections import defaultdict
 from itertools import groupby
 
-from jcvi.formats.blast import Blast
-from jcvi.utils.grouper import Grouper
+from jcvi.formats.blast import BlastArray
+from jcvi.utils.grouper import DisjointSet
 from jcvi.utils.cbook import gene_name
 from jcvi.compara.synteny import check_beds
 from jcvi.apps.base import OptionParser
@@ -41,24 +43,23 @@ def blastfilter_main(blast_file, p, opts):
     tandem_Nmax = opts.tandem_Nmax
     cscore = opts.cscore
 
-    fp = open(blast_file)
-    total_lines = sum(1 for line in fp if line[0] != '#')
+    bl = BlastArray(blast_file, cpus=opts.cpus)
     logging.debug("Load BLAST file `%s` (total %d lines)" % \
-            (blast_file, total_lines))
-    bl = Blast(blast_file)
-    blasts = sorted(list(bl), key=lambda b: b.score, reverse=True)
+            (blast_file, len(bl)))
+    # descending score, ties kept in file order
+    order = np.argsort(-bl.data["score"], kind="mergesort")
 
     filtered_blasts = []
     seen = set()
     ostrip = opts.strip_names
+    names = [gene_name(x) for x in bl.names] if ostrip else list(bl.names)
+    qids, sids = bl.data["query"], bl.data["subject"]
     nwarnings = 0
-    for b in blasts:
-        query, subject = b.query, b.subject
-        if query == subject:
+    for i in order:
+        if qids[i] == sids[i]:
             continue
 
-        if ostrip:
-            query, subject = gene_name(query), gene_name(subject)
+        query, subject = names[qids[i]], names[sids[i]]
         if query not in qorder:
             if nwarnings < 100:
                 logging.warning("{0} not in {1}".format(query,
@@ -89,6 +90,7 @@ def blastfilter_main(blast_file, p, opts):
         if key in seen:
             continue
         seen.add(key)
+        b = bl.line(i)
         b.query, b.subject = key
 
         b.qi, b.si = qi, si
@@ -236,7 +238,7 @@ def tandem_grouper(bed, blast_list, tandem_Nmax=10, flip=True):
 
     simple_blast.sort()
 
-    standems = Grouper()
+    pairs = []
     for name, hits in groupby(simple_blast, key=lambda x: x[0]):
         # these are already sorted.
         hits = [x[1] for x in hits]
@@ -244,8 +246,10 @@ def tandem_grouper(bed, blast_list, tandem_Nmax=10, flip=True):
             b = hits[ia + 1]
             # on the same chr and rank difference no larger than tandem_Nmax
             if b[1] - a[1] <= tandem_Nmax and b[0] == a[0]:
-                standems.join(a[1], b[1])
+                pairs.append((a[1], b[1]))
 
+    standems = DisjointSet()
+    standems.join_pairs(pairs)
     return standems
 
 
@@ -254,6 +258,7 @@ def main(args):
     p = OptionParser(__doc__)
     p.set_beds()
     p.set_stripnames()
+    p.set_cpus(cpus=1)
     p.add_option("--tandems_only", dest="tandems_only",
             action="store_true", default=False,
             help="only calculate tandems, write .localdup file and exit.")
@@ -13,7 +13,7 @@ from jcvi.formats.blast import BlastLine
 from jcvi.formats.fasta import Fasta
 from jcvi.formats.bed import Bed
 from jcvi.formats.base import must_open, BaseFile
-from jcvi.utils.grouper import Grouper
+from jcvi.utils.grouper import DisjointSet
 from jcvi.utils.cbook import gene_name
 from jcvi.compara.synteny import AnchorFile, check_beds
 from jcvi.apps.base import OptionParser, glob, ActionDispatcher, \
@@ -130,7 +130,7 @@ def enrich(args):
     # Get gene => taxon mapping
     info = dict((k, v.split()[5]) for k, v in info.items())
 
-    groups = Grouper()
+    groups = DisjointSet()
 
     fp = open(groupsfile)
     for row in fp:
@@ -141,7 +141,7 @@ def enrich(args):
                     format(len(groups), groups.num_members))
 
     seen = set()
-    omggroups = Grouper()
+    omggroups = DisjointSet()
     fp = open(omgfile)
     for row in fp:
         genes, idxs = row.split()
@@ -387,11 +387,10 @@ def group(args):
         sys.exit(not p.print_help())
 
     anchorfiles = args
-    groups = Grouper()
+    groups = DisjointSet()
     for anchorfile in anchorfiles:
         ac = AnchorFile(anchorfile)
-        for a, b, idx in ac.iter_pairs():
-            groups.join(a, b)
+        groups.join_pairs([(a, b) for a, b, idx in ac.iter_pairs()])
 
     logging.debug("Created {0} groups with {1} members.".\
                   format(len(groups), groups.num_members))
@@ -723,7 +722,7 @@ def tandem_main(blast_file, cds_file, bed_file, N=3, P=50, is_self=True, \
 
     if is_self:
         # filter the blast file
-        g = Grouper()
+        g = DisjointSet()
         fp = open(blast_file)
         for row in fp:
             b = BlastLine(row)
@@ -744,7 +743,7 @@ def tandem_main(blast_file, cds_file, bed_file, N=3, P=50, is_self=True, \
                     g.join(query, subject)
 
     else:
-        homologs = Grouper()
+        homologs = DisjointSet()
         fp = open(blast_file)
         for row in fp:
             b = BlastLine(row)
@@ -762,7 +761,7 @@ def tandem_main(blast_file, cds_file, bed_file, N=3, P=50, is_self=True, \
         if genefam:
             g = homologs
         else:
-            g = Grouper()
+            g = DisjointSet()
             for i, atom in enumerate(bed):
                 for x in range(1, N+1):
                     if all([i-x >= 0, bed[i-x].seqid == atom.seqid, \
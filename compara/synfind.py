@@ -186,7 +186,8 @@ def main(blastfile, p, opts):
     sqlite = opts.sqlite
     qbed, sbed, qorder, sorder, is_self = check_beds(blastfile, p, opts)
     filtered_blast = read_blast(blastfile, qorder, sorder, \
-                                is_self=is_self, ostrip=opts.strip_names)
+                                is_self=is_self, ostrip=opts.strip_names,
+                                cpus=opts.cpus)
     all_data = [(b.qi, b.si) for b in filtered_blast]
 
     c = None
@@ -221,6 +222,7 @@ if __name__ == '__main__':
     p.set_beds()
     p.set_stripnames()
     p.set_outfile()
+    p.set_cpus(cpus=1)
 
     coge_group = OptionGroup(p, "CoGe-specific options")
     coge_group.add_option("--sqlite", help="Write sqlite database")
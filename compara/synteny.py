@@ -7,12 +7,14 @@ import logging
 
 import numpy as np
 from collections import Iterable, defaultdict
+from itertools import groupby
+from multiprocessing import Pool
 
 from jcvi.algorithms.lis import heaviest_increasing_subsequence as his
 from jcvi.formats.bed import Bed, BedLine
-from jcvi.formats.blast import Blast
+from jcvi.formats.blast import BlastArray
 from jcvi.formats.base import BaseFile, SetFile, read_block, must_open
-from jcvi.utils.grouper import Grouper
+from jcvi.utils.grouper import DisjointSet
 from jcvi.utils.cbook import gene_name, human_size
 from jcvi.utils.range import Range, range_chain
 from jcvi.apps.base import OptionParser, ActionDispatcher
@@ -277,20 +279,21 @@ def group_hits(blasts):
     return all_hits
 
 
-def read_blast(blast_file, qorder, sorder, is_self=False, ostrip=True):
+def read_blast(blast_file, qorder, sorder, is_self=False, ostrip=True, cpus=1):
     """ Read the blast and convert name into coordinates
     """
     filtered_blast = []
     seen = set()
-    bl = Blast(blast_file)
-    for b in bl:
-        query, subject = b.query, b.subject
-        if query == subject:
-            continue
-        if ostrip:
-            query, subject = gene_name(query), gene_name(subject)
-        if query not in qorder or subject not in sorder:
-            continue
+    bl = BlastArray(blast_file, cpus=cpus)
+    # Resolve names once per unique id, rather than once per line
+    names = [gene_name(x) for x in bl.names] if ostrip else list(bl.names)
+    inq = np.array([x in qorder for x in names], dtype=bool)
+    ins = np.array([x in sorder for x in names], dtype=bool)
+    qids, sids = bl.data["query"], bl.data["subject"]
+    valid = np.flatnonzero((qids != sids) & inq[qids] & ins[sids])
+    for i in valid:
+        b = bl.line(i)
+        query, subject = names[qids[i]], names[sids[i]]
 
         qi, q = qorder[query]
         si, s = sorder[subject]
@@ -352,40 +355,78 @@ def synteny_scan(points, xdist, ydist, N):
     This is the core single linkage algorithm which behaves in O(n):
     iterate through the pairs, foreach pair we look back on the
     adjacent pairs to find links
+
+    The look-back is done for all points at once, one offset at a time, and
+    the links are then resolved into clusters with DisjointSet.join_pairs().
     """
-    clusters = Grouper()
-    n = len(points)
     points.sort()
-    for i in xrange(n):
-        for j in xrange(i - 1, -1, -1):
-            # x-axis distance
-            del_x = points[i][0] - points[j][0]
-            if del_x > xdist:
-                break
-            # y-axis distance
-            del_y = points[i][1] - points[j][1]
-            if abs(del_y) > ydist:
-                continue
-            # otherwise join
-            clusters.join(points[i], points[j])
-
-    # select clusters that are at least >=N
-    clusters = [sorted(cluster) for cluster in list(clusters) \
-            if _score(cluster) >= N]
+    # identical points are the same node
+    points = [x for i, x in enumerate(points) if i == 0 or x != points[i - 1]]
+    n = len(points)
+    if not n:
+        return []
+
+    xy = np.array([x[:2] for x in points], dtype=np.int64)
+    x, y = xy[:, 0], xy[:, 1]
+    width = np.arange(n) - np.searchsorted(x, x - xdist, side="left")
+    pa, pb = [], []
+    active = np.flatnonzero(width > 0)
+    k = 1
+    while len(active):
+        j = active - k
+        near = np.abs(y[active] - y[j]) <= ydist
+        pa.append(active[near])
+        pb.append(j[near])
+        k += 1
+        active = active[width[active] >= k]
+
+    clusters = DisjointSet(xrange(n))
+    if pa:
+        clusters.join_pairs(np.column_stack((np.concatenate(pa),
+                                             np.concatenate(pb))))
+    labels = clusters.find_many(xrange(n))
+
+    # score of the cluster is the number of non-repetitive matches
+    xcounts = np.bincount(np.unique(labels * (x.max() + 1) + x) / (x.max() + 1),
+                          minlength=n)
+    ycounts = np.bincount(np.unique(labels * (y.max() + 1) + y) / (y.max() + 1),
+                          minlength=n)
+    scores = np.minimum(xcounts, ycounts)
+
+    # select clusters that are at least >=N, points never linked are skipped
+    sizes = np.bincount(labels, minlength=n)
+    keep = np.flatnonzero((scores[labels] >= N) & (sizes[labels] > 1))
+    keep = keep[np.argsort(labels[keep], kind="mergesort")]
+    clusters = []
+    for label, members in groupby(keep, key=lambda i: labels[i]):
+        clusters.append([points[i] for i in members])
 
     return clusters
 
 
-def batch_scan(points, xdist=20, ydist=20, N=5):
+def _scan_pair(args):
+    points, xdist, ydist, N = args
+    return synteny_scan(points, xdist, ydist, N)
+
+
+def batch_scan(points, xdist=20, ydist=20, N=5, cpus=1):
     """
     runs synteny_scan() per chromosome pair
     """
     chr_pair_points = group_hits(points)
 
+    jobs = [(chr_pair_points[x], xdist, ydist, N) \
+                for x in sorted(chr_pair_points.keys())]
+    if cpus > 1 and len(jobs) > 1:
+        p = Pool(processes=min(cpus, len(jobs)))
+        results = p.map(_scan_pair, jobs)
+        p.close()
+    else:
+        results = [_scan_pair(x) for x in jobs]
+
     clusters = []
-    for chr_pair in sorted(chr_pair_points.keys()):
-        points = chr_pair_points[chr_pair]
-        clusters.extend(synteny_scan(points, xdist, ydist, N))
+    for res in results:
+        clusters.extend(res)
 
     return clusters
 
@@ -1462,17 +1503,19 @@ def scan(args):
     p.add_option("--liftover",
             help="Scan BLAST file to find extra anchors [default: %default]")
     p.set_stripnames()
+    p.set_cpus(cpus=1)
 
     blast_file, anchor_file, dist, opts = add_options(p, args, dist=20)
     qbed, sbed, qorder, sorder, is_self = check_beds(blast_file, p, opts)
 
     filtered_blast = read_blast(blast_file, qorder, sorder, \
-                                is_self=is_self, ostrip=False)
+                                is_self=is_self, ostrip=False, cpus=opts.cpus)
 
     fw = open(anchor_file, "w")
     logging.debug("Chaining distance = {0}".format(dist))
 
-    clusters = batch_scan(filtered_blast, xdist=dist, ydist=dist, N=opts.n)
+    clusters = batch_scan(filtered_blast, xdist=dist, ydist=dist, N=opts.n,
+                          cpus=opts.cpus)
     for cluster in clusters:
         print >>fw, "###"
         for qi, si, score in cluster:
@@ -1506,12 +1549,14 @@ def liftover(args):
     """
     p = OptionParser(liftover.__doc__)
     p.set_stripnames()
+    p.set_cpus(cpus=1)
 
     blast_file, anchor_file, dist, opts = add_options(p, args)
     qbed, sbed, qorder, sorder, is_self = check_beds(blast_file, p, opts)
 
     filtered_blast = read_blast(blast_file, qorder, sorder,
-                            is_self=is_self, ostrip=opts.strip_names)
+                            is_self=is_self, ostrip=opts.strip_names,
+                            cpus=opts.cpus)
     blast_to_score = dict(((b.qi, b.si), int(b.score)) for b in filtered_blast)
     accepted = dict(((b.query, b.subject), str(int(b.score))) \
                      for b in filtered_blast)
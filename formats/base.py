@@ -479,6 +479,31 @@ def read_block(handle, signal):
         yield None, seq
 
 
+def split_ranges(filename, nchunks):
+    """
+    Split file into at most nchunks byte ranges [start, end) that begin and
+    end on line boundaries, so that each range can be parsed independently.
+    """
+    size = op.getsize(filename)
+    bounds = [0]
+    fp = open(filename)
+    for i in xrange(1, nchunks):
+        fp.seek(max(size * i / nchunks, bounds[-1]))
+        fp.readline()
+        bounds.append(min(fp.tell(), size))
+    fp.close()
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+
+def file_stamp(filename):
+    """
+    Size and mtime of a file, used to tell if a cache is stale.
+    """
+    st = os.stat(filename)
+    return (st.st_size, int(st.st_mtime))
+
+
 def is_number(s, cast=float):
     """
     Check if a string is a number. Use cast=int to check if s is an integer.
@@ -9,6 +9,7 @@ import math
 import logging
 import numpy as np
 
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 from itertools import groupby
 
@@ -21,7 +22,7 @@ from jcvi.utils.natsort import natsort_key, natsorted
 from jcvi.utils.range import Range, range_union, range_chain, \
             range_distance, range_intersect
 from jcvi.apps.base import OptionParser, ActionDispatcher, sh, \
-            need_update, popen
+            need_update
 
 
 class BedLine(object):
@@ -106,11 +107,21 @@ class BedLine(object):
         return row
 
 
+def _invalidates_index(method):
+    # wrap list mutators so that any change to the Bed drops the range index
+    def wrapper(self, *args, **kwargs):
+        self._index = None
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
 class Bed(LineFile):
 
     def __init__(self, filename=None, key=None, sorted=True, juncs=False,
                        include=None):
         super(Bed, self).__init__(filename)
+        self._index = None
 
         # the sorting key provides some flexibility in ordering the features
         # for example, user might not like the lexico-order of seqid
@@ -131,6 +142,19 @@ class Bed(LineFile):
         if sorted:
             self.sort(key=self.key)
 
+    append = _invalidates_index(list.append)
+    extend = _invalidates_index(list.extend)
+    insert = _invalidates_index(list.insert)
+    remove = _invalidates_index(list.remove)
+    pop = _invalidates_index(list.pop)
+    sort = _invalidates_index(list.sort)
+    reverse = _invalidates_index(list.reverse)
+    __setitem__ = _invalidates_index(list.__setitem__)
+    __delitem__ = _invalidates_index(list.__delitem__)
+    __setslice__ = _invalidates_index(list.__setslice__)
+    __delslice__ = _invalidates_index(list.__delslice__)
+    __iadd__ = _invalidates_index(list.__iadd__)
+
     def add(self, row):
         self.append(BedLine(row))
 
@@ -194,20 +218,66 @@ class Bed(LineFile):
                 r.append(((a.accn, a.strand), (b.accn, b.strand)))
         return r
 
+    @property
+    def seqid_index(self):
+        """
+        Per-seqid range index, built lazily on first query and dropped whenever
+        the list is modified. Each entry holds the features in list order, plus
+        the features sorted by start along with their start positions and the
+        running maximum of their ends, so that range queries are binary
+        searches. Editing coordinates of a BedLine in place does not reset the
+        index; set `bed._index = None` after doing so.
+        """
+        if self._index is None:
+            members = defaultdict(list)
+            for i, b in enumerate(self):
+                members[b.seqid].append((i, b))
+
+            self._index = index = {}
+            for seqid, feats in members.items():
+                byorder = [b for i, b in feats]
+                bystart = sorted(feats, key=lambda x: (x[1].start, x[0]))
+                starts = [b.start for i, b in bystart]
+                maxends = []
+                maxend = 0
+                for i, b in bystart:
+                    maxend = max(maxend, b.end)
+                    maxends.append(maxend)
+                index[seqid] = (byorder, bystart, starts, maxends)
+
+        return self._index
+
     def extract(self, seqid, start, end):
         # get all features within certain range
-        for b in self:
-            if b.seqid != seqid:
-                continue
-            if b.start < start or b.end > end:
-                continue
+        if seqid not in self.seqid_index:
+            return
+
+        byorder, bystart, starts, maxends = self.seqid_index[seqid]
+        lo = bisect_left(starts, start)
+        hi = bisect_right(starts, end)
+        hits = sorted(x for x in bystart[lo:hi] if x[1].end <= end)
+        for i, b in hits:
+            yield b
+
+    def overlap(self, seqid, start, end):
+        # get all features that overlap certain range
+        if seqid not in self.seqid_index:
+            return
+
+        byorder, bystart, starts, maxends = self.seqid_index[seqid]
+        lo = bisect_left(maxends, start)
+        hi = bisect_right(starts, end)
+        hits = sorted(x for x in bystart[lo:hi] if x[1].end >= start)
+        for i, b in hits:
             yield b
 
     def sub_bed(self, seqid):
         # get all the beds on one chromosome
-        for b in self:
-            if b.seqid == seqid:
-                yield b
+        if seqid not in self.seqid_index:
+            return
+
+        for b in self.seqid_index[seqid][0]:
+            yield b
 
     def sub_beds(self):
 
@@ -225,6 +295,337 @@ class Bed(LineFile):
             yield seqid, ranks[0][1], ranks[-1][1]
 
 
+def overlap_pairs(astart, aend, bstart, bend):
+    """
+    Find all overlapping pairs between intervals a and b, where b must be
+    sorted by start. Returns two index arrays into a and b, ordered by a then
+    by b. Coordinates are closed, so intervals sharing one base overlap.
+    """
+    if not len(astart) or not len(bstart):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+
+    # Any b that overlaps must start before a ends, and must come after the
+    # first b whose running maximum end reaches a start
+    maxends = np.maximum.accumulate(bend)
+    lo = np.searchsorted(maxends, astart, side="left")
+    hi = np.searchsorted(bstart, aend, side="right")
+    counts = np.maximum(hi - lo, 0)
+    ia = np.repeat(np.arange(len(astart)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    ib = np.repeat(lo, counts) + offsets
+    keep = bend[ib] >= astart[ia]
+    return ia[keep], ib[keep]
+
+
+def aggregate_scores(scores, firsts, method="mean"):
+    """
+    Summarize the scores within each block, where blocks are consecutive runs
+    starting at indices `firsts`. Same choices as `mergeBed -scores`.
+    """
+    if method == "collapse":
+        return [",".join(x) for x in np.split(scores, firsts[1:])]
+
+    scores = scores.astype(float)
+    if method == "sum":
+        agg = np.add.reduceat(scores, firsts)
+    elif method == "min":
+        agg = np.minimum.reduceat(scores, firsts)
+    elif method == "max":
+        agg = np.maximum.reduceat(scores, firsts)
+    elif method == "median":
+        agg = [np.median(x) for x in np.split(scores, firsts[1:])]
+    elif method in ("mode", "antimode"):
+        agg = []
+        for x in np.split(scores, firsts[1:]):
+            values, counts = np.unique(x, return_counts=True)
+            pick = np.argmax if method == "mode" else np.argmin
+            agg.append(values[pick(counts)])
+    else:
+        counts = np.diff(np.append(firsts, len(scores)))
+        agg = np.add.reduceat(scores, firsts) / counts
+
+    return ["{0:.10g}".format(x) for x in agg]
+
+
+class BedArray(object):
+    """
+    Columnar version of Bed, for files too large to hold as BedLine objects.
+
+    Seqids are stored as integer codes into `seqids`, which is natsorted so
+    that code order is the natural seqid order. Coordinates follow BedLine,
+    i.e. `start` is 1-based. The accn, score and strand columns are kept only
+    if the file has them; any further columns are dropped.
+    """
+    def __init__(self, filename=None, sorted=True, include=None,
+                       chunksize=1000000):
+
+        self.filename = filename
+        self.seqids = []
+        self.seqid = np.zeros(0, dtype=np.int32)
+        self.start = np.zeros(0, dtype=np.int64)
+        self.end = np.zeros(0, dtype=np.int64)
+        self.accn = self.score = self.strand = None
+
+        if not filename:
+            return
+
+        logging.debug("Load file `{0}` into BedArray".format(filename))
+        codes = {}
+        chunks = []
+        rows = []
+        for line in must_open(filename):
+            if line[0] == "#":
+                continue
+            rows.append(line.rstrip("\n").split("\t", 6)[:6])
+            if len(rows) == chunksize:
+                chunks.append(self._parse_chunk(rows, codes))
+                rows = []
+        if rows or not chunks:
+            chunks.append(self._parse_chunk(rows, codes))
+
+        # Re-code seqids so that code order follows natsort order
+        self.seqids = natsorted(codes.keys())
+        recode = np.zeros(len(codes), dtype=np.int32)
+        for i, seqid in enumerate(self.seqids):
+            recode[codes[seqid]] = i
+
+        columns = zip(*chunks)
+        self.seqid = recode[np.concatenate(columns[0])]
+        self.start = np.concatenate(columns[1])
+        self.end = np.concatenate(columns[2])
+        assert np.all(self.start <= self.end), \
+                "Found features with start > end in `{0}`".format(filename)
+        self.accn, self.score, self.strand = \
+                [np.concatenate(x) if all(c is not None for c in x) \
+                    else None for x in columns[3:]]
+
+        if include:
+            assert self.accn is not None, \
+                    "Name column required for `include` in `{0}`".format(filename)
+            self.take(np.in1d(self.accn, list(include)), inplace=True)
+
+        if sorted:
+            self.sort()
+
+    @staticmethod
+    def _parse_chunk(rows, codes):
+        if not rows:
+            return [np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64), None, None, None]
+
+        ncols = min(len(x) for x in rows)
+        cols = zip(*rows)
+        uniq, inverse = np.unique(np.array(cols[0]), return_inverse=True)
+        localcodes = np.array([codes.setdefault(x, len(codes)) for x in uniq],
+                              dtype=np.int32)
+        seqid = localcodes[inverse]
+        start = np.array(cols[1]).astype(np.int64) + 1
+        end = np.array(cols[2]).astype(np.int64)
+        extra = [np.array(cols[i]) if ncols > i else None for i in (3, 4, 5)]
+        return [seqid, start, end] + extra
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def spans(self):
+        return self.end - self.start + 1
+
+    @property
+    def columns(self):
+        return [x for x in ("accn", "score", "strand") \
+                    if getattr(self, x) is not None]
+
+    def take(self, idx, inplace=False):
+        """
+        Subset by index array, boolean mask or slice.
+        """
+        b = self if inplace else BedArray()
+        b.filename = self.filename
+        b.seqids = self.seqids
+        for attr in ("seqid", "start", "end", "accn", "score", "strand"):
+            x = getattr(self, attr)
+            setattr(b, attr, x[idx] if x is not None else None)
+        return b
+
+    def sort(self):
+        # Same order as Bed.nullkey: natural seqid, start, accn
+        keys = (self.start, self.seqid)
+        if self.accn is not None:
+            keys = (self.accn,) + keys
+        self.take(np.lexsort(keys), inplace=True)
+
+    def sub_beds(self):
+        """
+        Yield (seqid, BedArray) for each seqid, assuming sorted by seqid.
+        """
+        bounds = np.flatnonzero(np.diff(self.seqid)) + 1
+        bounds = [0] + bounds.tolist() + [len(self)]
+        for i, j in pairwise(bounds):
+            if i == j:
+                continue
+            yield self.seqids[self.seqid[i]], self.take(slice(i, j))
+
+    def counts(self):
+        """
+        Number of features per seqid.
+        """
+        c = np.bincount(self.seqid, minlength=len(self.seqids))
+        return dict(zip(self.seqids, c.tolist()))
+
+    def sum(self, unique=True):
+        if not unique:
+            return int(self.spans.sum())
+
+        total = 0
+        for seqid, sb in self.sub_beds():
+            order = np.argsort(sb.start, kind="mergesort")
+            starts, ends = sb.start[order], sb.end[order]
+            # A new block starts wherever start goes past all previous ends
+            maxends = np.maximum.accumulate(ends)
+            newblock = np.ones(len(starts), dtype=bool)
+            newblock[1:] = starts[1:] > maxends[:-1]
+            blockstarts = starts[newblock]
+            blockends = maxends[np.append(np.flatnonzero(newblock)[1:] - 1,
+                                          len(starts) - 1)]
+            total += int((blockends - blockstarts + 1).sum())
+        return total
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        args = [self.seqids[self.seqid[i]], self.start[i] - 1, self.end[i]]
+        args += [getattr(self, x)[i] for x in self.columns]
+        return BedLine("\t".join(str(x) for x in args))
+
+    def print_to_file(self, filename="stdout"):
+        fw = must_open(filename, "w")
+        for b in self:
+            print >> fw, b
+        fw.close()
+
+    def sorted_by_start(self):
+        return self.take(np.lexsort((self.start, self.seqid)))
+
+    def merge(self, d=0, nms=False, scores=None, delim=";"):
+        """
+        Union of features that overlap or are within distance `d`, same as
+        `mergeBed`, book-ended features included. Names are collapsed with
+        `delim` when `nms` is set, and scores are summarized with one of
+        `aggregate_scores` methods. Output is in natsorted seqid order.
+        """
+        a = self.sorted_by_start()
+        merged = BedArray()
+        merged.filename = self.filename
+        merged.seqids = self.seqids
+        if not len(a):
+            return merged
+
+        # Shift each seqid to its own coordinate range so that one running
+        # maximum can sweep all seqids at once
+        shift = a.seqid.astype(np.int64) * (int(a.end.max()) + d + 2)
+        starts, maxends = a.start + shift, np.maximum.accumulate(a.end + shift)
+        newblock = np.ones(len(a), dtype=bool)
+        newblock[1:] = starts[1:] > maxends[:-1] + d + 1
+        firsts = np.flatnonzero(newblock)
+        lasts = np.append(firsts[1:] - 1, len(a) - 1)
+
+        merged.seqid = a.seqid[firsts]
+        merged.start = a.start[firsts]
+        merged.end = maxends[lasts] - shift[lasts]
+        if nms:
+            if a.accn is None:
+                logging.debug("Only 3 columns detected... set nms=True")
+            else:
+                merged.accn = np.array([delim.join(x) for x in \
+                                        np.split(a.accn, firsts[1:])])
+        if scores:
+            assert a.score is not None, "Score column required for merging"
+            merged.score = np.array(aggregate_scores(a.score, firsts,
+                                                     method=scores))
+        return merged
+
+    def complement(self, sizes):
+        """
+        Regions not covered by any feature, same as `complementBed`. `sizes`
+        is a dict of seqid to size, seqids without features are reported
+        whole. Output is in natsorted seqid order, not the order of `sizes`.
+        """
+        merged = self.merge()
+        bounds = dict((seqid, (sb.start, sb.end)) \
+                        for seqid, sb in merged.sub_beds())
+
+        comp = BedArray()
+        comp.filename = self.filename
+        comp.seqids = natsorted(sizes.keys())
+        seqid, start, end = [], [], []
+        for i, s in enumerate(comp.seqids):
+            starts, ends = bounds.get(s, ([], []))
+            gapstarts = np.append(1, np.asarray(ends) + 1)
+            gapends = np.append(np.asarray(starts) - 1, sizes[s])
+            keep = gapstarts <= gapends
+            start.append(gapstarts[keep])
+            end.append(gapends[keep])
+            seqid.append(np.repeat(i, keep.sum()))
+
+        comp.seqid = np.concatenate(seqid).astype(np.int32)
+        comp.start = np.concatenate(start).astype(np.int64)
+        comp.end = np.concatenate(end).astype(np.int64)
+        return comp
+
+    def intersect(self, other):
+        """
+        Portions of features that overlap features in `other`, same as
+        `intersectBed -a self -b other`. Each overlapping pair yields a copy of
+        the feature in self clipped to the overlap. Output is sorted by seqid
+        (natsorted) and start, rather than kept in the order of self. Only the
+        first six columns are kept, so extra columns of self are dropped.
+        """
+        a, b = self.sorted_by_start(), other.sorted_by_start()
+        bsub = dict(b.sub_beds())
+        hits, starts, ends = [], [], []
+        offset = 0
+        for seqid, sa in a.sub_beds():
+            if seqid in bsub:
+                sb = bsub[seqid]
+                ia, ib = overlap_pairs(sa.start, sa.end, sb.start, sb.end)
+                hits.append(ia + offset)
+                starts.append(np.maximum(sa.start[ia], sb.start[ib]))
+                ends.append(np.minimum(sa.end[ia], sb.end[ib]))
+            offset += len(sa)
+
+        if not hits:
+            return a.take(np.zeros(0, dtype=np.int64))
+
+        res = a.take(np.concatenate(hits))
+        res.start = np.concatenate(starts)
+        res.end = np.concatenate(ends)
+        return res
+
+    def to_bed(self):
+        bed = Bed()
+        bed.extend(self)
+        return bed
+
+    @classmethod
+    def from_bed(cls, bed):
+        b = cls()
+        b.filename = bed.filename
+        b.seqids = natsorted(set(x.seqid for x in bed))
+        codes = dict((x, i) for i, x in enumerate(b.seqids))
+        b.seqid = np.array([codes[x.seqid] for x in bed], dtype=np.int32)
+        b.start = np.array([x.start for x in bed], dtype=np.int64)
+        b.end = np.array([x.end for x in bed], dtype=np.int64)
+        for attr in ("accn", "score", "strand"):
+            if bed and all(x[attr] is not None for x in bed):
+                setattr(b, attr, np.array([x[attr] for x in bed]))
+        return b
+
+
 class BedpeLine(object):
 
     def __init__(self, sline):
@@ -349,14 +750,23 @@ class BedEvaluate (object):
 class BedSummary(object):
 
     def __init__(self, bed):
-        mspans = [(x.span, x.accn) for x in bed]
-        spans, accns = zip(*mspans)
+        if isinstance(bed, BedArray):
+            spans = bed.spans.tolist()
+            accns = bed.accn.tolist() if bed.accn is not None \
+                        else [None] * len(bed)
+            mspans = zip(spans, accns)
+            self.nseqids = len(np.unique(bed.seqid))
+            self.total_bases = bed.sum(unique=False)
+            self.unique_bases = bed.sum()
+        else:
+            mspans = [(x.span, x.accn) for x in bed]
+            spans, accns = zip(*mspans)
+            self.nseqids = len(set(x.seqid for x in bed))
+            self.total_bases = bed_sum(bed, unique=False)
+            self.unique_bases = bed_sum(bed)
         self.mspans = mspans
         self.stats = SummaryStats(spans)
-        self.nseqids = len(set(x.seqid for x in bed))
         self.nfeats = len(bed)
-        self.total_bases = bed_sum(bed, unique=False)
-        self.unique_bases = bed_sum(bed)
         self.coverage = self.total_bases * 1. / self.unique_bases
 
     def report(self):
@@ -589,12 +999,15 @@ def density(args):
         sys.exit(not p.print_help())
 
     bedfile, fastafile = args
-    bed = Bed(bedfile)
+    bed = BedArray(bedfile)
     sizes = Sizes(fastafile).mapping
     header = "seqid features size density_per_Mb".split()
     print "\t".join(header)
-    for seqid, bb in bed.sub_beds():
-        nfeats = len(bb)
+    counts = bed.counts()
+    for seqid in bed.seqids:
+        nfeats = counts[seqid]
+        if not nfeats:
+            continue
         size = sizes[seqid]
         ds = nfeats * 1e6 / size
         print "\t".join(str(x) for x in \
@@ -1306,24 +1719,19 @@ def bins(args):
         return binfile
 
     sz = Sizes(fastafile)
-    sizesfile = sz.filename
     sizes = sz.mapping
     fw = open(binfile, "w")
     scores = "median" if mode == "score" else None
+    bed = BedArray(bedfile)
     if not opts.nomerge:
-        bedfile = mergeBed(bedfile, nms=True, scores=scores)
+        bed = bed.merge(nms=True, scores=scores)
     if subtract:
-        subtractmerge = mergeBed(subtract)
-        subtract_complement = complementBed(subtractmerge, sizesfile)
-        bedfile = intersectBed(bedfile, subtract_complement)
+        subtract_complement = BedArray(subtract).complement(sizes)
+        bed = bed.intersect(subtract_complement)
 
-    bedfile = sort([bedfile, "-i"])
-
-    bed = Bed(bedfile)
     sbdict = dict(bed.sub_beds())
     for chr, chr_len in sorted(sizes.items()):
         chr_len = sizes[chr]
-        subbeds = sbdict.get(chr, [])
         nbins = chr_len / binsize
         last_bin = chr_len % binsize
         if last_bin:
@@ -1335,29 +1743,47 @@ def bins(args):
         b[:-1] = binsize
         b[-1] = last_bin
 
-        for bb in subbeds:
-
-            start, end = bb.start, bb.end
+        if chr in sbdict:
+            sb = sbdict[chr]
+            start, end = sb.start, sb.end
             startbin = start / binsize
             endbin = end / binsize
-
-            assert startbin <= endbin
-            c[startbin:endbin + 1] += 1
+            assert np.all(startbin <= endbin)
+
+            # Features cover bins [startbin, endbin], accumulate with
+            # difference arrays instead of slice updates per feature. A
+            # feature ending at chr_len may reach bin nbins, clip it there
+            # like the slice update did.
+            lo = np.minimum(startbin, nbins)
+            hi = np.minimum(endbin + 1, nbins)
+            diff = np.zeros(nbins + 1, dtype="int")
+            np.add.at(diff, lo, 1)
+            np.add.at(diff, hi, -1)
+            c += np.cumsum(diff)[:-1]
 
             if mode == "score":
-                a[startbin:endbin + 1] += float(bb.score)
+                scores = sb.score.astype(float)
+                fdiff = np.zeros(nbins + 1)
+                np.add.at(fdiff, lo, scores)
+                np.add.at(fdiff, hi, -scores)
+                a += np.cumsum(fdiff)[:-1]
 
             elif mode == "span":
-                if startbin == endbin:
-                    a[startbin] += end - start + 1
-
-                if startbin < endbin:
-                    firstsize = (startbin + 1) * binsize - start + 1
-                    lastsize = end - endbin * binsize
-                    a[startbin] += firstsize
-                    if startbin + 1 < endbin:
-                        a[startbin + 1:endbin] += binsize
-                    a[endbin] += lastsize
+                same = (startbin == endbin) & (startbin < nbins)
+                np.add.at(a, startbin[same], (end - start + 1)[same])
+
+                cross = startbin < endbin
+                sbin, ebin = startbin[cross], endbin[cross]
+                firstsize = (sbin + 1) * binsize - start[cross] + 1
+                lastsize = end[cross] - ebin * binsize
+                np.add.at(a, sbin, firstsize)
+                inbins = ebin < nbins
+                np.add.at(a, ebin[inbins], lastsize[inbins])
+                # Bins strictly in between are fully covered
+                inner = np.zeros(nbins + 1, dtype="int")
+                np.add.at(inner, sbin + 1, 1)
+                np.add.at(inner, ebin, -1)
+                a += np.cumsum(inner)[:-1] * binsize
 
         if mode == "count":
             a = c
@@ -1380,7 +1806,7 @@ def pile(args):
 
     Call intersectBed on two bedfiles.
     """
-    from jcvi.utils.grouper import Grouper
+    from jcvi.utils.grouper import DisjointSet
 
     p = OptionParser(pile.__doc__)
     p.add_option("--minOverlap", default=0, type="int",
@@ -1392,9 +1818,8 @@ def pile(args):
 
     abedfile, bbedfile = args
     iw = intersectBed_wao(abedfile, bbedfile, minOverlap=opts.minOverlap)
-    groups = Grouper()
-    for a, b in iw:
-        groups.join(a.accn, b.accn)
+    groups = DisjointSet()
+    groups.join_pairs([(a.accn, b.accn) for a, b in iw if b is not None])
 
     ngroups = 0
     for group in groups:
@@ -1448,24 +1873,56 @@ def index(args):
 
 
 def fastaFromBed(bedfile, fastafile, name=False, tab=False, stranded=False):
+    from jcvi.formats.fasta import FaidxFasta
+
     suffix = ".sfa" if tab else ".fasta"
     outfile = op.basename(bedfile).rsplit(".", 1)[0] + suffix
-    cmd = "fastaFromBed -fi {0} -bed {1} -fo {2}".\
-            format(fastafile, bedfile, outfile)
-    if name:
-        cmd += " -name"
-    if tab:
-        cmd += " -tab"
-    if stranded:
-        cmd += " -s"
-
-    if need_update([bedfile, fastafile], outfile):
-        sh(cmd, outfile=outfile)
+    if not need_update([bedfile, fastafile], outfile):
+        return outfile
+
+    f = FaidxFasta(fastafile)
+    fw = open(outfile, "w")
+    for b in Bed(bedfile, sorted=False):
+        strand = b.strand if stranded else None
+        seq = f.sequence({'chr': b.seqid, 'start': b.start, 'stop': b.end,
+                          'strand': strand})
+        header = b.accn if name else \
+                 "{0}:{1}-{2}".format(b.seqid, b.start - 1, b.end)
+        if strand:
+            # Same as `fastaFromBed -s`, e.g. chr1:0-100(-)
+            header += "({0})".format(strand)
+        if tab:
+            print >> fw, "\t".join((header, seq))
+        else:
+            print >> fw, ">{0}\n{1}".format(header, seq)
+    fw.close()
 
     return outfile
 
 
 def mergeBed(bedfile, d=0, sorted=False, nms=False, s=False, scores=None, delim=";"):
+    """
+    Without `s`, merging is done in process by BedArray.merge(), so the output
+    is natsorted by seqid, which may differ from `sort -k1,1` order.
+    """
+    pf = bedfile.rsplit(".", 1)[0] if bedfile.endswith(".bed") else bedfile
+    mergebedfile = op.basename(pf) + ".merge.bed"
+    if not need_update(bedfile, mergebedfile):
+        return mergebedfile
+
+    if scores:
+        valid_opts = ("sum", "min", "max", "mean", "median",
+                "mode", "antimode", "collapse")
+        if not scores in valid_opts:
+            scores = "mean"
+
+    if not s:
+        bed = BedArray(bedfile, sorted=False)
+        bed.merge(d=d, nms=nms, scores=scores, delim=delim).\
+                print_to_file(mergebedfile)
+        return mergebedfile
+
+    # Strand-aware merging is still delegated to bedtools
     if not sorted:
         bedfile = sort([bedfile, "-i"])
     cmd = "mergeBed -i {0}".format(bedfile)
@@ -1478,46 +1935,44 @@ def mergeBed(bedfile, d=0, sorted=False, nms=False, s=False, scores=None, delim=
                             .format(nargs))
         else:
             cmd += " -c 4 -o collapse"
-    if s:
-        cmd += " -s"
+    cmd += " -s"
     if scores:
-        valid_opts = ("sum", "min", "max", "mean", "median",
-                "mode", "antimode", "collapse")
-        if not scores in valid_opts:
-            scores = "mean"
         cmd += " -scores {0}".format(scores)
 
     if delim:
         cmd += ' -delim "{0}"'.format(delim)
 
-    pf = bedfile.rsplit(".", 1)[0] if bedfile.endswith(".bed") else bedfile
-    mergebedfile = op.basename(pf) + ".merge.bed"
-
-    if need_update(bedfile, mergebedfile):
-        sh(cmd, outfile=mergebedfile)
+    sh(cmd, outfile=mergebedfile)
     return mergebedfile
 
 
 def complementBed(bedfile, sizesfile):
-    cmd = "complementBed"
-    cmd += " -i {0} -g {1}".format(bedfile, sizesfile)
+    """
+    Seqids are written in natsorted order rather than the order in sizesfile.
+    """
     complementbedfile = "complement_" + op.basename(bedfile)
 
     if need_update([bedfile, sizesfile], complementbedfile):
-        sh(cmd, outfile=complementbedfile)
+        sizes = Sizes(sizesfile).mapping
+        BedArray(bedfile, sorted=False).complement(sizes).\
+                print_to_file(complementbedfile)
     return complementbedfile
 
 
 def intersectBed(bedfile1, bedfile2):
-    cmd = "intersectBed"
-    cmd += " -a {0} -b {1}".format(bedfile1, bedfile2)
+    """
+    Output is sorted by seqid and start, not kept in the order of bedfile1.
+    Columns of bedfile1 past the sixth (strand) are dropped, unlike bedtools.
+    """
     suffix = ".intersect.bed"
 
     intersectbedfile = ".".join((op.basename(bedfile1).split(".")[0],
             op.basename(bedfile2).split(".")[0])) + suffix
 
     if need_update([bedfile1, bedfile2], intersectbedfile):
-        sh(cmd, outfile=intersectbedfile)
+        abed = BedArray(bedfile1, sorted=False)
+        bbed = BedArray(bedfile2, sorted=False)
+        abed.intersect(bbed).print_to_file(intersectbedfile)
     return intersectbedfile
 
 
@@ -1596,29 +2051,27 @@ def evaluate(args):
 
 
 def intersectBed_wao(abedfile, bbedfile, minOverlap=0):
-    abed = Bed(abedfile)
-    bbed = Bed(bbedfile)
+    """
+    Pair each feature in abedfile with every overlapping feature in bbedfile,
+    same as `intersectBed -wao`. Features without overlap are paired with None.
+    """
+    abed = Bed(abedfile, sorted=False)
+    bbed = Bed(bbedfile, sorted=False)
     print >> sys.stderr, "`{0}` has {1} features.".format(abedfile, len(abed))
     print >> sys.stderr, "`{0}` has {1} features.".format(bbedfile, len(bbed))
 
-    cmd = "intersectBed -wao -a {0} -b {1}".format(abedfile, bbedfile)
-    acols = abed[0].nargs
-    bcols = bbed[0].nargs
-    fp = popen(cmd)
-    for row in fp:
-        atoms = row.split()
-        aline = "\t".join(atoms[:acols])
-        bline = "\t".join(atoms[acols:acols + bcols])
-        c = int(atoms[-1])
-        if c < minOverlap:
+    for a in abed:
+        hits = list(bbed.overlap(a.seqid, a.start, a.end))
+        if not hits:
+            if minOverlap <= 0:
+                yield a, None
             continue
-        a = BedLine(aline)
-        try:
-            b = BedLine(bline)
-        except AssertionError:
-            b = None
 
-        yield a, b
+        for b in hits:
+            c = min(a.end, b.end) - max(a.start, b.start) + 1
+            if c < minOverlap:
+                continue
+            yield a, b
 
 
 def refine(args):
@@ -2032,7 +2485,7 @@ def summary(args):
         sys.exit(not p.print_help())
 
     bedfile, = args
-    bed = Bed(bedfile)
+    bed = BedArray(bedfile)
     bs = BedSummary(bed)
     if opts.sizes:
         sizesfile = bedfile + ".sizes"
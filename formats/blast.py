@@ -2,14 +2,20 @@
 parses tabular BLAST -m8 (-format 6 in BLAST+) format
 """
 
+import os
 import os.path as op
 import sys
+import struct
+import zipfile
 import logging
+import numpy as np
 
 from itertools import groupby
 from collections import defaultdict
+from multiprocessing import Pool
 
-from jcvi.formats.base import LineFile, BaseFile, must_open
+from jcvi.formats.base import LineFile, BaseFile, must_open, split_ranges, \
+            file_stamp
 from jcvi.formats.bed import Bed
 from jcvi.formats.coords import print_stats
 from jcvi.formats.sizes import Sizes
@@ -184,6 +190,199 @@ class Blast (BaseFile):
         return dict(self.iter_best_hit())
 
 
+def _parse_blast_range(args):
+    """
+    Parse lines of a BLAST file between byte offsets [start, end) into
+    columns, with query/subject coded against the names seen in this range.
+    """
+    filename, start, end = args
+    names = {}
+    ids = ([], [])
+    cols = [[] for x in BlastArray.dtype[2:]]
+    fp = open(filename)
+    fp.seek(start)
+    pos = start
+    while pos < end:
+        row = fp.readline()
+        if not row:
+            break
+        pos += len(row)
+        if row[0] == '#':
+            continue
+        atoms = row.rstrip().split("\t")
+        ids[0].append(names.setdefault(atoms[0], len(names)))
+        ids[1].append(names.setdefault(atoms[1], len(names)))
+        for c, x in zip(cols, atoms[2:12]):
+            c.append(x)
+    fp.close()
+
+    names = sorted(names, key=names.get)
+    ids = [np.array(x, dtype=np.int32) for x in ids]
+    cols = [np.array(c, dtype=dt) if c else np.zeros(0, dtype=dt) \
+                for c, (name, dt) in zip(cols, BlastArray.dtype[2:])]
+    return names, ids, cols
+
+
+def _memmap_npz(npzfile, key):
+    """
+    Memory map one array stored (uncompressed) in an .npz archive, by locating
+    the .npy payload inside the zip file.
+    """
+    zf = zipfile.ZipFile(npzfile)
+    info = zf.getinfo(key + ".npy")
+    zf.close()
+    assert info.compress_type == zipfile.ZIP_STORED, \
+            "`{0}` in `{1}` is compressed".format(key, npzfile)
+
+    fp = open(npzfile, "rb")
+    fp.seek(info.header_offset)
+    header = fp.read(30)  # fixed part of zip local file header
+    namelen, extralen = struct.unpack("<HH", header[26:30])
+    fp.seek(info.header_offset + 30 + namelen + extralen)
+    version = np.lib.format.read_magic(fp)
+    if version == (1, 0):
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(fp)
+    else:
+        shape, fortran, dtype = np.lib.format.read_array_header_2_0(fp)
+    offset = fp.tell()
+    fp.close()
+
+    if not shape or not shape[0]:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(npzfile, dtype=dtype, mode="r", shape=shape,
+                     order="F" if fortran else "C", offset=offset)
+
+
+class BlastArray (BaseFile):
+    """
+    Columnar BLAST table, with query and subject coded as int ids into `names`
+    and the other 10 columns as typed fields of the record array `data`.
+
+    The file is parsed in parallel by splitting it at line boundaries, and the
+    result is cached to `blastfile.npz`, keyed on the size and mtime of the
+    BLAST file. Later loads memory map the cache instead of parsing. If the
+    cache cannot be written, e.g. in a read-only folder, it is skipped.
+    """
+    dtype = [("query", "i4"), ("subject", "i4"), ("pctid", "f8"),
+             ("hitlen", "i4"), ("nmismatch", "i4"), ("ngaps", "i4"),
+             ("qstart", "i4"), ("qstop", "i4"), ("sstart", "i4"),
+             ("sstop", "i4"), ("evalue", "f8"), ("score", "f8")]
+
+    def __init__(self, filename, cpus=1, cache=True):
+        super(BlastArray, self).__init__(filename)
+        self.cachefile = filename + ".npz"
+        self.stamp = np.array(file_stamp(filename), dtype=np.int64)
+
+        if cache and self.load_cache():
+            return
+
+        self.parse(cpus=cpus)
+        if cache:
+            self.save_cache()
+
+    def parse(self, cpus=1):
+        filename = self.filename
+        if filename.endswith(".gz"):
+            # Compressed file cannot be split at byte offsets
+            from tempfile import mkstemp
+
+            fp = must_open(filename)
+            fd, tmpfile = mkstemp(suffix=".blast")
+            fw = os.fdopen(fd, "w")
+            for row in fp:
+                fw.write(row)
+            fw.close()
+            filename = tmpfile
+
+        ranges = split_ranges(filename, cpus)
+        jobs = [(filename, a, b) for a, b in ranges]
+        if cpus > 1 and len(jobs) > 1:
+            p = Pool(processes=min(cpus, len(jobs)))
+            results = p.map(_parse_blast_range, jobs)
+            p.close()
+        else:
+            results = [_parse_blast_range(x) for x in jobs]
+
+        # Translate the local ids of each chunk into one set of ids
+        nameids = {}
+        data = np.zeros(sum(len(r[1][0]) for r in results),
+                        dtype=BlastArray.dtype)
+        i = 0
+        for names, (qids, sids), cols in results:
+            recode = np.array([nameids.setdefault(x, len(nameids)) \
+                                for x in names], dtype=np.int32)
+            j = i + len(qids)
+            if j > i:
+                data["query"][i:j] = recode[qids]
+                data["subject"][i:j] = recode[sids]
+                for (name, dt), c in zip(BlastArray.dtype[2:], cols):
+                    data[name][i:j] = c
+            i = j
+
+        if filename != self.filename:
+            os.remove(filename)
+
+        self.names = np.array(sorted(nameids, key=nameids.get))
+        self.data = data
+        logging.debug("Parsed {0} BLAST hits from `{1}`".\
+                        format(len(data), self.filename))
+
+    def save_cache(self):
+        try:
+            np.savez(self.cachefile, stamp=self.stamp, names=self.names,
+                     data=self.data)
+        except (IOError, OSError) as e:
+            logging.error("Cannot write cache `{0}`: {1}".\
+                            format(self.cachefile, e))
+            if op.exists(self.cachefile):
+                os.remove(self.cachefile)
+            return
+        logging.debug("BLAST cache written to `{0}`".format(self.cachefile))
+
+    def load_cache(self):
+        if not op.exists(self.cachefile):
+            return False
+
+        try:
+            npz = np.load(self.cachefile)
+            stamp, names = npz["stamp"], npz["names"]
+            npz.close()
+            if not np.array_equal(stamp, self.stamp):
+                logging.debug("Cache `{0}` is stale".format(self.cachefile))
+                return False
+            self.names = names
+            self.data = _memmap_npz(self.cachefile, "data")
+        except (IOError, KeyError, ValueError, zipfile.BadZipfile) as e:
+            logging.error("Cannot load cache `{0}`: {1}".\
+                            format(self.cachefile, e))
+            return False
+
+        logging.debug("Load {0} BLAST hits from cache `{1}`".\
+                        format(len(self.data), self.cachefile))
+        return True
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def query(self):
+        return self.names[self.data["query"]]
+
+    @property
+    def subject(self):
+        return self.names[self.data["subject"]]
+
+    def line(self, i):
+        r = self.data[i]
+        args = [self.names[r[0]], self.names[r[1]]] + \
+               [repr(x) if isinstance(x, float) else str(x) for x in r.tolist()[2:]]
+        return BlastLine("\t".join(args))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.line(i)
+
+
 class BlastLineByConversion (BlastLine):
     """
     make BlastLine object from tab delimited line objects with
@@ -6,10 +6,15 @@ import re
 import sys
 import os
 import os.path as op
+import mmap
 import shutil
+import struct
+import zlib
 import logging
 import string
 
+from bisect import bisect_right
+
 from itertools import groupby, izip_longest
 
 from Bio import SeqIO
@@ -22,6 +27,7 @@ from hashlib import md5
 from jcvi.formats.base import BaseFile, DictFile, must_open
 from jcvi.formats.bed import Bed
 from jcvi.utils.cbook import percentage
+from jcvi.utils.orderedcollections import OrderedDict
 from jcvi.utils.table import write_csv
 from jcvi.apps.console import red, green
 from jcvi.apps.base import OptionParser, ActionDispatcher, need_update
@@ -166,6 +172,214 @@ class Fasta (BaseFile, dict):
         return seq
 
 
+def bgzf_blocks(filename):
+    """
+    Scan the headers of a BGZF (bgzip) file, and return the list of
+    (compressed offset, uncompressed offset) at the start of each block.
+    """
+    blocks = []
+    coffset = uoffset = 0
+    fp = open(filename, "rb")
+    while True:
+        header = fp.read(18)
+        if not header:
+            break
+        assert len(header) == 18 and header[:4] == "\x1f\x8b\x08\x04" \
+                and header[12:14] == "BC", \
+                "`{0}` is not BGZF compressed, use bgzip".format(filename)
+        bsize, = struct.unpack("<H", header[16:18])
+        fp.seek(coffset + bsize + 1 - 4)
+        isize, = struct.unpack("<I", fp.read(4))
+        blocks.append((coffset, uoffset))
+        coffset += bsize + 1
+        uoffset += isize
+    fp.close()
+    return blocks
+
+
+class FaidxFasta (BaseFile):
+    """
+    Random access to sequences in a FASTA file, using a samtools-compatible
+    .fai index (name, length, offset, linebases, linewidth) built on first
+    use. Byte offsets of any region are computed from the line length, so
+    only the bytes of that region are read from the memory-mapped file.
+    bgzip-compressed files are supported via a .gzi index of block offsets,
+    in which case only the BGZF blocks covering the region are inflated.
+
+    Unlike Fasta, sequences are returned as strings instead of SeqRecords.
+    """
+    def __init__(self, filename):
+        super(FaidxFasta, self).__init__(filename)
+        self.faifile = filename + ".fai"
+        self.bgzf = filename.endswith(".gz")
+        self.fp = open(filename, "rb")
+        if self.bgzf:
+            self.blocks = self.load_gzi()
+            self.ustarts = [u for c, u in self.blocks]
+            self.cached = (None, "")
+        else:
+            size = op.getsize(filename)
+            self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ) \
+                        if size else ""
+
+        if need_update(filename, self.faifile):
+            self.build_fai()
+        self.index = OrderedDict()
+        for row in open(self.faifile):
+            name, length, offset, linebases, linewidth = row.split()[:5]
+            self.index[name] = (int(length), int(offset), int(linebases),
+                                int(linewidth))
+
+    def load_gzi(self):
+        gzifile = self.filename + ".gzi"
+        if need_update(self.filename, gzifile):
+            blocks = bgzf_blocks(self.filename)
+            # samtools omits the first block, which always starts at (0, 0)
+            fw = open(gzifile, "wb")
+            fw.write(struct.pack("<Q", len(blocks) - 1))
+            for c, u in blocks[1:]:
+                fw.write(struct.pack("<QQ", c, u))
+            fw.close()
+            return blocks
+
+        data = open(gzifile, "rb").read()
+        n, = struct.unpack("<Q", data[:8])
+        values = struct.unpack("<{0}Q".format(2 * n), data[8:8 + 16 * n])
+        return [(0, 0)] + zip(values[0::2], values[1::2])
+
+    def build_fai(self):
+        """
+        Build .fai in one pass, recording the offset of the first base and the
+        line layout of each record.
+        """
+        fp = must_open(self.filename)
+        fw = open(self.faifile, "w")
+        name = None
+        offset = 0
+
+        def flush():
+            if name is None:
+                return
+            print >> fw, "\t".join(str(x) for x in \
+                    (name, length, seqoffset, linebases, linewidth))
+
+        for row in fp:
+            rowlen = len(row)
+            if row[0] == ">":
+                flush()
+                name = row[1:].split(None, 1)[0] if row[1:].strip() else ""
+                seqoffset = offset + rowlen
+                length = linebases = linewidth = 0
+                lastline = False
+            else:
+                bases = len(row.rstrip("\r\n"))
+                if linebases == 0:
+                    linebases, linewidth = bases, rowlen
+                else:
+                    assert not lastline and bases <= linebases, \
+                        "Different line length in `{0}`".format(name)
+                lastline = bases < linebases
+                length += bases
+            offset += rowlen
+        flush()
+        fw.close()
+        logging.debug("Index written to `{0}`".format(self.faifile))
+
+    def _read(self, start, end):
+        """
+        Read bytes [start, end) of the uncompressed file.
+        """
+        if not self.bgzf:
+            return self.mm[start:end]
+
+        chunks = []
+        i = bisect_right(self.ustarts, start) - 1
+        pos = self.ustarts[i]
+        while pos < end and i < len(self.blocks):
+            data = self._inflate(i)
+            chunks.append(data[max(start - pos, 0):end - pos])
+            pos += len(data)
+            i += 1
+        return "".join(chunks)
+
+    def _inflate(self, i):
+        if self.cached[0] == i:
+            return self.cached[1]
+        coffset = self.blocks[i][0]
+        self.fp.seek(coffset)
+        header = self.fp.read(18)
+        bsize, = struct.unpack("<H", header[16:18])
+        block = header + self.fp.read(bsize + 1 - 18)
+        data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(block)
+        self.cached = (i, data)
+        return data
+
+    def keys(self):
+        return self.index.keys()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def itersizes(self):
+        for k, v in self.index.items():
+            yield k, v[0]
+
+    def subseq(self, seqid, start=None, stop=None, strand=None):
+        """
+        Return seqid:start-stop (1-based, inclusive) as a string
+        """
+        length, offset, linebases, linewidth = self.index[seqid]
+        start = start - 1 if start is not None else 0
+        stop = stop if stop is not None else length
+
+        if start < 0:
+            msg = "start ({0}) must > 0 of `{1}`. Reset to 1".\
+                        format(start + 1, seqid)
+            logging.error(msg)
+            start = 0
+
+        if stop > length:
+            msg = "stop ({0}) must be <= length of `{1}` ({2}). Reset to {2}.".\
+                        format(stop, seqid, length)
+            logging.error(msg)
+            stop = length
+
+        if start >= stop:
+            return ""
+
+        bstart = offset + start / linebases * linewidth + start % linebases
+        bend = offset + (stop - 1) / linebases * linewidth + \
+                (stop - 1) % linebases + 1
+        seq = self._read(bstart, bend)
+        if linewidth > linebases:
+            seq = seq.replace("\n", "").replace("\r", "")
+
+        if strand in (-1, '-1', '-'):
+            seq = str(Seq(seq).reverse_complement())
+
+        return seq
+
+    def sequence(self, f, asstring=True):
+        """
+        Same as Fasta.sequence(), reading only the bytes in the range
+        """
+        assert 'chr' in f, "`chr` field required"
+        name = f['chr']
+
+        assert name in self, "feature: %s not in `%s`" % \
+                (f, self.filename)
+
+        seq = self.subseq(name, f.get('start'), f.get('stop'), f.get('strand'))
+
+        if asstring:
+            return seq
+
+        return Seq(seq)
+
+
 """
 Class derived from https://gist.github.com/933737
 Original code written by David Winter (https://github.com/dwinter)
@@ -11,7 +11,9 @@ import re
 import logging
 import json
 
-from itertools import islice
+import numpy as np
+
+from itertools import islice, izip
 
 from Bio import SeqIO
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
@@ -44,6 +46,14 @@ class FastqLite (object):
         self.qual = self.qual[::-1]
 
 
+def offset_table(offset):
+    """
+    Lookup table that shifts quality characters by offset, clipped to the
+    printable range.
+    """
+    return np.clip(np.arange(256) + offset, 33, 126).astype(np.uint8)
+
+
 class FastqRecord (object):
     def __init__(self, fh, offset=0, key=None):
         self.name = self.header = fh.readline()
@@ -54,7 +64,7 @@ class FastqRecord (object):
         self.l3 = fh.readline().rstrip()
         self.qual = fh.readline().rstrip()
         if offset != 0:
-            self.qual = "".join(chr(ord(x) + offset) for x in self.qual)
+            self.qual = self.qual.translate(offset_table(offset).tostring())
         self.length = len(self.seq)
         assert self.length == len(self.qual), \
                 "length mismatch: seq(%s) and qual(%s)" % (self.seq, self.qual)
@@ -182,6 +192,238 @@ class FastqHeader(object):
         return str(self)
 
 
+class FastqBlock (object):
+    """
+    A batch of FASTQ records held in one byte array, with the offsets of
+    each record and of its sequence and quality lines, so that per-read
+    operations run over whole batches in NumPy.
+    """
+    def __init__(self, buf, start, seq_start, seq_end, qual_start, qual_end,
+                 end):
+        self.buf = buf
+        self.start = start
+        self.seq_start = seq_start
+        self.seq_end = seq_end
+        self.qual_start = qual_start
+        self.qual_end = qual_end
+        self.end = end
+
+    @classmethod
+    def parse(cls, text, multiple=1):
+        """
+        Parse the complete records at the beginning of text, as a multiple
+        of `multiple` records. Returns the block (None if there is no
+        complete record yet) and the unparsed remainder.
+        """
+        buf = np.frombuffer(text, dtype=np.uint8)
+        nl = np.flatnonzero(buf == ord("\n"))
+        n = len(nl) / (4 * multiple) * multiple
+        if n == 0:
+            return None, text
+
+        nl = nl[:4 * n].reshape(n, 4)
+        end = nl[:, 3] + 1
+        start = np.concatenate(([0], end[:-1]))
+        seq_start, seq_end = nl[:, 0] + 1, nl[:, 1]
+        qual_start, qual_end = nl[:, 2] + 1, nl[:, 3]
+        # Windows line endings
+        seq_end -= buf[seq_end - 1] == ord("\r")
+        qual_end -= buf[qual_end - 1] == ord("\r")
+
+        assert (buf[start] == ord("@")).all(), "malformed FASTQ record"
+        bad = np.flatnonzero(seq_end - seq_start != qual_end - qual_start)
+        assert len(bad) == 0, "length mismatch: seq and qual in record `%s`" % \
+                text[start[bad[0]]:seq_start[bad[0]]].strip()
+
+        blk = cls(buf[:end[-1]], start, seq_start, seq_end,
+                  qual_start, qual_end, end)
+        return blk, text[end[-1]:]
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def lengths(self):
+        return self.seq_end - self.seq_start
+
+    def subset(self, idx):
+        """
+        Records selected by a slice, index or boolean array, sharing the
+        same buffer.
+        """
+        return FastqBlock(self.buf, self.start[idx], self.seq_start[idx],
+                          self.seq_end[idx], self.qual_start[idx],
+                          self.qual_end[idx], self.end[idx])
+
+    def mask(self, starts, ends):
+        """
+        Boolean mask over the buffer, True inside the [starts, ends) ranges.
+        """
+        d = np.zeros(len(self.buf) + 1, dtype=np.int32)
+        np.add.at(d, starts, 1)
+        np.add.at(d, ends, -1)
+        return np.cumsum(d[:-1]) > 0
+
+    def count_qual(self, table):
+        """
+        Number of quality characters per record for which table is True.
+        """
+        c = np.concatenate(([0], np.cumsum(table[self.buf])))
+        return c[self.qual_end] - c[self.qual_start]
+
+    def is_high_qv(self, qvchar, pct=90):
+        """
+        Vectorized isHighQv() over the records.
+        """
+        table = np.arange(256) >= ord(qvchar)
+        cutoff = self.lengths * pct / 100
+        return self.count_qual(table) >= cutoff
+
+    def convert_offset(self, offset):
+        """
+        New block with the quality characters shifted by offset.
+        """
+        buf = self.buf.copy()
+        inqual = self.mask(self.qual_start, self.qual_end)
+        buf[inqual] = offset_table(offset)[buf[inqual]]
+        return FastqBlock(buf, self.start, self.seq_start, self.seq_end,
+                          self.qual_start, self.qual_end, self.end)
+
+    def records(self):
+        text = self.buf.tostring()
+        return [text[a:b] for a, b in izip(self.start, self.end)]
+
+    def names(self):
+        text = self.buf.tostring()
+        return [text[a:b].split(None, 1)[0] for a, b in \
+                izip(self.start, self.seq_start)]
+
+    def seqs(self):
+        text = self.buf.tostring()
+        return [text[a:b] for a, b in izip(self.seq_start, self.seq_end)]
+
+    def tostring(self):
+        """
+        The records as FASTQ text, in the order of the block.
+        """
+        if len(self) and (np.diff(self.start) > 0).all() and \
+                (self.start[1:] == self.end[:-1]).all():
+            return self.buf[self.start[0]:self.end[-1]].tostring()
+        return "".join(self.records())
+
+
+def read_chunks(fh, blocksize):
+    try:
+        while True:
+            chunk = fh.read(blocksize)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fh.close()
+
+
+def background(iterable, maxsize=4):
+    """
+    Run iterable in a thread, up to `maxsize` items ahead of the consumer.
+    zlib releases the GIL, so decompression overlaps with parsing. If the
+    consumer stops early, the thread is told to stop and the iterable closed.
+    """
+    from threading import Thread, Event
+    from Queue import Queue, Full
+
+    q = Queue(maxsize)
+    done = object()
+    stop = Event()
+
+    def put(x):
+        while not stop.is_set():
+            try:
+                q.put(x, timeout=.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for x in iterable:
+                if not put(x):
+                    break
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+            put(done)
+
+    t = Thread(target=produce)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            x = q.get()
+            if x is done:
+                break
+            yield x
+    finally:
+        stop.set()
+        t.join()
+
+
+def iter_fastq_blocks(filename, blocksize=1 << 24, multiple=1):
+    """
+    Iterate FastqBlock objects of about `blocksize` bytes. Use multiple=2 on
+    interleaved files to keep pairs within the same block.
+    """
+    logging.debug("Read file `{0}`".format(filename))
+    if filename.endswith(".gz"):
+        import gzip
+        chunks = background(read_chunks(gzip.open(filename), blocksize))
+    else:
+        chunks = read_chunks(must_open(filename), blocksize)
+
+    leftover = ""
+    for chunk in chunks:
+        blk, leftover = FastqBlock.parse(leftover + chunk, multiple=multiple)
+        if blk:
+            yield blk
+
+    if leftover and not leftover.endswith("\n"):
+        blk, leftover = FastqBlock.parse(leftover + "\n", multiple=multiple)
+        if blk:
+            yield blk
+    if leftover.strip():
+        logging.error("Truncated record at the end of `{0}`".format(filename))
+
+
+def iter_paired_blocks(r1, r2, blocksize=1 << 24):
+    """
+    Iterate (read1, read2) FastqBlock pairs with the same number of records.
+    When r1 == r2, the file is taken as interleaved.
+    """
+    if r1 == r2:
+        for blk in iter_fastq_blocks(r1, blocksize=blocksize, multiple=2):
+            yield blk.subset(slice(0, None, 2)), blk.subset(slice(1, None, 2))
+        return
+
+    ai = iter_fastq_blocks(r1, blocksize=blocksize)
+    bi = iter_fastq_blocks(r2, blocksize=blocksize)
+    a = b = None
+    while True:
+        if not a:
+            a = next(ai, None)
+        if not b:
+            b = next(bi, None)
+        if not a or not b:
+            break
+        n = min(len(a), len(b))
+        yield a.subset(slice(None, n)), b.subset(slice(None, n))
+        a, b = a.subset(slice(n, None)), b.subset(slice(n, None))
+
+    if a or b:
+        logging.error("`{0}` and `{1}` differ in number of reads".\
+                      format(r1, r2))
+
+
 def pairspf(pp, commonprefix=True):
     if commonprefix:
         pf = op.commonprefix(pp).rstrip("._-")
@@ -239,7 +481,7 @@ def uniq(args):
     %prog uniq fastqfile
 
     Retain only first instance of duplicate reads. Duplicate is defined as
-    having the same read name.
+    having the same read name. Records are written as they are in the input.
     """
     p = OptionParser(uniq.__doc__)
     p.set_outfile()
@@ -252,16 +494,16 @@ def uniq(args):
     fw = must_open(opts.outfile, "w")
     nduplicates = nreads = 0
     seen = set()
-    for rec in iter_fastq(fastqfile):
-        nreads += 1
-        if rec is None:
-            break
-        name = rec.name
-        if name in seen:
-            nduplicates += 1
-            continue
-        seen.add(name)
-        print >> fw, rec
+    for blk in iter_fastq_blocks(fastqfile):
+        keep = np.ones(len(blk), dtype=bool)
+        for i, name in enumerate(blk.names()):
+            if name in seen:
+                keep[i] = False
+                continue
+            seen.add(name)
+        nreads += len(blk)
+        nduplicates += len(blk) - keep.sum()
+        fw.write(blk.subset(keep).tostring())
     logging.debug("Removed duplicate reads: {}".\
                   format(percentage(nduplicates, nreads)))
 
@@ -270,7 +512,8 @@ def suffix(args):
     """
     %prog suffix fastqfile CAG
 
-    Filter reads based on suffix.
+    Filter reads based on suffix. Records are written as they are in the
+    input.
     """
     p = OptionParser(suffix.__doc__)
     p.set_outfile()
@@ -282,13 +525,11 @@ def suffix(args):
     fastqfile, sf = args
     fw = must_open(opts.outfile, "w")
     nreads = nselected = 0
-    for rec in iter_fastq(fastqfile):
-        nreads += 1
-        if rec is None:
-            break
-        if rec.seq.endswith(sf):
-            print >> fw, rec
-            nselected += 1
+    for blk in iter_fastq_blocks(fastqfile):
+        keep = np.array([x.endswith(sf) for x in blk.seqs()], dtype=bool)
+        fw.write(blk.subset(keep).tostring())
+        nreads += len(blk)
+        nselected += keep.sum()
     logging.debug("Selected reads with suffix {0}: {1}".\
                   format(sf, percentage(nselected, nreads)))
 
@@ -297,13 +538,10 @@ def calc_readlen(f, first):
     from jcvi.utils.cbook import SummaryStats
 
     L = []
-    ai = iter_fastq(f)
-    rec = ai.next()
-    while rec:
-        L.append(rec.length)
+    for blk in iter_fastq_blocks(f, blocksize=1 << 20):
+        L.extend(blk.lengths[:first + 1 - len(L)])
         if len(L) > first:
             break
-        rec = ai.next()
     s = SummaryStats(L)
 
     return s
@@ -479,19 +717,12 @@ def filter(args):
     outfile = r1.rsplit(".", 1)[0] + ".q{0}.paired.fastq".format(qv)
     fw = open(outfile, "w")
 
-    p1fp, p2fp = FastqPairedIterator(r1, r2)
-    while True:
-        a = list(islice(p1fp, 4))
-        if not a:
-            break
-
-        b = list(islice(p2fp, 4))
-        q1 = a[-1].rstrip()
-        q2 = b[-1].rstrip()
-
-        if isHighQv(q1, qvchar, pct=pct) and isHighQv(q2, qvchar, pct=pct):
-            fw.writelines(a)
-            fw.writelines(b)
+    for a, b in iter_paired_blocks(r1, r2):
+        keep = a.is_high_qv(qvchar, pct=pct) & b.is_high_qv(qvchar, pct=pct)
+        a, b = a.subset(keep), b.subset(keep)
+        for ra, rb in izip(a.records(), b.records()):
+            fw.write(ra)
+            fw.write(rb)
 
 
 def checkShuffleSizes(p1, p2, pairsfastq, extra=0):
@@ -623,20 +854,15 @@ def guessoffset(args):
         sys.exit(not p.print_help())
 
     fastqfile, = args
-    ai = iter_fastq(fastqfile)
-    rec = ai.next()
     offset = 64
-    while rec:
-        quality = rec.quality
-        lowcounts = len([x for x in quality if x < 59])
-        highcounts = len([x for x in quality if x > 74])
-        diff = highcounts - lowcounts
-        if diff > 10:
-            break
-        elif diff < -10:
-            offset = 33
+    low, high = np.arange(256) < 59, np.arange(256) > 74
+    for blk in iter_fastq_blocks(fastqfile, blocksize=1 << 20):
+        diff = blk.count_qual(high) - blk.count_qual(low)
+        decided = np.flatnonzero(np.abs(diff) > 10)
+        if len(decided):
+            if diff[decided[0]] < -10:
+                offset = 33
             break
-        rec = ai.next()
 
     if offset == 33:
         print >> sys.stderr, "Sanger encoding (offset=33)"
@@ -837,11 +1063,9 @@ def size(args):
     total_size = total_numrecords = 0
     for f in args:
         cur_size = cur_numrecords = 0
-        for rec in iter_fastq(f):
-            if not rec:
-                break
-            cur_numrecords += 1
-            cur_size += len(rec)
+        for blk in iter_fastq_blocks(f):
+            cur_numrecords += len(blk)
+            cur_size += blk.lengths.sum()
 
         print " ".join(str(x) for x in \
                 (op.basename(f), cur_numrecords, cur_size))
@@ -859,7 +1083,7 @@ def convert(args):
 
     illumina fastq quality encoding uses offset 64, and sanger uses 33. This
     script creates a new file with the correct encoding. Output gzipped file if
-    input is also gzipped.
+    input is also gzipped. Qualities beyond the printable range are clipped.
     """
     p = OptionParser(convert.__doc__)
     p.set_phred()
@@ -879,19 +1103,10 @@ def convert(args):
     if gz:
         outfastq += ".gz"
 
-    fin = "illumina" if phred == "64" else "sanger"
-    fout = "sanger" if phred == "64" else "illumina"
-
-    seqret = "seqret"
-    if infastq.endswith(".gz"):
-        cmd = "zcat {0} | ".format(infastq)
-        cmd += seqret + " fastq-{0}::stdin fastq-{1}::stdout".\
-                format(fin, fout)
-    else:
-        cmd = seqret + " fastq-{0}::{1} fastq-{2}::stdout".\
-                format(fin, infastq, fout)
-
-    sh(cmd, outfile=outfastq)
+    fw = must_open(outfastq, "w")
+    for blk in iter_fastq_blocks(infastq):
+        fw.write(blk.convert_offset(int(ophred) - int(phred)).tostring())
+    fw.close()
 
     return outfastq
 
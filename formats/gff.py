@@ -6,18 +6,24 @@ import sys
 import os
 import os.path as op
 import logging
+import mmap
 import re
+import sqlite3
+import zipfile
+import numpy as np
 
 from collections import defaultdict
+from multiprocessing import Pool
 from urllib import quote, unquote
 
 from jcvi.utils.cbook import AutoVivification
-from jcvi.formats.base import DictFile, LineFile, must_open, is_number
-from jcvi.formats.fasta import Fasta, SeqIO
+from jcvi.formats.base import BaseFile, DictFile, LineFile, must_open, \
+            is_number, split_ranges, file_stamp
+from jcvi.formats.fasta import Fasta, FaidxFasta, SeqIO
 from jcvi.formats.bed import Bed, BedLine, natsorted
 from jcvi.annotation.reformat import atg_name
 from jcvi.utils.iter import flatten
-from jcvi.utils.range import range_minmax
+from jcvi.utils.range import range_minmax, range_union
 from jcvi.utils.orderedcollections import DefaultOrderedDict, parse_qs
 from jcvi.apps.base import OptionParser, OptionGroup, ActionDispatcher, mkdir, \
             parse_multi_values, need_update, sh
@@ -80,7 +86,9 @@ class GffLine (object):
         assert self.phase in Valid_phases, \
                 "phase must be one of {0}".format(Valid_phases)
         self.attributes_text = "" if len(args) <= 8 else args[8].strip()
-        self.attributes = make_attributes(self.attributes_text, gff3=gff3, keep_attr_order=keep_attr_order)
+        # attributes are decoded on first access, see `attributes`
+        self._attributes = None
+        self.keep_attr_order = keep_attr_order
         # key is not in the gff3 field, this indicates the conversion to accn
         self.key = key  # usually it's `ID=xxxxx;`
         self.gff3 = gff3
@@ -118,6 +126,17 @@ class GffLine (object):
     def __getitem__(self, key):
         return getattr(self, key)
 
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = make_attributes(self.attributes_text,
+                    gff3=self.gff3, keep_attr_order=self.keep_attr_order)
+        return self._attributes
+
+    @attributes.setter
+    def attributes(self, value):
+        self._attributes = value
+
     def __str__(self):
         return "\t".join(str(x) for x in (self.seqid, self.source, self.type,
                 self.start, self.end, self.score, self.strand, self.phase,
@@ -230,15 +249,226 @@ class GffLine (object):
         return ",".join(str(elem) for elem in sig_elems)
 
 
+def fasta_offset(filename):
+    """
+    Byte offset of the ##FASTA line, or the file size if there is none.
+    """
+    size = op.getsize(filename)
+    if size == 0:
+        return 0
+    fp = open(filename)
+    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(FastaTag)] == FastaTag:
+        i = 0
+    else:
+        i = mm.find("\n" + FastaTag)
+        i = size if i < 0 else i + 1
+    mm.close()
+    fp.close()
+    return i
+
+
+def _parse_gff_range(args):
+    """
+    Parse the features between byte offsets [start, end) of a GFF file into
+    columns. Returns the number of lines read and whether ##FASTA was hit.
+    """
+    filename, start, end = args
+    codes = ({}, {}, {})
+    cols = [[], [], [], [], [], [], [], [], []]
+    lineno, attrs = [], []
+    nlines = 0
+    stopped = False
+    fp = open(filename)
+    fp.seek(start)
+    pos = start
+    while pos < end:
+        row = fp.readline()
+        if not row:
+            break
+        pos += len(row)
+        nlines += 1
+        row = row.strip()
+        if row == "":
+            continue
+        if row[0] == '#':
+            if row == FastaTag:
+                stopped = True
+                break
+            continue
+        atoms = row.split("\t")
+        if len(atoms) != 9:
+            atoms = row.split()
+        if len(atoms) < 8:  # Not a feature line
+            continue
+        for i, c in enumerate(codes):
+            cols[i].append(c.setdefault(atoms[i], len(c)))
+        for i in xrange(3, 8):
+            cols[i].append(atoms[i])
+        attrs.append(atoms[8].strip() if len(atoms) > 8 else "")
+        lineno.append(nlines - 1)
+    fp.close()
+
+    names = [sorted(c, key=c.get) for c in codes]
+    ids = [np.array(x, dtype=np.int32) for x in cols[:3]]
+    coords = [np.array(x, dtype=np.int64) for x in cols[3:5]]
+    text = [np.array(x, dtype="S") for x in cols[5:8]]
+    lengths = np.array([len(x) for x in attrs], dtype=np.int64)
+    blob = np.frombuffer("".join(attrs), dtype=np.uint8)
+    return names, ids, coords, text, lengths, blob, \
+           np.array(lineno, dtype=np.int64), nlines, stopped
+
+
+class GffStore (BaseFile):
+    """
+    Compact column store of all features in a GFF file. Seqid, source and
+    type are interned as int codes, coordinates are int64 arrays, and the
+    attributes column is kept as raw bytes, so attributes are only decoded
+    for the rows being used.
+
+    The file is parsed once, in parallel chunks, and the store is cached to
+    `gffile.npz`, keyed on the size and mtime of the GFF file. An unreadable
+    cache is parsed again, and an unwritable one is skipped.
+    """
+    columns = ("seqid", "source", "type", "start", "end", "score", "strand",
+               "phase", "attr_offsets", "attr_blob", "lineno")
+
+    def __init__(self, filename, cpus=1, cache=True):
+        super(GffStore, self).__init__(filename)
+        self.cachefile = filename + ".npz"
+        self.stamp = np.array(file_stamp(filename), dtype=np.int64)
+
+        if cache and self.load_cache():
+            return
+
+        self.parse(cpus=cpus)
+        if cache:
+            self.save_cache()
+
+    def parse(self, cpus=1):
+        # Only split the features, everything after ##FASTA is sequence
+        cap = fasta_offset(self.filename)
+        jobs = [(self.filename, a, min(b, cap)) for a, b in \
+                    split_ranges(self.filename, cpus) if a < cap] or \
+               [(self.filename, 0, 0)]
+        if cpus > 1 and len(jobs) > 1:
+            p = Pool(processes=min(cpus, len(jobs)))
+            results = p.map(_parse_gff_range, jobs)
+            p.close()
+        else:
+            results = [_parse_gff_range(x) for x in jobs]
+
+        # Everything after ##FASTA is sequence
+        for i, r in enumerate(results):
+            if r[-1]:
+                results = results[:i + 1]
+                break
+
+        interned = ({}, {}, {})
+        codes = [[], [], []]
+        columns = defaultdict(list)
+        lineoffset = 0
+        for names, ids, coords, text, lengths, blob, lineno, nlines, \
+                stopped in results:
+            for i, (intern, c) in enumerate(zip(interned, names)):
+                recode = np.array([intern.setdefault(x, len(intern)) \
+                                    for x in c], dtype=np.int32)
+                codes[i].append(recode[ids[i]] if len(ids[i]) else ids[i])
+            for name, x in zip(("start", "end", "score", "strand", "phase"),
+                               coords + text):
+                columns[name].append(x)
+            columns["lengths"].append(lengths)
+            columns["attr_blob"].append(blob)
+            columns["lineno"].append(lineno + lineoffset)
+            lineoffset += nlines
+
+        for i, name in enumerate(("seqid", "source", "type")):
+            setattr(self, name + "s", np.array(sorted(interned[i],
+                    key=interned[i].get)))
+            setattr(self, name, np.concatenate(codes[i]))
+        for name in ("start", "end", "score", "strand", "phase", "attr_blob",
+                     "lineno"):
+            setattr(self, name, np.concatenate(columns[name]))
+        lengths = np.concatenate(columns["lengths"])
+        self.attr_offsets = np.append(0, np.cumsum(lengths))
+        logging.debug("Parsed {0} features from `{1}`".\
+                        format(len(self), self.filename))
+
+    def save_cache(self):
+        arrays = dict((x, getattr(self, x)) for x in self.columns)
+        for name in ("seqids", "sources", "types"):
+            arrays[name] = getattr(self, name)
+        try:
+            np.savez(self.cachefile, stamp=self.stamp, **arrays)
+        except (IOError, OSError) as e:
+            logging.error("Cannot write cache `{0}`: {1}".\
+                            format(self.cachefile, e))
+            if op.exists(self.cachefile):
+                os.remove(self.cachefile)
+            return
+        logging.debug("GFF cache written to `{0}`".format(self.cachefile))
+
+    def load_cache(self):
+        if not op.exists(self.cachefile):
+            return False
+
+        try:
+            npz = np.load(self.cachefile)
+            if not np.array_equal(npz["stamp"], self.stamp):
+                logging.debug("Cache `{0}` is stale".format(self.cachefile))
+                npz.close()
+                return False
+            arrays = dict((name, npz[name]) for name in \
+                            self.columns + ("seqids", "sources", "types"))
+            npz.close()
+        except (IOError, KeyError, ValueError, zipfile.BadZipfile) as e:
+            logging.error("Cannot load cache `{0}`: {1}".\
+                            format(self.cachefile, e))
+            return False
+
+        for name, a in arrays.items():
+            setattr(self, name, a)
+        logging.debug("Load {0} features from cache `{1}`".\
+                        format(len(self), self.cachefile))
+        return True
+
+    def __len__(self):
+        return len(self.start)
+
+    def select(self, types=None, sources=None):
+        """
+        Indices of rows matching any of the given types and sources.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for values, codes, names in ((types, self.type, self.types),
+                                     (sources, self.source, self.sources)):
+            if values:
+                wanted = np.flatnonzero(np.in1d(names, list(values)))
+                mask &= np.in1d(codes, wanted)
+        return np.flatnonzero(mask)
+
+    def row(self, i):
+        a, b = self.attr_offsets[i], self.attr_offsets[i + 1]
+        return "\t".join((self.seqids[self.seqid[i]],
+                          self.sources[self.source[i]],
+                          self.types[self.type[i]],
+                          str(self.start[i]), str(self.end[i]),
+                          self.score[i], self.strand[i], self.phase[i],
+                          self.attr_blob[a:b].tostring()))
+
+
 class Gff (LineFile):
 
     def __init__(self, filename, key="ID", strict=True, append_source=False, \
             append_ftype=False, score_attrib=False, \
             keep_attr_order=True, make_gff_store=False, \
-            compute_signature=False):
+            compute_signature=False, colstore=False, cpus=1):
         super(Gff, self).__init__(filename)
         self.make_gff_store = make_gff_store
         self.gff3 = True
+        # Column store parsed once by GffStore, unlike the list of GffLines
+        # kept in self.gffstore by make_gff_store
+        self.colstore = None
         if self.make_gff_store:
             self.gffstore = []
             gff = Gff(self.filename, key=key, strict=True, append_source=append_source, \
@@ -261,24 +491,63 @@ class Gff (LineFile):
                     logging.debug("File is not gff3 standard.")
                 return
 
+            if colstore:
+                self.colstore = GffStore(filename, cpus=cpus)
             self.set_gff_type()
 
     def set_gff_type(self):
         # Determine file type
-        row = None
-        for row in self:
-            break
-        gff3 = False if not row else "=" in row.attributes_text
+        store = self.colstore
+        if store:
+            attributes = store.attr_blob[:store.attr_offsets[1]].tostring() \
+                            if len(store) else ""
+            gff3 = "=" in attributes
+        else:
+            row = None
+            for row in self:
+                break
+            gff3 = False if not row else "=" in row.attributes_text
+            self.fp.seek(0)
         if not gff3:
             logging.debug("File is not gff3 standard.")
 
         self.gff3 = gff3
-        self.fp.seek(0)
+
+    def _gffline(self, row, idx):
+        return GffLine(row, key=self.key, line_index=idx, \
+                strict=self.strict, \
+                append_source=self.append_source, \
+                append_ftype=self.append_ftype,\
+                score_attrib=self.score_attrib, \
+                keep_attr_order=self.keep_attr_order, \
+                compute_signature=self.compute_signature, \
+                gff3=self.gff3)
+
+    def select(self, types=None, sources=None):
+        """
+        Iterate over features of certain types and sources. With the feature
+        store, only the matching rows are turned into GffLine.
+        """
+        if not self.colstore:
+            for g in self:
+                if types and g.type not in types:
+                    continue
+                if sources and g.source not in sources:
+                    continue
+                yield g
+            return
+
+        store = self.colstore
+        for i in store.select(types=types, sources=sources):
+            yield self._gffline(store.row(i), int(store.lineno[i]))
 
     def __iter__(self):
         if self.make_gff_store:
             for row in self.gffstore:
                 yield row
+        elif self.colstore:
+            for g in self.select():
+                yield g
         else:
             self.fp = must_open(self.filename)
             for idx, row in enumerate(self.fp):
@@ -289,17 +558,13 @@ class Gff (LineFile):
                     if row == FastaTag:
                         break
                     continue
-                yield GffLine(row, key=self.key, line_index=idx, \
-                        strict=self.strict, \
-                        append_source=self.append_source, \
-                        append_ftype=self.append_ftype,\
-                        score_attrib=self.score_attrib, \
-                        keep_attr_order=self.keep_attr_order, \
-                        compute_signature=self.compute_signature, \
-                        gff3=self.gff3)
+                yield self._gffline(row, idx)
 
     @property
     def seqids(self):
+        if self.colstore:
+            store = self.colstore
+            return set(store.seqids[np.unique(store.seqid)])
         return set(x.seqid for x in self)
 
 
@@ -374,7 +639,7 @@ def make_attributes(s, gff3=True, keep_attr_order=True):
 
 def to_range(obj, score=None, id=None, strand=None):
     """
-    Given a gffutils object, convert it to a range object
+    Given a GffFeature object, convert it to a range object
     """
     from jcvi.utils.range import Range
 
@@ -557,7 +822,7 @@ def fixpartials(args):
     gffile, gfasta, partials, = args
 
     gff = make_index(gffile)
-    genome = Fasta(gfasta, index=True)
+    genome = FaidxFasta(gfasta)
     partials = LineFile(partials, load=True).lines
 
     # all_transcripts = [f.id for f in gff.features_of_type("mRNA", \
@@ -1378,10 +1643,13 @@ def format(args):
                  help="Print output in GFF3 format [default: %default]")
     g3.add_option("--make_gff_store", default=False, action="store_true",
                  help="Store entire GFF file in memory during first iteration [default: %default]")
+    g3.add_option("--store", default=False, action="store_true",
+                 help="Parse once into feature store cached as gffile.npz [default: %default]")
     p.add_option_group(g3)
 
     p.set_outfile()
     p.set_SO_opts()
+    p.set_cpus(cpus=1)
 
     opts, args = p.parse_args(args)
 
@@ -1471,6 +1739,7 @@ def format(args):
         notes = {}
 
     remove = set()
+    gff = None
     if unique or duptype or remove_feats or remove_feats_by_ID \
             or opts.multiparents == "merge" or invent_name_attr or make_gff_store \
             or invent_protein_feat:
@@ -1493,7 +1762,7 @@ def format(args):
             make_gff_store = compute_signature = True
         gff = Gff(gffile, keep_attr_order=(not opts.no_keep_attr_order), \
                 make_gff_store=make_gff_store, compute_signature=compute_signature, \
-                strict=strict)
+                strict=strict, colstore=opts.store, cpus=opts.cpus)
         for g in gff:
             if process_ftype and g.type not in process_ftype:
                 continue
@@ -1533,9 +1802,10 @@ def format(args):
         valid_soterm = {}
 
     fw = must_open(outfile, "w")
-    if not make_gff_store:
+    # The feature store can be iterated again without re-parsing the file
+    if not (make_gff_store or (opts.store and gff is not None)):
         gff = Gff(gffile, keep_attr_order=(not opts.no_keep_attr_order), \
-                strict=strict)
+                strict=strict, colstore=opts.store, cpus=opts.cpus)
     for g in gff:
         if process_ftype and g.type not in process_ftype:
             print >> fw, g
@@ -1838,7 +2108,7 @@ def match_Nth_child(f1c, f2c, N=1, slop=False):
 
 def match_subfeats(f1, f2, dbx1, dbx2, featuretype=None, slop=False):
     """
-    Given 2 gffutils features located in 2 separate gffutils databases,
+    Given 2 features located in 2 separate GffDB databases,
     iterate through all subfeatures of a certain type and check whether
     they are identical or not
 
@@ -2567,7 +2837,10 @@ def bed(args):
             help="Append GFF feature type to extracted key value")
     p.add_option("--nosort", default=False, action="store_true",
             help="Do not sort the output bed file [default: %default]")
+    p.add_option("--store", default=False, action="store_true",
+            help="Parse into feature store cached as gffile.npz [default: %default]")
     p.set_stripnames(default=False)
+    p.set_cpus(cpus=1)
     p.set_outfile()
 
     opts, args = p.parse_args(args)
@@ -2587,15 +2860,11 @@ def bed(args):
         source = set(x.strip() for x in opts.source.split(","))
 
     gff = Gff(gffile, key=key, append_source=opts.append_source, \
-        append_ftype=opts.append_ftype, score_attrib=opts.score_attrib)
+        append_ftype=opts.append_ftype, score_attrib=opts.score_attrib, \
+        colstore=opts.store, cpus=opts.cpus)
     b = Bed()
 
-    for g in gff:
-        if type and g.type not in type:
-            continue
-        if source and g.source not in source:
-            continue
-
+    for g in gff.select(types=type, sources=source):
         bl = g.bedline
         if strip_names:
             bl.accn = gene_name(bl.accn)
@@ -2609,22 +2878,356 @@ def bed(args):
                     format(len(b), ",".join(type), key))
 
 
+class FeatureNotFoundError (KeyError):
+    pass
+
+
+class GffFeature (GffLine):
+    """
+    A feature retrieved from `GffDB`. Carries the unique ID assigned in the
+    index, and also answers to the gffutils-style names (featuretype, chrom,
+    stop, frame). Attributes edited after retrieval are written back out
+    when printed.
+    """
+    id = None
+
+    def __init__(self, row, gff3=True):
+        self.id, self.seqid, self.source, self.type, self.start, self.end, \
+            self.score, self.strand, self.phase, self.attributes_text = row
+        self._attributes = None
+        self.keep_attr_order = True
+        self.key = "ID"
+        self.gff3 = gff3
+
+    def __str__(self):
+        if self._attributes is not None:
+            self.update_attributes(gff3=self.gff3)
+        return super(GffFeature, self).__str__()
+
+    def __getitem__(self, key):
+        # gffutils-style access to the attribute values, e.g. feat['Parent']
+        return self.attributes[key]
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, list):
+            value = [value]
+        self.attributes[key] = value
+
+    def __len__(self):
+        return self.span
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    @property
+    def featuretype(self):
+        return self.type
+
+    @featuretype.setter
+    def featuretype(self, value):
+        self.type = value
+
+    @property
+    def stop(self):
+        return self.end
+
+    @stop.setter
+    def stop(self, value):
+        self.end = value
+
+    @property
+    def chrom(self):
+        return self.seqid
+
+    @property
+    def frame(self):
+        return self.phase
+
+
+class GffDB (object):
+    """
+    SQLite index of a GFF file, see `make_index()`.
+
+    Features are keyed on their ID (made unique by appending _1, _2 ..., and
+    auto-generated as type_N when missing). Parent-child links are stored as
+    a closure table with the distance between the two features as `level`,
+    so that children and parents at any depth are a single indexed lookup,
+    and feature spans go in an R*Tree for region queries.
+    """
+    version = "1"
+    columns = ("id", "seqid", "source", "featuretype", "start", "stop",
+               "score", "strand", "frame", "attributes")
+    order_columns = set(columns[:-1])
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.conn = sqlite3.connect(dbfile)
+        self.conn.text_factory = str
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        self.gff3 = meta["gff3"] == "1"
+
+    @classmethod
+    def valid(cls, dbfile):
+        try:
+            conn = sqlite3.connect(dbfile)
+            row = conn.execute("SELECT value FROM meta WHERE key = 'version'")\
+                    .fetchone()
+            conn.close()
+        except sqlite3.DatabaseError:
+            return False
+        return row is not None and row[0] == cls.version
+
+    @classmethod
+    def create(cls, gff_file, dbfile):
+        gff = Gff(gff_file)
+        conn = sqlite3.connect(dbfile)
+        conn.text_factory = str
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE features (
+                fid INTEGER PRIMARY KEY, id TEXT UNIQUE, seqid TEXT,
+                source TEXT, featuretype TEXT, start INTEGER, stop INTEGER,
+                score TEXT, strand TEXT, frame TEXT, attributes TEXT);
+            CREATE TABLE seqids (code INTEGER PRIMARY KEY, seqid TEXT UNIQUE);
+            CREATE TABLE relations (
+                parent INTEGER, child INTEGER, level INTEGER,
+                PRIMARY KEY (parent, child, level));
+            CREATE VIRTUAL TABLE spans USING rtree(fid, slo, shi, start, stop);
+        """)
+
+        ids, counts, seqids = {}, defaultdict(int), {}
+        rows, spans, edges = [], [], []
+        for fid, g in enumerate(gff):
+            ftype = g.type
+            if "ID" in g.attributes:
+                id = g.attributes["ID"][0]
+            else:
+                counts[ftype] += 1
+                id = "{0}_{1}".format(ftype, counts[ftype])
+            uid, k = id, 0
+            while uid in ids:
+                k += 1
+                uid = "{0}_{1}".format(id, k)
+            ids[uid] = fid
+            rows.append((fid, uid, g.seqid, g.source, ftype, g.start, g.end,
+                         g.score, g.strand, g.phase, g.attributes_text))
+            s = seqids.setdefault(g.seqid, len(seqids))
+            spans.append((fid, s, s, min(g.start, g.end), max(g.start, g.end)))
+            edges.extend((p, fid) for p in g.attributes.get("Parent", []))
+
+        edges = [(ids[p], c, 1) for p, c in edges if p in ids]
+        conn.executemany("INSERT INTO features VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                         rows)
+        conn.executemany("INSERT INTO spans VALUES (?,?,?,?,?)", spans)
+        conn.executemany("INSERT INTO seqids VALUES (?,?)",
+                         ((v, k) for k, v in seqids.items()))
+        conn.executemany("INSERT OR IGNORE INTO relations VALUES (?,?,?)",
+                         edges)
+        conn.executemany("INSERT INTO meta VALUES (?,?)",
+                         (("version", cls.version),
+                          ("gff3", "1" if gff.gff3 else "0")))
+        conn.executescript("""
+            CREATE INDEX relations_child ON relations (child, level);
+            CREATE INDEX features_type ON features (featuretype);
+        """)
+
+        # Close the hierarchy one level at a time
+        level = 1
+        while level < len(rows):
+            cur = conn.execute("""INSERT OR IGNORE INTO relations
+                SELECT r.parent, e.child, ? FROM relations r
+                JOIN relations e ON e.parent = r.child AND e.level = 1
+                WHERE r.level = ?""", (level + 1, level))
+            if cur.rowcount <= 0:
+                break
+            level += 1
+
+        conn.commit()
+        conn.close()
+        logging.debug("Indexed {0} features and {1} parent-child links ({2} levels)".\
+                        format(len(rows), len(edges), level))
+        return cls(dbfile)
+
+    def _fetch(self, joins="", where=(), params=(), featuretype=None,
+               strand=None, order_by=None, reverse=False):
+        where, params = list(where), list(params)
+        if featuretype:
+            if isinstance(featuretype, basestring):
+                featuretype = [featuretype]
+            where.append("f.featuretype IN ({0})".\
+                            format(",".join("?" * len(featuretype))))
+            params.extend(featuretype)
+        if strand:
+            where.append("f.strand = ?")
+            params.append(strand)
+
+        sql = "SELECT DISTINCT {0} FROM features f {1}".\
+                format(",".join("f." + x for x in self.columns), joins)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+
+        if order_by:
+            if isinstance(order_by, basestring):
+                order_by = [order_by]
+            order_by = ["stop" if x == "end" else x for x in order_by]
+            assert set(order_by) <= self.order_columns, \
+                "order_by must be in {0}".format(sorted(self.order_columns))
+        else:
+            order_by = ["fid"]
+        direction = " DESC" if reverse else ""
+        sql += " ORDER BY " + ",".join("f." + x + direction for x in order_by)
+
+        for row in self.conn.execute(sql, params):
+            yield GffFeature(row, gff3=self.gff3)
+
+    def _fid(self, key):
+        key = getattr(key, "id", key)
+        row = self.conn.execute("SELECT fid FROM features WHERE id = ?",
+                                (key,)).fetchone()
+        if row is None:
+            raise FeatureNotFoundError(key)
+        return row[0]
+
+    def __getitem__(self, key):
+        key = getattr(key, "id", key)
+        for f in self._fetch(where=["f.id = ?"], params=[key]):
+            return f
+        raise FeatureNotFoundError(key)
+
+    def __contains__(self, key):
+        return self.conn.execute("SELECT 1 FROM features WHERE id = ?",
+                    (getattr(key, "id", key),)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+
+    def featuretypes(self):
+        for row in self.conn.execute("SELECT DISTINCT featuretype FROM features "
+                                     "ORDER BY featuretype"):
+            yield row[0]
+
+    def count_features_of_type(self, featuretype=None):
+        if featuretype is None:
+            return len(self)
+        return self.conn.execute("SELECT COUNT(*) FROM features WHERE "
+                        "featuretype = ?", (featuretype,)).fetchone()[0]
+
+    def all_features(self, featuretype=None, strand=None, order_by=None,
+                     reverse=False):
+        return self._fetch(featuretype=featuretype, strand=strand,
+                           order_by=order_by, reverse=reverse)
+
+    def features_of_type(self, featuretype, strand=None, order_by=None,
+                         reverse=False):
+        return self.all_features(featuretype=featuretype, strand=strand,
+                                 order_by=order_by, reverse=reverse)
+
+    def _relatives(self, key, this, other, level=None, featuretype=None,
+                   order_by=None, reverse=False):
+        joins = "JOIN relations r ON r.{0} = f.fid".format(this)
+        where = ["r.{0} = ?".format(other)]
+        params = [self._fid(key)]
+        if level is not None:
+            where.append("r.level = ?")
+            params.append(level)
+        return self._fetch(joins=joins, where=where, params=params,
+                           featuretype=featuretype, order_by=order_by,
+                           reverse=reverse)
+
+    def children(self, key, level=None, featuretype=None, order_by=None,
+                 reverse=False):
+        """
+        Children of a feature, only those `level` steps down when given.
+        """
+        return self._relatives(key, "child", "parent", level=level,
+                               featuretype=featuretype, order_by=order_by,
+                               reverse=reverse)
+
+    def parents(self, key, level=None, featuretype=None, order_by=None,
+                reverse=False):
+        return self._relatives(key, "parent", "child", level=level,
+                               featuretype=featuretype, order_by=order_by,
+                               reverse=reverse)
+
+    def iter_by_parent_childs(self, featuretype="gene", level=None,
+                              order_by=None, reverse=False):
+        """
+        For each feature of `featuretype`, yield a list of the feature
+        followed by its children.
+        """
+        for p in self.features_of_type(featuretype, order_by=order_by,
+                                       reverse=reverse):
+            yield [p] + list(self.children(p, level=level, order_by=order_by,
+                                           reverse=reverse))
+
+    def children_bp(self, key, child_featuretype="exon", merge=False):
+        """
+        Total bp covered by the children of a given type.
+        """
+        spans = [(c.start, c.end) for c in \
+                    self.children(key, featuretype=child_featuretype)]
+        if merge:
+            return range_union([("", a, b) for a, b in spans])
+        return sum(b - a + 1 for a, b in spans)
+
+    def region(self, region=None, seqid=None, start=None, end=None,
+               strand=None, featuretype=None, completely_within=False,
+               order_by=None):
+        """
+        Features overlapping a region, which can be given as a feature,
+        a (seqid, start, end) tuple, a `seqid:start-end` string or keywords.
+        """
+        if isinstance(region, basestring):
+            seqid, span = region.rsplit(":", 1)
+            start, end = [int(x) for x in span.split("-")]
+        elif isinstance(region, tuple):
+            seqid, start, end = region[:3]
+        elif region is not None:
+            seqid, start, end = region.seqid, region.start, region.end
+
+        row = self.conn.execute("SELECT code FROM seqids WHERE seqid = ?",
+                                (seqid,)).fetchone()
+        if row is None:
+            return iter([])
+
+        code, = row
+        start = 0 if start is None else start
+        end = sys.maxint if end is None else end
+        joins = "JOIN spans s ON s.fid = f.fid"
+        where = ["s.slo = ?", "s.start <= ?", "s.stop >= ?",
+                 "f.seqid = ?", "f.start <= ?", "f.stop >= ?"]
+        params = [code, end, start, seqid, end, start]
+        if completely_within:
+            where.extend(["f.start >= ?", "f.stop <= ?"])
+            params.extend([start, end])
+        return self._fetch(joins=joins, where=where, params=params,
+                           featuretype=featuretype, strand=strand,
+                           order_by=order_by)
+
+
 def make_index(gff_file):
     """
     Make a sqlite database for fast retrieval of features.
     """
-    import gffutils
     db_file = gff_file + ".db"
 
-    if need_update(gff_file, db_file):
-        if op.exists(db_file):
-            os.remove(db_file)
+    if need_update(gff_file, db_file) or not GffDB.valid(db_file):
+        for x in (db_file, db_file + "-wal", db_file + "-shm"):
+            if op.exists(x):
+                os.remove(x)
         logging.debug("Indexing `{0}`".format(gff_file))
-        gffutils.create_db(gff_file, db_file, merge_strategy="create_unique")
-    else:
-        logging.debug("Load index `{0}`".format(gff_file))
+        return GffDB.create(gff_file, db_file)
 
-    return gffutils.FeatureDB(db_file)
+    logging.debug("Load index `{0}`".format(gff_file))
+    return GffDB(db_file)
 
 
 def get_parents(gff_file, parents):
@@ -2744,7 +3347,6 @@ def load(args):
     desc_attr = opts.desc_attribute
     sep = opts.sep
 
-    import gffutils
     g = make_index(gff_file)
     f = Fasta(fasta_file, index=False)
     seqlen = {}
@@ -2761,7 +3363,7 @@ def load(args):
             if fparent:
                 try:
                     g_fparent = g[fparent]
-                except gffutils.exceptions.FeatureNotFoundError:
+                except FeatureNotFoundError:
                     logging.error("{} not found in index .. skipped".format(fparent))
                     continue
                 if desc_attr in g_fparent.attributes:
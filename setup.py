@@ -51,5 +51,5 @@ setup(
       description='Python utility libraries on genome assembly, '\
                   'annotation and comparative genomics',
       install_requires=['biopython', 'deap',
-                        'matplotlib', 'networkx', 'numpy'],
+                        'matplotlib', 'networkx', 'numpy>=1.13'],
  )
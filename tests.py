@@ -17,3 +17,421 @@ def test_formats_cblast():
     b = BlastLine("Os09g11510	Os08g13650	92.31	39	3	0	2273	2311	3237	3199	0.001	54.0")
     assert b.query == 'Os09g11510'
     assert b.hitlen == 39
+
+
+def test_formats_gff_index():
+    """ Test formats.gff - make_index round-trip with attribute editing
+    """
+    import os.path as op
+    from tempfile import mkdtemp
+    from jcvi.formats.gff import make_index
+
+    gff_file = op.join(mkdtemp(), "test.gff3")
+    fw = open(gff_file, "w")
+    print >> fw, "##gff-version 3"
+    print >> fw, "chr1\tsrc\tgene\t100\t900\t.\t+\t.\tID=g1"
+    print >> fw, "chr1\tsrc\tmRNA\t100\t900\t.\t+\t.\tID=g1.t1;Parent=g1"
+    print >> fw, "chr1\tsrc\tCDS\t100\t300\t.\t+\t0\tID=c1;Parent=g1.t1"
+    print >> fw, "chr1\tsrc\tCDS\t500\t900\t.\t+\t0\tID=c2;Parent=g1.t1"
+    fw.close()
+
+    gffdb = make_index(gff_file)
+    mrna = gffdb["g1.t1"]
+    assert mrna["Parent"] == ["g1"]
+    mrna["ID"], mrna["_old_ID"] = ["g1.1"], [mrna.id]
+    assert str(mrna).split("\t")[-1] == "ID=g1.1;Parent=g1;_old_ID=g1.t1"
+
+    cds = list(gffdb.children(mrna, featuretype="CDS", order_by="start"))
+    assert [x.id for x in cds] == ["c1", "c2"]
+    assert all(mrna.id in x["Parent"] for x in cds)
+    cds[0]["Parent"] = "g1.1"
+    assert str(cds[0]).split("\t")[-1] == "ID=c1;Parent=g1.1"
+
+    # Reopening the cached index gives back the original attributes
+    gffdb = make_index(gff_file)
+    assert gffdb["c1"]["Parent"] == ["g1.t1"]
+
+
+def test_formats_gff_store_fasta():
+    """ Test formats.gff - GffStore parse stops at ##FASTA, cache recovery
+    """
+    import os.path as op
+    from tempfile import mkdtemp
+    from jcvi.formats.gff import Gff, GffStore
+
+    gff_file = op.join(mkdtemp(), "test.gff3")
+    fw = open(gff_file, "w")
+    print >> fw, "##gff-version 3"
+    for i in xrange(20):
+        print >> fw, "chr1\tsrc\tgene\t{0}\t{1}\t.\t+\t.\tID=g{2}".\
+                        format(i * 100 + 1, i * 100 + 50, i)
+    print >> fw, "##FASTA"
+    print >> fw, ">chr1"
+    for i in xrange(200):
+        print >> fw, "ACGT" * 15
+    fw.close()
+
+    for cpus in (1, 4):
+        store = GffStore(gff_file, cpus=cpus, cache=False)
+        assert len(store) == 20
+
+    # A corrupt cache is parsed again, and then rewritten
+    fw = open(gff_file + ".npz", "w")
+    fw.write("garbage")
+    fw.close()
+    assert len(GffStore(gff_file)) == 20
+    assert len(GffStore(gff_file)) == 20
+
+    gff = Gff(gff_file, colstore=True)
+    assert gff.gff3
+    assert [x.accn for x in gff][:2] == ["g0", "g1"]
+
+
+def test_apps_ks_ng86():
+    """ Test apps.ks - NG86 counting on hand-worked pairs
+    """
+    from math import log
+    from jcvi.apps.ks import ng86
+
+    def jc(p):
+        return -.75 * log(1 - 4 * p / 3)
+
+    # CTT (Leu) has 1 synonymous site, so S = 10, N = 20 and the single
+    # CTT -> CTC change is synonymous: pS = 1 / 10, pN = 0
+    a = "CTT" * 10
+    b = "CTC" + "CTT" * 9
+    # TGG (Trp, S = 0) -> CGA (Arg, S = 4 / 3) differs at positions 1 and 3.
+    # The pathway via TGA is a stop and is dropped, leaving TGG -> CGG -> CGA
+    # with Sd = 1, Nd = 1. S = 9 + 2 / 3, N = 30 - S
+    c = "TGG" + "CTT" * 9
+    d = "CGA" + "CTT" * 9
+    ks, ka = ng86([(a, b), (c, d), (a, a)])
+
+    assert abs(ks[0] - jc(.1)) < 1e-9
+    assert ka[0] == 0
+    assert abs(ks[1] - jc(3. / 29)) < 1e-9
+    assert abs(ka[1] - jc(3. / 61)) < 1e-9
+    assert ks[2] == 0 and ka[2] == 0
+
+
+def test_apps_uclust_stack():
+    """ Test apps.uclust - column counts against per-column counting
+    """
+    from jcvi.apps.uclust import BASES, NBASES, stack_array
+
+    S = [["ACTG-N", 3], ["ACTT_N", 1], ["TCAG--", 2]]
+    expected = []
+    for i in xrange(len(S[0][0])):
+        freq = [0] * NBASES
+        for seq, nrep in S:
+            freq[BASES.index(seq[i])] += nrep
+        expected.append(freq)
+    assert stack_array(S).tolist() == expected
+
+
+def test_apps_uclust_likelihood():
+    """ Test apps.uclust - H/E likelihood against scipy.stats.binom.pmf
+    """
+    import numpy as np
+    from scipy.stats import binom
+    from jcvi.apps.uclust import HELikelihood
+
+    P = np.array([.3, .2, .25, .25])
+    N = [[10, 0, 0, 0], [5, 5, 0, 0], [7, 1, 2, 0], [0, 3, 0, 12]]
+    E, H = .01, .05
+    lik = HELikelihood(P, N)
+    four = 1. - (P ** 2).sum()
+    for i, n in enumerate(N):
+        s = sum(n)
+        l1 = sum(P[x] * binom.pmf(s - n[x], s, E) for x in xrange(4))
+        l2 = sum(2 * P[x] * P[y] * binom.pmf(s - n[x] - n[y], s, 2. * E / 3) \
+                 * binom.pmf(n[x], n[x] + n[y], .5) / four \
+                 for x in xrange(4) for y in xrange(x + 1, 4))
+        assert np.isclose(lik.L1(E)[i], l1)
+        assert np.isclose(lik.L2(E)[i], l2)
+        assert np.isclose(lik.totlik(E, H)[i], (1 - H) * l1 + H * l2)
+
+
+def test_formats_bed_array_ops():
+    """ Test formats.bed - BedArray merge, complement and intersect
+    """
+    import os.path as op
+    from tempfile import mkdtemp
+    from jcvi.formats.bed import BedArray
+
+    def write_bed(filename, rows):
+        filename = op.join(workdir, filename)
+        fw = open(filename, "w")
+        for row in rows:
+            print >> fw, "\t".join(str(x) for x in row)
+        fw.close()
+        return filename
+
+    def lines(bed):
+        return [str(x) for x in bed]
+
+    workdir = mkdtemp()
+    abed = write_bed("a.bed", [("chr2", 0, 10, "a1"), ("chr1", 10, 20, "a2"),
+                               ("chr1", 0, 10, "a3"), ("chr1", 30, 40, "a4")])
+    bbed = write_bed("b.bed", [("chr1", 5, 15, "b1"), ("chr1", 35, 50, "b2")])
+    a, b = BedArray(abed, sorted=False), BedArray(bbed, sorted=False)
+
+    # Book-ended features are merged
+    assert lines(a.merge(nms=True)) == ["chr1\t0\t20\ta3;a2",
+                                        "chr1\t30\t40\ta4",
+                                        "chr2\t0\t10\ta1"]
+
+    # Seqids without features are reported whole
+    sizes = {"chr10": 50, "chr2": 10, "chr1": 60}
+    assert lines(a.complement(sizes)) == ["chr1\t20\t30", "chr1\t40\t60",
+                                          "chr10\t0\t50"]
+
+    # Each a feature is clipped to its overlap with the b feature
+    assert lines(a.intersect(b)) == ["chr1\t5\t10\ta3", "chr1\t10\t15\ta2",
+                                     "chr1\t35\t40\ta4"]
+
+
+def test_assembly_chic_sparse():
+    """ Test assembly.chic - sparse scorers against the dense ones
+    """
+    import array
+    import numpy as np
+    from jcvi.assembly.hic import ContactMatrix
+    from jcvi.assembly.chic import score_evaluate_M, score_evaluate_P, \
+            score_evaluate_Q, score_evaluate_M_sparse, \
+            score_evaluate_P_sparse, score_evaluate_Q_sparse
+
+    rs = np.random.RandomState(42)
+    N, BB = 30, 12
+    # Sizes large enough for some pairs to go past the distance limit
+    sizes = rs.randint(1000, 1000000, size=N)
+    links = np.triu(rs.randint(1, 10, size=(N, N)) * (rs.rand(N, N) < .3), 1)
+    links += links.T
+    rows, cols = np.nonzero(links)
+    nnz = len(rows)
+
+    M = ContactMatrix(N, rows, cols, links[rows, cols])
+    assert (M.toarray() == links).all()
+
+    Pd = np.zeros((N, N, 2), dtype=int)
+    Pd[rows, cols, 0] = links[rows, cols]
+    Pd[rows, cols, 1] = rs.randint(5778, 1149851, size=nnz)
+    P = ContactMatrix(N, rows, cols, Pd[rows, cols])
+    assert (P.toarray() == Pd).all()
+
+    Qs = rs.randint(0, 5, size=(nnz, 4, BB)).astype(np.int32)
+    Q = ContactMatrix(N, rows, cols, Qs)
+    Qa = Q.toarray()
+    assert Qa.shape == (N, N, 4, BB)
+    assert (Qa[rows, cols] == Qs).all()
+
+    signs = rs.choice([-1, 1], size=N)
+    # Dense Q holds the histogram of the current orientations, -1 if no links
+    Qd = -np.ones((N, N, BB), dtype=int)
+    Qd[rows, cols] = Qa[rows, cols, (signs[rows] < 0) * 2 + (signs[cols] < 0)]
+
+    for i in xrange(10):
+        tour = rs.permutation(N) if i else rs.permutation(N)[:N // 2]
+        tour = array.array('i', tour)
+        for dense, sparse, args in ((score_evaluate_M, score_evaluate_M_sparse,
+                                     (M.toarray(), M)),
+                                    (score_evaluate_P, score_evaluate_P_sparse,
+                                     (Pd, P)),
+                                    (score_evaluate_Q, score_evaluate_Q_sparse,
+                                     (Qd, Q))):
+            sparse_args = (tour, sizes, args[1])
+            if sparse is score_evaluate_Q_sparse:
+                sparse_args += (signs,)
+            s, = sparse(*sparse_args)
+            d, = dense(tour, sizes, args[0])
+            assert np.isclose(s, d), (dense.__name__, s, d)
+
+
+def test_assembly_chic_delta():
+    """ Test assembly.chic - delta scores against the full scorers
+    """
+    import array
+    import numpy as np
+    from jcvi.assembly.hic import ContactMatrix
+    from jcvi.assembly.chic import delta_M, tour_state, score_contig_Q, \
+            score_evaluate_M_sparse, score_evaluate_Q_sparse
+
+    rs = np.random.RandomState(7)
+    N, BB = 40, 12
+    sizes = rs.randint(1000, 500000, size=N)
+    links = np.triu(rs.randint(1, 10, size=(N, N)) * (rs.rand(N, N) < .3), 1)
+    rows, cols = np.nonzero(links)
+    # Q[b, a] in orientation (b, a) is Q[a, b] with both contigs flipped
+    upper = rs.randint(0, 5, size=(len(rows), 4, BB)).astype(np.int32)
+    lower = upper[:, [3, 1, 2, 0]]
+    rows, cols = np.append(rows, cols), np.append(cols, rows)
+    M = ContactMatrix(N, rows, cols, links[np.minimum(rows, cols),
+                                           np.maximum(rows, cols)])
+    Q = ContactMatrix(N, rows, cols, np.concatenate((upper, lower)))
+
+    tour = array.array('i', rs.permutation(N))
+    score, = score_evaluate_M_sparse(tour, sizes, M)
+    nchecked = 0
+    for i in xrange(200):
+        new = array.array('i', tour)
+        a, b = sorted(rs.choice(N, size=2, replace=False))
+        if i % 2:
+            new[a], new[b] = new[b], new[a]
+        else:
+            new[a: b + 1] = array.array('i', reversed(new[a: b + 1]))
+        d = delta_M(new, tour, sizes, M)
+        if d is None:
+            continue
+        new_score, = score_evaluate_M_sparse(new, sizes, M)
+        assert np.isclose(score + d, new_score)
+        nchecked += 1
+    assert nchecked > 50
+
+    signs = rs.choice([-1, 1], size=N)
+    pos, sizes_cum = tour_state(tour, sizes, N)
+    score, = score_evaluate_Q_sparse(tour, sizes, Q, signs)
+    for t in tour:
+        before = score_contig_Q(t, pos, sizes_cum, Q, signs)
+        signs[t] = -signs[t]
+        after = score_contig_Q(t, pos, sizes_cum, Q, signs)
+        flipped, = score_evaluate_Q_sparse(tour, sizes, Q, signs)
+        assert np.isclose(score - before + after, flipped)
+        score = flipped
+
+    # Histograms with the wrong number of distance bins are refused
+    Q8 = ContactMatrix(N, rows, cols, Q.data[:, :, :8].copy())
+    for fn, args in ((score_evaluate_Q_sparse, (tour, sizes, Q8, signs)),
+                     (score_contig_Q, (tour[0], pos, sizes_cum, Q8, signs))):
+        try:
+            fn(*args)
+        except AssertionError:
+            pass
+        else:
+            assert False, "{0} accepted 8 bins".format(fn.__name__)
+
+
+def test_formats_bed_index():
+    """ Test formats.bed - range queries against a linear scan
+    """
+    import random
+    from jcvi.formats.bed import Bed
+
+    def check(bed):
+        for i in xrange(50):
+            seqid = random.choice(("chr1", "chr2", "chr3"))
+            start = random.randint(1, 10000)
+            end = start + random.randint(0, 3000)
+            assert list(bed.extract(seqid, start, end)) == \
+                    [b for b in bed if b.seqid == seqid and \
+                        start <= b.start and b.end <= end]
+            assert list(bed.overlap(seqid, start, end)) == \
+                    [b for b in bed if b.seqid == seqid and \
+                        b.start <= end and b.end >= start]
+            assert list(bed.sub_bed(seqid)) == \
+                    [b for b in bed if b.seqid == seqid]
+
+    def row(i):
+        start = random.randint(0, 10000)
+        return "\t".join(str(x) for x in (random.choice(("chr1", "chr2")),
+                         start, start + random.randint(1, 2000), "f" + str(i)))
+
+    random.seed(3)
+    bed = Bed()
+    for i in xrange(300):
+        bed.add(row(i))
+    check(bed)
+
+    # Appending and sorting both reset the index
+    bed.add(row(300).replace("chr1", "chr3").replace("chr2", "chr3"))
+    check(bed)
+    bed.sort(key=bed.key)
+    check(bed)
+
+
+def test_formats_faidx_fasta():
+    """ Test formats.fasta - FaidxFasta against Fasta, plain and bgzip
+    """
+    import random
+    import os.path as op
+    from tempfile import mkdtemp
+    from Bio import bgzf
+    from jcvi.formats.fasta import Fasta, FaidxFasta
+
+    random.seed(5)
+    workdir = mkdtemp()
+    fastafile = op.join(workdir, "test.fasta")
+    fw = open(fastafile, "w")
+    # chr3 spans several 64Kb BGZF blocks
+    sizes = {"chr1": 2500, "chr2": 61, "chr3": 150000}
+    for name in sorted(sizes):
+        seq = "".join(random.choice("ACGT") for i in xrange(sizes[name]))
+        print >> fw, ">{0} description".format(name)
+        for i in xrange(0, len(seq), 60):
+            print >> fw, seq[i: i + 60]
+    fw.close()
+
+    gzfile = fastafile + ".gz"
+    fw = bgzf.BgzfWriter(gzfile, "wb")
+    fw.write(open(fastafile, "rb").read())
+    fw.close()
+
+    f = Fasta(fastafile)
+    for filename in (fastafile, gzfile):
+        ff = FaidxFasta(filename)
+        assert dict(ff.itersizes()) == sizes
+        for i in xrange(100):
+            name = random.choice(sorted(sizes))
+            start = random.randint(1, sizes[name])
+            stop = random.randint(start, min(start + 70000, sizes[name]))
+            for strand in ("+", "-"):
+                feat = {'chr': name, 'start': start, 'stop': stop,
+                        'strand': strand}
+                assert ff.sequence(feat) == f.sequence(feat)
+
+    # Reopening reads the block offsets back from the .gzi
+    assert op.exists(gzfile + ".gzi")
+    assert FaidxFasta(gzfile).blocks == ff.blocks
+
+
+def test_formats_fastq_block():
+    """ Test formats.fastq - FastqBlock against FastqRecord
+    """
+    import random
+    from cStringIO import StringIO
+    from jcvi.formats.fastq import FastqBlock, FastqRecord, isHighQv
+
+    random.seed(11)
+    rows = []
+    for i in xrange(200):
+        n = random.randint(20, 60)
+        seq = "".join(random.choice("ACGTN") for j in xrange(n))
+        qual = "".join(chr(random.randint(64, 104)) for j in xrange(n))
+        rows.append("@r{0} 1:N:0\n{1}\n+r{0}\n{2}\n".format(i, seq, qual))
+    text = "".join(rows)
+
+    def records(offset=0):
+        fh = StringIO(text)
+        return [FastqRecord(fh, offset=offset) for i in xrange(len(rows))]
+
+    def quals(blk):
+        return [blk.buf[a:b].tostring() for a, b in \
+                    zip(blk.qual_start, blk.qual_end)]
+
+    blk, rest = FastqBlock.parse(text + "@r200\nAC")
+    assert rest == "@r200\nAC"
+    assert blk.tostring() == text
+    blk2, rest = FastqBlock.parse(text + rows[0], multiple=2)
+    assert len(blk2) == 200 and rest == rows[0]
+
+    recs = records()
+    assert blk.names() == [r.name for r in recs]
+    assert blk.seqs() == [r.seq for r in recs]
+    assert blk.lengths.tolist() == [len(r) for r in recs]
+    assert quals(blk) == [r.qual for r in recs]
+    for qvchar in ("J", "T", "^"):
+        assert blk.is_high_qv(qvchar).tolist() == \
+                [isHighQv(r.qual, qvchar) for r in recs]
+
+    for offset in (-31, 31):
+        assert quals(blk.convert_offset(offset)) == \
+                [r.qual for r in records(offset=offset)]
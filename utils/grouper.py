@@ -6,6 +6,8 @@ Disjoint set data structure <http://code.activestate.com/recipes/387776/>
 Author: Michael Droettboom
 """
 
+import numpy as np
+
 
 class Grouper(object):
     """
@@ -107,6 +109,192 @@ class Grouper(object):
         return self._mapping.keys()
 
 
+class DisjointSet(object):
+    """
+    Union-find over hashable objects for hot paths with many joins. Objects
+    are mapped to integer slots, and the forest is kept in parent and rank
+    arrays, with union by rank and path compression, so join() and joined()
+    are near O(1) and len() is a cached count. Use join_pairs() to join many
+    pairs at once. Unlike Grouper, members cannot be removed. Set lookups via
+    g[key] share a root -> members map that is rebuilt only after a join.
+
+    >>> g = DisjointSet()
+    >>> g.join('a', 'b')
+    >>> g.join('b', 'c')
+    >>> g.join('d', 'e')
+    >>> list(g)
+    [['a', 'b', 'c'], ['d', 'e']]
+    >>> g.joined('a', 'c')
+    True
+    >>> g.joined('a', 'd')
+    False
+    >>> len(g)
+    2
+    >>> g['a']
+    ('a', 'b', 'c')
+    >>> g.join_pairs([('c', 'e'), ('f', 'g')])
+    >>> list(g)
+    [['a', 'b', 'c', 'd', 'e'], ['f', 'g']]
+    >>> g['a']
+    ('a', 'b', 'c', 'd', 'e')
+    """
+    def __init__(self, init=[]):
+        self._slots = {}
+        self._keys = []
+        self._parent = []
+        self._rank = []
+        self._count = 0
+        self._members = None
+        for x in init:
+            self._slot(x)
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = len(self._keys)
+            self._keys.append(key)
+            self._parent.append(slot)
+            self._rank.append(0)
+            self._count += 1
+            self._members = None
+        return slot
+
+    def _find(self, slot):
+        parent = self._parent
+        while parent[slot] != slot:
+            # path halving
+            parent[slot] = parent[parent[slot]]
+            slot = parent[slot]
+        return slot
+
+    def _union(self, a, b):
+        ra, rb = self._find(a), self._find(b)
+        if ra == rb:
+            return
+        rank = self._rank
+        if rank[ra] < rank[rb]:
+            ra, rb = rb, ra
+        self._parent[rb] = ra
+        if rank[ra] == rank[rb]:
+            rank[ra] += 1
+        self._count -= 1
+        self._members = None
+
+    def join(self, a, *args):
+        """
+        Join given arguments into the same set. Accepts one or more arguments.
+        """
+        sa = self._slot(a)
+        for arg in args:
+            self._union(sa, self._slot(arg))
+
+    def join_pairs(self, pairs):
+        """
+        Join each pair in a sequence or (n, 2) array of pairs. Roots of all
+        pairs are hooked together in rounds, larger slot onto smaller slot,
+        each followed by full path compression, all on numpy arrays.
+        """
+        pairs = np.asarray(pairs)
+        if not len(pairs):
+            return
+
+        uniq, inverse = np.unique(pairs.ravel(), return_inverse=True)
+        slots = np.array([self._slot(x) for x in uniq.tolist()])
+        slots = slots[inverse].reshape(-1, 2)
+        a, b = slots[:, 0], slots[:, 1]
+
+        parent = self._compressed()
+        while len(a):
+            ra, rb = parent[a], parent[b]
+            changed = ra != rb
+            if not changed.any():
+                break
+            a, b, ra, rb = a[changed], b[changed], ra[changed], rb[changed]
+            np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
+            parent = self._compress(parent)
+
+        # every tree is now flat, so rank 1 for roots with members
+        nslots = len(parent)
+        isroot = parent == np.arange(nslots)
+        hasmembers = np.bincount(parent, minlength=nslots) > 1
+        self._parent = parent.tolist()
+        self._rank = (isroot & hasmembers).astype(int).tolist()
+        self._count = int(isroot.sum())
+        self._members = None
+
+    @staticmethod
+    def _compress(parent):
+        while True:
+            jumped = parent[parent]
+            if (jumped == parent).all():
+                return parent
+            parent = jumped
+
+    def _compressed(self):
+        return self._compress(np.array(self._parent, dtype=np.int64))
+
+    def find_many(self, keys):
+        """
+        Returns an array with the root slot of each key, keys in the same set
+        share the same root.
+        """
+        slots = np.array([self._slots[x] for x in keys], dtype=np.int64)
+        return self._compressed()[slots]
+
+    def joined(self, a, b):
+        """
+        Returns True if a and b are members of the same set.
+        """
+        slots = self._slots
+        if a not in slots or b not in slots:
+            return False
+        return self._find(slots[a]) == self._find(slots[b])
+
+    def _groups(self):
+        groups = {}
+        order = []
+        for slot, key in enumerate(self._keys):
+            root = self._find(slot)
+            if root not in groups:
+                groups[root] = []
+                order.append(root)
+            groups[root].append(key)
+        return groups, order
+
+    def __iter__(self):
+        """
+        Returns an iterator returning each of the disjoint sets as a list,
+        ordered by their earliest added member.
+        """
+        groups, order = self._groups()
+        for root in order:
+            yield groups[root]
+
+    def __getitem__(self, key):
+        """
+        Returns the set that a certain key belongs.
+        """
+        slot = self._slots[key]
+        if self._members is None:
+            groups, order = self._groups()
+            self._members = dict((root, tuple(members)) \
+                                for root, members in groups.iteritems())
+        return self._members[self._find(slot)]
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def num_members(self):
+        return len(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
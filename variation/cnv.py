@@ -25,7 +25,7 @@ from jcvi.apps.grid import MakeManager
 from jcvi.utils.aws import glob_s3, push_to_s3, sync_from_s3
 from jcvi.utils.cbook import percentage
 from jcvi.apps.base import OptionParser, ActionDispatcher, getfilesize, \
-            mkdir, popen, sh
+            mkdir, need_update, popen, sh
 
 
 autosomes = ["chr{}".format(x) for x in range(1, 23)]
@@ -66,11 +66,65 @@ class CopyNumberSegment(object):
                                                self.tag, self.span, self.mean_cn))
 
 
+def banded_viterbi(X, means, sigma, mu):
+    """
+    Most likely state paths for a batch of sequences under an HMM with uniform
+    start, Gaussian emissions of variance sigma around the state means, and a
+    transition matrix of 1 - (n - 1) * mu on the diagonal and mu elsewhere.
+    Each step only compares staying against switching from the best state at
+    the previous step, O(T * n) rather than O(T * n^2), and all rows of X are
+    decoded together.
+
+    X holds one sequence per row, NaN entries (missing bins or padding) are
+    skipped as if removed from the sequence. Returns state indices of the same
+    shape as X, -1 at the skipped entries.
+    """
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    B, T = X.shape
+    n = len(means)
+    log_stay = np.log(1 - (n - 1) * mu)
+    log_switch = np.log(mu)
+    rows = np.arange(B)
+    observed = np.isfinite(X)
+    started = np.zeros(B, dtype=bool)
+    delta = np.zeros((B, n))
+    # Backpointers: best state at t - 1, and bit-packed whether staying wins
+    best = np.zeros((T, B), dtype=np.int16)
+    stay = np.zeros((T, B, (n + 7) // 8), dtype=np.uint8)
+
+    for t in xrange(T):
+        obs = observed[:, t]
+        if not obs.any():
+            continue
+        b = delta.argmax(axis=1)
+        switch = (delta[rows, b] + log_switch)[:, None]
+        trans = delta + log_stay
+        keep = (trans >= switch) | ~started[:, None]
+        np.maximum(trans, switch, out=trans)
+        trans[~started] = 0
+        emit = -(X[:, t, None] - means) ** 2 / (2 * sigma)
+        delta = np.where(obs[:, None], trans + emit, delta)
+        delta -= delta.max(axis=1)[:, None]
+        best[t] = b
+        stay[t] = np.packbits(keep, axis=1)
+        started |= obs
+
+    Z = -np.ones((B, T), dtype=int)
+    z = delta.argmax(axis=1)
+    for t in xrange(T - 1, -1, -1):
+        obs = observed[:, t]
+        Z[obs, t] = z[obs]
+        kept = (stay[t, rows, z >> 3] >> (7 - (z & 7))) & 1
+        z = np.where(obs & (kept == 0), best[t], z)
+
+    return Z
+
+
 class CopyNumberHMM(object):
 
     def __init__(self, workdir, betadir="beta",
                  mu=.003, sigma=10, step=.1, threshold=.2):
-        self.model = self.initialize(mu=mu, sigma=sigma, step=step)
+        self.means = self.initialize(step=step)
         self.workdir = workdir
         self.betadir = betadir
         if not op.exists(betadir):
@@ -80,20 +134,48 @@ class CopyNumberHMM(object):
         self.sigma = sigma
         self.step = step
         self.threshold = threshold
+        self.betas = {}
 
     def run(self, samplekey, chrs=allsomes):
+        return self.run_many([samplekey], chrs=chrs)[samplekey]
+
+    def run_many(self, samplekeys, chrs=allsomes, batchsize=100):
+        """
+        Segment all samples x chromosomes, decoding batchsize of them in each
+        Viterbi call. Returns events per sample.
+        """
         if isinstance(chrs, str):
             chrs = [chrs]
-        allevents = []
-        for chr in chrs:
-            X, Z, clen, events = self.run_one(samplekey, chr)
-            allevents.extend(events)
+        tasks = [(samplekey, chr) for samplekey in samplekeys for chr in chrs]
+        allevents = dict((samplekey, []) for samplekey in samplekeys)
+        for i in xrange(0, len(tasks), batchsize):
+            batch = tasks[i: i + batchsize]
+            Xs = [self.load(samplekey, chr) for samplekey, chr in batch]
+            Zs = self.predict_many(Xs)
+            for (samplekey, chr), X, Z in zip(batch, Xs, Zs):
+                allevents[samplekey].extend(self.segment(chr, X, Z))
         return allevents
 
     def run_one(self, samplekey, chr):
+        X = self.load(samplekey, chr)
+        Z = self.predict(X)
+        events = self.segment(chr, X, Z)
+        return X, Z, X.shape[0], events
+
+    def load_beta(self, chr):
+        if chr not in self.betas:
+            beta = np.fromfile(op.join(self.betadir, "{}.beta".format(chr)))
+            std = np.fromfile(op.join(self.betadir, "{}.std".format(chr)))
+            self.betas[chr] = beta, std
+        return self.betas[chr]
+
+    def load(self, samplekey, chr):
+        """
+        Normalized copy number along a chromosome, NaN where the baseline
+        population is too variable.
+        """
         cov = np.fromfile("{}/{}-cn/{}.{}.cn".format(self.workdir, samplekey, samplekey, chr))
-        beta = np.fromfile("beta/{}.beta".format(chr))
-        std = np.fromfile("beta/{}.std".format(chr))
+        beta, std = self.load_beta(chr)
         # Check if the two arrays have different dimensions
         clen, blen = cov.shape[0], beta.shape[0]
         tlen = max(clen, blen)
@@ -107,9 +189,9 @@ class CopyNumberHMM(object):
         normalized = cov / beta
         fixed = normalized.copy()
         fixed[np.where(std > self.threshold)] = np.nan
-        X = fixed
-        Z = self.predict(X)
+        return fixed
 
+    def segment(self, chr, fixed, Z):
         med_cn = np.median(fixed[np.isfinite(fixed)])
         print chr, med_cn
 
@@ -129,7 +211,7 @@ class CopyNumberHMM(object):
         for mean_cn, rr, segment in events:
             print segment
 
-        return X, Z, clen, events
+        return events
 
     def tag(self, chr, mean_cn, rr, med_cn, realbins, base=2):
         around_0 = around_value(mean_cn, 0)
@@ -171,43 +253,33 @@ class CopyNumberHMM(object):
         segment = CopyNumberSegment(chr, rr, tag, mean_cn, realbins, is_PAR=False)
         return segment
 
-    def initialize(self, mu, sigma, step):
-        from hmmlearn import hmm
-
-        # Initial population probability
+    def initialize(self, step):
+        # The means of each copy number state
         n = int(10 / step)
-        startprob = 1. / n * np.ones(n)
-        transmat = mu * np.ones((n, n))
-        np.fill_diagonal(transmat, 1 - (n - 1) * mu)
-
-        # The means of each component
-        means = np.arange(0, step * n, step)
-        means.resize((n, 1, 1))
-        # The covariance of each component
-        covars = sigma * np.ones((n, 1, 1))
-
-        # Build an HMM instance and set parameters
-        model = hmm.GaussianHMM(n_components=n, covariance_type="full")
-
-        # Instead of fitting it from the data, we directly set the estimated
-        # parameters, the means and covariance of the components
-        model.startprob_ = startprob
-        model.transmat_ = transmat
-        model.means_ = means
-        model.covars_ = covars
-        return model
+        return np.arange(0, step * n, step)
 
     def predict(self, X):
-        # Handle missing values
-        X = ma.masked_invalid(X)
-        mask = X.mask
-        dX = ma.compressed(X).reshape(-1, 1)
-        dZ = self.model.predict(dX)
-        Z = np.array([np.nan for i in xrange(X.shape[0])])
-        Z[~mask] = dZ
-        Z = ma.masked_invalid(Z)
+        return self.predict_many([X])[0]
 
-        return Z * self.step
+    def predict_many(self, Xs):
+        """
+        Decode the copy number states of several sequences in one go, each
+        returned as a masked array with missing values masked.
+        """
+        T = max(X.shape[0] for X in Xs)
+        P = np.nan * np.ones((len(Xs), T))
+        for i, X in enumerate(Xs):
+            P[i, :X.shape[0]] = X
+        S = banded_viterbi(P, self.means, self.sigma, self.mu)
+
+        Zs = []
+        for X, states in zip(Xs, S):
+            states = states[:X.shape[0]]
+            Z = np.nan * np.ones(X.shape[0])
+            Z[states >= 0] = states[states >= 0]
+            Z = ma.masked_invalid(Z)
+            Zs.append(Z * self.step)
+        return Zs
 
     def annotate_segments(self, Z):
         """ Report the copy number and start-end segment
@@ -646,19 +718,102 @@ def compare(args):
         print "\n".join(res)
 
 
-def bam_to_cib(arg):
+# Reads left out of pileup by default: unmapped, secondary, QC fail, duplicate
+PILEUP_SKIP = 0x4 | 0x100 | 0x200 | 0x400
+
+
+class CibDepth(object):
+    """
+    Streaming depth from position-sorted alignments into a CIB file. Span
+    starts and ends are accumulated as +1/-1 events into a difference array
+    over the positions not yet written; positions before the start of the
+    last read seen are final and written out through a memory map.
+    """
+    def __init__(self, cibfile, length):
+        self.cib = np.memmap(cibfile, dtype=np.int8, mode="w+",
+                             shape=(length,))
+        self.length = length
+        self.lo = 0                     # First position not yet written
+        self.depth = 0                  # Depth at self.lo - 1
+        self.diff = np.zeros(0, dtype=np.int64)
+
+    def add(self, starts, ends, upto):
+        if starts:
+            lo = self.lo
+            starts = np.array(starts, dtype=np.int64) - lo
+            ends = np.minimum(np.array(ends, dtype=np.int64), self.length) - lo
+            n = max(len(self.diff), ends.max() + 1)
+            diff = np.bincount(starts, minlength=n) - \
+                   np.bincount(ends, minlength=n)
+            diff[:len(self.diff)] += self.diff
+            self.diff = diff
+        self.flush(upto)
+
+    def flush(self, upto):
+        k = min(upto, self.length) - self.lo
+        if k <= 0:
+            return
+        if len(self.diff) < k:
+            self.diff = np.append(self.diff,
+                                  np.zeros(k - len(self.diff), dtype=np.int64))
+        depth = self.depth + np.cumsum(self.diff[:k])
+        self.cib[self.lo: self.lo + k] = np.minimum(depth, 255) - 128
+        self.depth = depth[-1]
+        self.diff = self.diff[k:]
+        self.lo += k
+
+    def close(self):
+        self.flush(self.length)
+        self.cib.flush()
+        del self.cib
+
+
+def read_spans(read):
+    """
+    Reference intervals covered by a read: deletions are included, and the
+    read is split at skipped regions (N) so introns do not count as depth.
+    """
+    start = read.reference_start
+    if 'N' not in read.cigarstring:
+        return [(start, read.reference_end)]
+
+    spans = []
+    pos = start
+    for cigop, size in read.cigartuples:
+        if cigop == 3:                 # N
+            if pos > start:
+                spans.append((start, pos))
+            pos += size
+            start = pos
+        elif cigop in (0, 2, 7, 8):    # M, D, =, X
+            pos += size
+    if pos > start:
+        spans.append((start, pos))
+    return spans
+
+
+def bam_to_cib(arg, blocksize=100000):
     bamfile, seq, samplekey = arg
     bam = pysam.AlignmentFile(bamfile, "rb")
     name, length = seq["SN"], seq["LN"]
     logging.debug("Computing depth for {} (length={})".format(name, length))
-    pileup = bam.pileup(name)
-    a = np.ones(length, dtype=np.int8) * -128
-    for x in pileup:
-        a[x.reference_pos] = min(x.nsegments, 255) - 128
 
     cibfile = op.join(samplekey, "{}.{}.cib".format(samplekey, name))
-    a.tofile(cibfile)
+    depth = CibDepth(cibfile, length)
+    starts, ends = [], []
+    for read in bam.fetch(name):
+        if read.flag & PILEUP_SKIP or read.reference_end is None:
+            continue
+        for a, b in read_spans(read):
+            starts.append(a)
+            ends.append(b)
+        if len(starts) >= blocksize:
+            depth.add(starts, ends, read.reference_start)
+            starts, ends = [], []
+    depth.add(starts, ends, length)
+    depth.close()
     logging.debug("Depth written to `{}`".format(cibfile))
+    build_cib_pyramid(cibfile)
 
 
 def cib(args):
@@ -698,11 +853,15 @@ def batchcn(args):
     """
     %prog batchcn workdir samples.csv
 
-    Run CNV segmentation caller in batch mode. Scans a workdir.
+    Run CNV segmentation caller in batch mode. Scans a workdir. The `cn` jobs
+    are printed to stdout and can run in parallel, the batched `hmm` command
+    goes to --hmmfile and must only be run after all `cn` jobs have finished.
     """
     p = OptionParser(batchcn.__doc__)
     p.add_option("--upload", default="s3://hli-mv-data-science/htang/ccn",
                  help="Upload cn and seg results to s3")
+    p.add_option("--hmmfile", default="hmm.sh",
+                 help="Write the batched hmm command to this file")
     opts, args = p.parse_args(args)
 
     if len(args) != 2:
@@ -714,10 +873,11 @@ def batchcn(args):
     computed = [op.basename(x).split(".")[0] for x in glob_s3(store)]
     computed = set(computed)
 
-    # Generate a bunch of cn commands
+    # Generate a bunch of cn commands, then segment all samples in one go
     fp = open(samples)
     nskipped = ntotal = 0
-    cmd = "python -m jcvi.variation.cnv cn --hmm --cleanup {}".format(workdir)
+    samplekeys = []
+    cmd = "python -m jcvi.variation.cnv cn --cleanup {}".format(workdir)
     for row in fp:
         samplekey, path = row.strip().split(",")
         ntotal += 1
@@ -725,18 +885,28 @@ def batchcn(args):
             nskipped += 1
             continue
         print " ".join((cmd, samplekey, path))
+        samplekeys.append(samplekey)
+
+    if samplekeys:
+        cmd = "python -m jcvi.variation.cnv hmm --upload {} {}"\
+                .format(upload, workdir)
+        fw = open(opts.hmmfile, "w")
+        print >> fw, " ".join([cmd] + samplekeys)
+        fw.close()
+        logging.debug("Run `{}` after all cn jobs are done".format(opts.hmmfile))
 
     logging.debug("Skipped: {}".format(percentage(nskipped, ntotal)))
 
 
 def hmm(args):
     """
-    %prog hmm workdir sample_key
+    %prog hmm workdir sample_key [sample_key ...]
 
     Run CNV segmentation caller. The workdir must contain a subfolder called
     `sample_key-cn` that contains CN for each chromosome. A `beta` directory
     that contains scaler for each bin must also be present in the current
-    directory.
+    directory. Multiple samples are decoded together in batches, samples with
+    missing CN files are skipped.
     """
     p = OptionParser(hmm.__doc__)
     p.add_option("--mu", default=.003, type="float", help="Transition probability")
@@ -744,29 +914,48 @@ def hmm(args):
                  help="Standard deviation of Gaussian emission distribution")
     p.add_option("--threshold", default=1, type="float",
                  help="Standard deviation must be < this in the baseline population")
+    p.add_option("--batchsize", default=100, type="int",
+                 help="Number of chromosomes to decode in one batch")
+    p.add_option("--upload", help="Upload seg results to s3")
     opts, args = p.parse_args(args)
 
-    if len(args) != 2:
+    if len(args) < 2:
         sys.exit(not p.print_help())
 
-    workdir, sample_key = args
+    workdir = args[0]
+    sample_keys = []
+    for sample_key in args[1:]:
+        cnfiles = [op.join(workdir, sample_key + "-cn",
+                   "{}.{}.cn".format(sample_key, chr)) for chr in allsomes]
+        missing = [x for x in cnfiles if not op.exists(x)]
+        if missing:
+            logging.error("File {} not found. Sample {} skipped."\
+                            .format(missing[0], sample_key))
+            continue
+        sample_keys.append(sample_key)
+
     model = CopyNumberHMM(workdir=workdir, mu=opts.mu, sigma=opts.sigma,
                           threshold=opts.threshold)
-    events = model.run(sample_key)
+    allevents = model.run_many(sample_keys, batchsize=opts.batchsize)
     params = ".mu-{}.sigma-{}.threshold-{}"\
                 .format(opts.mu, opts.sigma, opts.threshold)
-    hmmfile = op.join(workdir, sample_key + params + ".seg")
-    fw = open(hmmfile, "w")
-    nevents = 0
-    for mean_cn, rr, event in events:
-        if event is None:
-            continue
-        print >> fw, " ".join((event.bedline, sample_key))
-        nevents += 1
-    fw.close()
-    logging.debug("A total of {} aberrant events written to `{}`"\
-                    .format(nevents, hmmfile))
-    return hmmfile
+    hmmfiles = []
+    for sample_key in sample_keys:
+        hmmfile = op.join(workdir, sample_key + params + ".seg")
+        fw = open(hmmfile, "w")
+        nevents = 0
+        for mean_cn, rr, event in allevents[sample_key]:
+            if event is None:
+                continue
+            print >> fw, " ".join((event.bedline, sample_key))
+            nevents += 1
+        fw.close()
+        logging.debug("A total of {} aberrant events written to `{}`"\
+                        .format(nevents, hmmfile))
+        if opts.upload:
+            push_to_s3(opts.upload, hmmfile)
+        hmmfiles.append(hmmfile)
+    return hmmfiles
 
 
 def batchccn(args):
@@ -864,8 +1053,63 @@ def is_matching_gz(origfile, gzfile):
     return getfilesize(origfile) == getfilesize(gzfile)
 
 
+def window_sums(a, n, chunksize=10000000):
+    """
+    Sums over consecutive full windows of size n, the same values as a rolling
+    sum sampled at [n - 1::n]; a trailing partial window is dropped. Works on
+    memory-mapped arrays in a single pass, one chunk of whole windows at a
+    time, so the input is never fully loaded.
+    """
+    nwindows = a.shape[0] // n
+    sums = np.zeros(nwindows, dtype=np.int64)
+    step = max(chunksize // n, 1)
+    for i in xrange(0, nwindows, step):
+        j = min(i + step, nwindows)
+        chunk = np.asarray(a[i * n: j * n], dtype=np.int64)
+        sums[i: j] = chunk.reshape(-1, n).sum(axis=1)
+    return sums
+
+
+# Window sizes of the per-chromosome depth pyramid, each dividing the next
+CIB_LEVELS = (1000, 10000, 100000)
+
+
+def cib_pyramid_file(cibfile, n):
+    return "{}.{}".format(cibfile, n)
+
+
+def build_cib_pyramid(cibfile, levels=CIB_LEVELS):
+    """
+    Write mean depth per window for each window size in levels, next to the
+    CIB file as `cibfile.n` (float64). The CIB is memory-mapped and scanned
+    once at the finest level; coarser levels are summed from the finer ones.
+    """
+    cib = np.memmap(cibfile, dtype=np.int8, mode="r")
+    levels = sorted(levels)
+    n = levels[0]
+    sums = window_sums(cib, n) + 128 * n
+    del cib
+    for level in levels:
+        assert level % n == 0, \
+                "Window {} not a multiple of {}".format(level, n)
+        sums = window_sums(sums, level // n)
+        n = level
+        means = sums / float(n)
+        means.tofile(cib_pyramid_file(cibfile, n))
+    logging.debug("Depth pyramid ({}) written for `{}`"\
+                    .format(",".join(str(x) for x in levels), cibfile))
+
+
 def load_cib(cibfile, n=1000):
+    """
+    Mean depth over windows of size n. Pyramid levels are read directly when
+    they are up to date, without decompressing or reading the CIB.
+    """
     cibgzfile = cibfile + ".gz"
+    pyramidfile = cib_pyramid_file(cibfile, n)
+    if not need_update([cibfile, cibgzfile], pyramidfile):
+        return np.fromfile(pyramidfile)
+
     # When we try unzip if cib not found, or cib does not match cibgz
     if not op.exists(cibfile) or not is_matching_gz(cibfile, cibgzfile):
         if op.exists(cibgzfile):
@@ -876,12 +1120,8 @@ def load_cib(cibfile, n=1000):
     if not op.exists(cibfile):
         return
 
-    cib = np.fromfile(cibfile, dtype=np.int8) + 128
-    rm = pd.rolling_mean(cib, n, min_periods=n / 2)
-    a = rm[n - 1::n].copy()
-    del cib
-    del rm
-    return a
+    build_cib_pyramid(cibfile, levels=CIB_LEVELS if n in CIB_LEVELS else [n])
+    return np.fromfile(pyramidfile)
 
 
 def build_gc_array(fastafile="/mnt/ref/hg38.upper.fa",
@@ -896,9 +1136,9 @@ def build_gc_array(fastafile="/mnt/ref/hg38.upper.fa",
         c = np.array(f[seqid])
         gc = (c == 'G') | (c == 'C')  # If base is GC
         rr = ~(c == 'N')              # If base is real
-        mgc = pd.rolling_sum(gc, n, min_periods=n / 2)[n - 1::n]
-        mrr = pd.rolling_sum(rr, n, min_periods=n / 2)[n - 1::n]
-        gc_pct = np.rint(mgc * 100 / mrr)
+        mgc = window_sums(gc, n)
+        mrr = window_sums(rr, n)
+        gc_pct = np.rint(mgc * 100. / mrr)
         gc_pct = np.asarray(gc_pct, dtype=np.uint8)
         arfile = op.join(gcdir, "{}.{}.gc".format(seqid, n))
         gc_pct.tofile(arfile)
@@ -989,18 +1229,20 @@ def cn(args):
         beta_cn.tofile(cnfile)
 
     # Run HMM caller if asked
-    segfile = hmm([workdir, sample_key]) if opts.hmm else None
+    segfiles = hmm([workdir, sample_key]) if opts.hmm else []
 
     upload = opts.upload
     if upload:
         push_to_s3(upload, cndir)
-        if segfile:
+        for segfile in segfiles:
             push_to_s3(upload, segfile)
 
+    # Without --hmm the CN are kept for a later (batched) hmm run
     if opts.cleanup:
         import shutil
         shutil.rmtree(sampledir)
-        shutil.rmtree(cndir)
+        if opts.hmm:
+            shutil.rmtree(cndir)
 
 
 if __name__ == '__main__':
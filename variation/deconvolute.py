@@ -7,18 +7,17 @@ Deconvolute fastq files according to barcodes.
 
 import os.path as op
 import sys
+import shutil
 import logging
 
-from itertools import product, groupby, islice
+from itertools import product, groupby, islice, izip
 from multiprocessing import Pool
 from collections import namedtuple
 
 from Bio.Data.IUPACData import ambiguous_dna_values
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 from jcvi.utils.iter import flatten
 from jcvi.formats.base import FileMerger, must_open
-from jcvi.formats.fastq import FastqPairedIterator
 from jcvi.apps.base import OptionParser, ActionDispatcher, mkdir, glob
 
 
@@ -43,88 +42,214 @@ def unpack_ambiguous(s):
     return ["".join(x) for x in list(product(*sd))]
 
 
-def is_barcode_sample(seq, barcode, excludebarcode, trim):
-    if seq[:trim] != barcode.seq:
-        return False
-    hasexclude = any(seq.startswith(x.seq) for x in excludebarcode)
-    if hasexclude:
-        return False
-    return True
-
-
-def split_barcode_paired(t):
-
-    barcode, excludebarcode, outdir, inputfile = t
-    trim = len(barcode.seq)
-    outfastq = op.join(outdir, "{0}.{1}.fastq".format(barcode.id, barcode.seq))
-
-    r1, r2 = inputfile
-    p1fp, p2fp = FastqPairedIterator(r1, r2)
-    fw = open(outfastq, "w")
-    while True:
-        a = list(islice(p1fp, 4))
-        if not a:
+class BarcodeTrie (object):
+    """
+    Prefix trie of barcodes. A read is assigned to the longest barcode that
+    prefixes it, so a barcode that is a prefix of another never steals its
+    reads; with longest=False, all the barcodes that prefix it are reported.
+    """
+    def __init__(self, barcodes, longest=True):
+        self.root = {}
+        self.longest = longest
+        for bc in barcodes:
+            node = self.root
+            for c in bc.seq:
+                node = node.setdefault(c, {})
+            node[None] = bc
+
+    def match(self, seq):
+        hits = []
+        node = self.root
+        for c in seq:
+            node = node.get(c)
+            if node is None:
+                break
+            if None in node:
+                hits.append(node[None])
+        if self.longest:
+            return hits[-1:]
+        return hits
+
+
+class BarcodeWriter (object):
+    """
+    Buffered writers, one file per barcode, opened on first use.
+    """
+    def __init__(self, outdir, bufsize=10000):
+        self.outdir = outdir
+        self.bufsize = bufsize
+        self.buffers = {}
+        self.counts = {}
+
+    def filename(self, barcode):
+        return op.join(self.outdir,
+                       "{0}.{1}.fastq".format(barcode.id, barcode.seq))
+
+    def write(self, barcode, text):
+        buf = self.buffers.get(barcode)
+        if buf is None:
+            buf = self.buffers[barcode] = []
+            open(self.filename(barcode), "w").close()
+            self.counts[barcode] = 0
+        buf.append(text)
+        self.counts[barcode] += 1
+        if len(buf) >= self.bufsize:
+            self.flush(barcode)
+
+    def flush(self, barcode):
+        fw = open(self.filename(barcode), "a")
+        fw.writelines(self.buffers[barcode])
+        fw.close()
+        self.buffers[barcode] = []
+
+    def close(self):
+        for barcode in self.buffers:
+            self.flush(barcode)
+        return self.counts
+
+
+def iter_records(filename, start=0, end=None):
+    """
+    FASTQ records as lists of 4 lines, from byte offset `start` (a record
+    start) up to the first record that starts at or after `end`.
+    """
+    if start == 0 and end is None:
+        fp = must_open(filename)
+    else:
+        fp = open(filename)
+        fp.seek(start)
+    pos = start
+    while end is None or pos < end:
+        rec = list(islice(fp, 4))
+        if len(rec) < 4:
             break
+        pos += sum(len(x) for x in rec)
+        yield rec
+    fp.close()
 
-        b = list(islice(p2fp, 4))
-        title, seq, plus, qual = a
-        title, seq, qual = title.strip(), seq.strip(), qual.strip()
-        if not is_barcode_sample(seq, barcode, excludebarcode, trim):
-            continue
-
-        print >> fw, "{0}\n{1}\n+\n{2}".format(title, seq[trim:], qual[trim:])
-        fw.writelines(b)
-
-    fw.close()
-
-
-def append_barcode_paired(t):
 
-    barcode, excludebarcode, outdir, inputfile = t
-    bs = barcode.seq
-    trim = len(bs)
-    fake_qual = len(bs) * "#"
-    outfastq = op.join(outdir, "{0}.{1}.fastq".format(barcode.id, barcode.seq))
-
-    r1, r2 = inputfile
-    p1fp, p2fp = FastqPairedIterator(r1, r2)
-    fw = open(outfastq, "w")
+def sync_record(fp):
+    """
+    Move fp forward to the next record start: a line that starts with '@'
+    and is followed by a '+' line two lines down. Quality lines may start
+    with '@' too, but then the line two down is a sequence.
+    """
     while True:
-        a = list(islice(p1fp, 4))
+        pos = fp.tell()
+        a = fp.readline()
         if not a:
-            break
-
-        title, seq, plus, qual = a
-        seq = seq.strip()
-        if not is_barcode_sample(seq, barcode, excludebarcode, trim):
-            continue
+            return pos
+        fp.readline()
+        c = fp.readline()
+        if a[0] == "@" and c[:1] == "+":
+            return pos
+        fp.seek(pos)
+        fp.readline()
 
-        fw.writelines(a)
 
-        title, seq, plus, qual = list(islice(p2fp, 4))
-        title, seq, qual = title.strip(), seq.strip(), qual.strip()
-        # append barcode
-        seq = bs + seq
-        qual = fake_qual + qual
-        print >> fw, "{0}\n{1}\n+\n{2}".format(title, seq, qual)
-
-    fw.close()
-
-
-def split_barcode(t):
-
-    barcode, excludebarcode, outdir, inputfile = t
-    trim = len(barcode.seq)
-    outfastq = op.join(outdir, "{0}.{1}.fastq".format(barcode.id, barcode.seq))
-
-    fp = must_open(inputfile)
-    fw = open(outfastq, "w")
-    for title, seq, qual in FastqGeneralIterator(fp):
-        if not is_barcode_sample(seq, barcode, excludebarcode, trim):
+def fastq_ranges(filename, nchunks):
+    """
+    Split FASTQ file into at most nchunks byte ranges [start, end) that
+    begin on record boundaries. Compressed files are not split.
+    """
+    size = op.getsize(filename)
+    if nchunks < 2 or filename.endswith((".gz", ".bz2")):
+        return [(0, None)]
+    bounds = [0]
+    fp = open(filename)
+    for i in xrange(1, nchunks):
+        fp.seek(max(size * i / nchunks, bounds[-1]))
+        fp.readline()
+        bounds.append(sync_record(fp))
+    fp.close()
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+
+def count_lines(filename, offsets, blocksize=1 << 20):
+    """
+    Number of lines before each of the (sorted) byte offsets.
+    """
+    counts = []
+    fp = open(filename)
+    pos = nlines = 0
+    for offset in offsets:
+        while pos + blocksize <= offset:
+            block = fp.read(blocksize)
+            nlines += block.count("\n")
+            pos += len(block)
+        block = fp.read(offset - pos)
+        nlines += block.count("\n")
+        pos += len(block)
+        counts.append(nlines)
+    fp.close()
+    return counts
+
+
+def line_offsets(filename, linenos, blocksize=1 << 20):
+    """
+    Byte offsets at which each of the (sorted) line numbers start.
+    """
+    offsets = []
+    fp = open(filename)
+    pos = nlines = 0
+    block = ""
+    for lineno in linenos:
+        # `block` holds the unread bytes from `pos`, which starts line `nlines`
+        while nlines + block.count("\n") < lineno:
+            nlines += block.count("\n")
+            pos += len(block)
+            block = fp.read(blocksize)
+            if not block:  # Past the end of file
+                break
+        if not block:
+            offsets.append(pos)
             continue
-        print >> fw, "@{0}\n{1}\n+\n{2}".format(title, seq[trim:], qual[trim:])
+        i = -1
+        for k in xrange(lineno - nlines):
+            i = block.find("\n", i + 1)
+        nlines, pos, block = lineno, pos + i + 1, block[i + 1:]
+        offsets.append(pos)
+    fp.close()
+    return offsets
 
-    fw.close()
+
+def split_chunk(t):
+    """
+    Route every read (or pair) in one chunk of the input to its barcode.
+    """
+    trie, mode, outdir, inputs = t
+    writer = BarcodeWriter(outdir)
+    if mode == "single":
+        filename, start, end = inputs
+        records = ((x, None) for x in iter_records(filename, start, end))
+    else:
+        r1, s1, e1, r2, s2 = inputs
+        reads1 = iter_records(r1, s1, e1)
+        if r1 == r2:  # Interleaved
+            records = izip(reads1, reads1)
+        else:
+            records = izip(reads1, iter_records(r2, s2))
+
+    for a, b in records:
+        seq = a[1].rstrip()
+        for bc in trie.match(seq):
+            bs = bc.seq
+            trim = len(bs)
+            if mode == "append":
+                title, seq, plus, qual = b
+                text = "".join(a) + "{0}\n{1}{2}\n+\n{3}{4}\n".format(
+                        title.rstrip(), bs, seq.rstrip(),
+                        trim * "#", qual.rstrip())
+            else:
+                title, seq, plus, qual = a
+                text = "{0}\n{1}\n+\n{2}\n".format(title.rstrip(),
+                        seq.rstrip()[trim:], qual.rstrip()[trim:])
+                if b:
+                    text += "".join(b)
+            writer.write(bc, text)
+
+    return writer.close()
 
 
 def split(args):
@@ -176,10 +301,8 @@ def split(args):
     checkprefix = not opts.nocheckprefix
 
     if checkprefix:
-        # Sanity check of shared prefix
-        excludebarcodes = []
+        # Sanity check of shared prefix, the longest barcode takes the read
         for bc in barcodes:
-            exclude = []
             for s in barcodes:
                 if bc.id == s.id:
                     continue
@@ -187,32 +310,77 @@ def split(args):
                 assert bc.seq != s.seq
                 if s.seq.startswith(bc.seq) and len(s.seq) > len(bc.seq):
                     logging.error("{0} shares same prefix as {1}.".format(s, bc))
-                    exclude.append(s)
-            excludebarcodes.append(exclude)
-    else:
-        excludebarcodes = nbc * [[]]
 
+    trie = BarcodeTrie(barcodes, longest=checkprefix)
     outdir = opts.outdir
     mkdir(outdir)
 
-    cpus = opts.cpus
-    logging.debug("Create a pool of {0} workers.".format(cpus))
-    pool = Pool(cpus)
-
     if paired:
         assert nfiles == 2, "You asked for --paired, but sent in {0} files".\
                             format(nfiles)
-        split_fun = append_barcode_paired if append else split_barcode_paired
-        mode = "paired"
+        mode = "append" if append else "paired"
     else:
-        split_fun = split_barcode
         mode = "single"
 
     logging.debug("Mode: {0}".format(mode))
 
-    pool.map(split_fun, \
-             zip(barcodes, excludebarcodes,
-             nbc * [outdir], nbc * [fastqfile]))
+    cpus = opts.cpus
+    if mode == "single":
+        chunks = [(f, start, end) for f in fastqfile
+                    for start, end in fastq_ranges(f, cpus)]
+    else:
+        r1, r2 = fastqfile
+        ranges = fastq_ranges(r1, cpus)
+        if len(ranges) == 1 or r2.endswith((".gz", ".bz2")):
+            chunks = [(r1, 0, None, r2, 0)]
+        else:
+            # Find the same record in read2 by counting lines up to it
+            nrecords = [x / 4 for x in count_lines(r1, [a for a, b in ranges])]
+            if r1 == r2:  # Interleaved, chunks start at a read1
+                nrecords = [x - x % 2 for x in nrecords]
+            starts1 = line_offsets(r1, [4 * x for x in nrecords])
+            starts2 = line_offsets(r2, [4 * x for x in nrecords])
+            ends1 = starts1[1:] + [op.getsize(r1)]
+            chunks = zip(fastqfile[:1] * len(starts1), starts1, ends1,
+                         fastqfile[1:] * len(starts1), starts2)
+
+    # Each chunk writes its own set of files, concatenated in order after
+    nchunks = len(chunks)
+    if nchunks == 1:
+        chunkdirs = [outdir]
+    else:
+        chunkdirs = [op.join(outdir, "chunk{0:04d}".format(i))
+                        for i in xrange(nchunks)]
+        for d in chunkdirs:
+            mkdir(d)
+
+    logging.debug("Split {0} chunks on {1} workers.".format(nchunks, cpus))
+    pool = Pool(cpus)
+    counts = pool.map(split_chunk, \
+                      zip(nchunks * [trie], nchunks * [mode],
+                      chunkdirs, chunks))
+    pool.close()
+    pool.join()
+
+    writer = BarcodeWriter(outdir)
+    for bc in barcodes:
+        n = sum(x.get(bc, 0) for x in counts)
+        logging.debug("{0}: {1} reads".format(writer.filename(bc), n))
+        if nchunks == 1:
+            continue
+        fw = open(writer.filename(bc), "w")
+        for d, x in zip(chunkdirs, counts):
+            if bc not in x:
+                continue
+            filename = BarcodeWriter(d).filename(bc)
+            fp = open(filename)
+            shutil.copyfileobj(fp, fw)
+            fp.close()
+        fw.close()
+
+    for d in chunkdirs:
+        if d != outdir:
+            shutil.rmtree(d)
 
 
 def merge(args):
@@ -10,7 +10,7 @@ import os
 import os.path as op
 import json
 import sys
-import vcf
+import struct
 import logging
 import pyfasta
 import numpy as np
@@ -23,7 +23,7 @@ from multiprocessing import Pool
 from jcvi.utils.cbook import percentage, uniqify
 from jcvi.formats.base import timestamp
 from jcvi.formats.bed import natsorted
-from jcvi.apps.grid import MakeManager
+from jcvi.apps.grid import MakeManager, imap_bounded
 from jcvi.formats.base import LineFile, must_open
 from jcvi.utils.aws import push_to_s3, pull_from_s3, check_exists_s3, ls_s3
 from jcvi.apps.base import OptionParser, ActionDispatcher, mkdir, need_update, \
@@ -264,21 +264,37 @@ class LobSTRvcf(dict):
                             format(len(self.columns), columnidsfile))
 
     def parse(self, filename, filtered=True, cleanup=False):
+        """
+        Read the VCF line by line, picking out only the INFO and FORMAT fields
+        needed; FORMAT field positions are looked up once per FORMAT string.
+        """
         self.samplekey = op.basename(filename).split(".")[0]
         logging.debug("Parse `{}` (filtered={})".format(filename, filtered))
         fp = must_open(filename)
-        reader = vcf.Reader(fp)
-        for record in reader:
-            if filtered and record.FILTER:
+        formats = {}
+        for row in fp:
+            if row[0] == "#":
+                continue
+            atoms = row.rstrip("\n").split("\t")
+            if filtered and atoms[6] not in ("PASS", "."):
                 continue
-            info = record.INFO
+            info = dict(x.split("=", 1) for x in atoms[7].split(";") if "=" in x)
             ref = float(info["REF"])
-            rpa = info.get("RPA", ref)
+            rpa = [float(x) for x in info["RPA"].split(",")] \
+                        if "RPA" in info else ref
             motif = info["MOTIF"]
-            name = "_".join(str(x) for x in (record.CHROM, record.POS, motif))
-            for sample in record.samples:
-                gt = sample["GT"]
-                if filtered and sample["FT"] != "PASS":
+            name = "_".join((atoms[0], atoms[1], motif))
+
+            fmt = atoms[8]
+            if fmt not in formats:
+                keys = fmt.split(":")
+                formats[fmt] = [keys.index(x) if x in keys else len(keys) \
+                                    for x in ("GT", "FT", "ALLREADS")]
+            igt, ift, iallreads = formats[fmt]
+            for sample in atoms[9:]:
+                values = sample.split(":") + [None] * 3
+                gt = values[igt]
+                if filtered and values[ift] != "PASS":
                     continue
                 if gt == "0/0":
                     alleles = (ref, ref)
@@ -288,6 +304,9 @@ class LobSTRvcf(dict):
                     alleles = (rpa[0], rpa[0])
                 elif gt == "1/2":
                     alleles = rpa
+                else:
+                    self[name] = "-,-"
+                    continue
                 try:
                     self[name] = ",".join(str(int(x)) for x in sorted(alleles))
                 except:
@@ -297,8 +316,12 @@ class LobSTRvcf(dict):
                 motif_length = len(motif)
                 adjusted_alleles = [(x - ref) * motif_length for x in alleles]
                 support = stutters = 0
-                allreads = sample["ALLREADS"]
-                for r in allreads.split(";"):
+                allreads = values[iallreads]
+                if allreads in (None, "", "."):
+                    allreads = []
+                else:
+                    allreads = allreads.split(";")
+                for r in allreads:
                     k, v = r.split("|")
                     k, v = int(k), int(v)
                     min_dist = min([abs(k - x) for x in adjusted_alleles])
@@ -318,6 +341,141 @@ class LobSTRvcf(dict):
     def evline(self):
         return ",".join([self.evidence.get(c, "-1,-1") for c in self.columns])
 
+    @property
+    def row(self):
+        """
+        Genotypes in the layout of the merged matrix (see mergecsv): the two
+        alleles as a * 1000 + b, and -1 where missing.
+        """
+        a = -np.ones(len(self.columns), dtype=np.int32)
+        for i, c in enumerate(self.columns):
+            try:
+                x1, x2 = self[c].split(",")
+                a[i] = max(int(x1) * 1000 + int(x2), -1)
+            except (KeyError, ValueError):
+                continue
+        return a
+
+
+class STRMatrix(object):
+    """
+    Sample x locus matrix on disk. Loci are split into blocks of `blocksize`
+    columns, each stored contiguously as a (samples x loci) array, so that a
+    block of loci, or one sample within a block, is a single read. A header
+    carries the dtype, the block size and the sample and locus ids.
+
+    Raw sample-major .bin files are read through the same interface as one
+    block over all loci, with the ids taken from `sampleids` and `strids`.
+    """
+    magic = "STRMATRIX"
+    align = 64
+
+    def __init__(self, filename, sampleids=None, strids=None, mode="r"):
+        self.filename = filename
+        fp = open(filename, "rb")
+        if fp.read(len(self.magic)) == self.magic:
+            size, = struct.unpack("<Q", fp.read(8))
+            header = json.loads(fp.read(size))
+            self.dtype = np.dtype(str(header["dtype"]))
+            self.samples = [str(x) for x in header["samples"]]
+            self.loci = [str(x) for x in header["loci"]]
+            self.blocksize = header["blocksize"]
+            offset = self.data_offset(size)
+        else:
+            self.dtype = np.dtype(np.int32)
+            self.samples = [x.strip() for x in open(sampleids)]
+            self.loci = [x.strip() for x in open(strids)]
+            self.blocksize = len(self.loci)
+            offset = 0
+        fp.close()
+
+        self.nsamples, self.nloci = len(self.samples), len(self.loci)
+        self.data = np.memmap(filename, dtype=self.dtype, mode=mode,
+                              offset=offset,
+                              shape=(self.nsamples * self.nloci,))
+        self.sample_index = dict((x, i) for i, x in enumerate(self.samples))
+        self.locus_index = dict((x, i) for i, x in enumerate(self.loci))
+
+    @classmethod
+    def data_offset(cls, size):
+        offset = len(cls.magic) + 8 + size
+        return (offset + cls.align - 1) // cls.align * cls.align
+
+    @classmethod
+    def create(cls, filename, samples, loci, dtype=np.int32, blocksize=4096):
+        header = json.dumps(dict(dtype=np.dtype(dtype).str, blocksize=blocksize,
+                                 samples=list(samples), loci=list(loci)))
+        offset = cls.data_offset(len(header))
+        nbytes = len(samples) * len(loci) * np.dtype(dtype).itemsize
+        fw = open(filename, "wb")
+        fw.write(cls.magic)
+        fw.write(struct.pack("<Q", len(header)))
+        fw.write(header)
+        fw.write("\0" * (offset - fw.tell()))
+        fw.truncate(offset + nbytes)
+        fw.close()
+        return cls(filename, mode="r+")
+
+    @property
+    def nblocks(self):
+        return (self.nloci + self.blocksize - 1) // self.blocksize
+
+    def block(self, b):
+        j = b * self.blocksize
+        width = min(self.blocksize, self.nloci - j)
+        start = j * self.nsamples
+        block = self.data[start: start + width * self.nsamples]
+        return block.reshape(self.nsamples, width)
+
+    def columns(self, j, k):
+        """
+        Loci j to k (exclusive) for all samples, read into memory.
+        """
+        bs = self.blocksize
+        parts = []
+        for b in xrange(j // bs, (k - 1) // bs + 1):
+            start = b * bs
+            parts.append(self.block(b)[:, max(j - start, 0): k - start])
+        return np.hstack(parts)
+
+    def write_columns(self, j, a):
+        bs = self.blocksize
+        k = j + a.shape[1]
+        for b in xrange(j // bs, (k - 1) // bs + 1):
+            start = b * bs
+            lo, hi = max(j - start, 0), min(k - start, bs)
+            self.block(b)[:, lo: hi] = a[:, start + lo - j: start + hi - j]
+
+    def locus(self, locus):
+        i = self.locus_index[locus] if isinstance(locus, str) else locus
+        b, k = divmod(i, self.blocksize)
+        return np.array(self.block(b)[:, k])
+
+    def sample(self, sample):
+        i = self.sample_index[sample] if isinstance(sample, str) else sample
+        return np.concatenate([self.block(b)[i] for b in xrange(self.nblocks)])
+
+    def set_sample(self, sample, a):
+        i = self.sample_index[sample] if isinstance(sample, str) else sample
+        for b in xrange(self.nblocks):
+            j = b * self.blocksize
+            block = self.block(b)
+            block[i] = a[j: j + block.shape[1]]
+
+    def iter_blocks(self, blocksize=4096):
+        """
+        Yield (first locus index, samples x loci array) over blocks of loci.
+        """
+        for j in xrange(0, self.nloci, blocksize):
+            yield j, self.columns(j, min(j + blocksize, self.nloci))
+
+    def iter_samples(self):
+        for i in xrange(self.nsamples):
+            yield self.sample(i)
+
+    def flush(self):
+        self.data.flush()
+
 
 def main():
 
@@ -587,16 +745,17 @@ def meta(args):
 
     af_file = "allele_freq"
     if need_update(binfile, af_file):
-        df, m, samples, loci = read_binfile(binfile, sampleids, strids)
-        nalleles = len(samples)
+        store = read_binfile(binfile, sampleids, strids)
+        nalleles = store.nsamples
         fw = must_open(af_file, "w")
-        for i, locus in enumerate(loci):
-            a = m[:, i]
-            counts = alleles_to_counts(a)
-            af = counts_to_af(counts)
-            seqid = locus.split("_")[0]
-            remove = counts_filter(counts, nalleles, seqid, cutoff=cutoff)
-            print >> fw, "\t".join((locus, af, remove))
+        for j, block in store.iter_blocks():
+            for k in xrange(block.shape[1]):
+                locus = store.loci[j + k]
+                counts = alleles_to_counts(block[:, k])
+                af = counts_to_af(counts)
+                seqid = locus.split("_")[0]
+                remove = counts_filter(counts, nalleles, seqid, cutoff=cutoff)
+                print >> fw, "\t".join((locus, af, remove))
         fw.close()
 
     logging.debug("Load gene intersections from `{}`".format(wobed))
@@ -701,6 +860,18 @@ def convert_to_percentile(arg):
     return i, pp
 
 
+def convert_block_to_percentile(arg):
+    """
+    convert_to_percentile over all columns of a samples x loci block, with one
+    percentile dict per column.
+    """
+    j, block, percentiles = arg
+    pp = np.empty(block.shape, dtype="S8")
+    for k, percentile in enumerate(percentiles):
+        pp[:, k] = convert_to_percentile((j + k, block[:, k], percentile))[1]
+    return j, pp
+
+
 def write_csv(csvfile, m, index, columns, sep="\t", index_label="SampleKey"):
     fw = open(csvfile, "w")
     print >> fw, "\t".join([index_label] + columns)
@@ -740,6 +911,38 @@ def write_mask(cpus, samples, final_columns, run_args, filename="mask.tsv"):
     write_csv(filename, m, samples, final_columns)
 
 
+def write_mask_blocks(cpus, store, final_columns, percentiles,
+                      filename="mask.tsv"):
+    """
+    Same as write_mask for a matrix on disk. P-values are computed one block of
+    loci at a time, each worker taking a slice of the block's columns, into a
+    temporary matrix of strings, which is then written out one sample at a
+    time and removed.
+    """
+    from tempfile import mkstemp
+
+    p = Pool(processes=cpus)
+    fd, maskbin = mkstemp(suffix=".mask.bin",
+                          dir=op.dirname(op.abspath(filename)))
+    os.close(fd)
+    try:
+        mask = STRMatrix.create(maskbin, store.samples, final_columns,
+                                dtype="S8")
+        for j, block in store.iter_blocks():
+            width = block.shape[1]
+            step = (width + cpus - 1) // cpus
+            run_args = [(j + k, block[:, k: k + step],
+                         [percentiles[x] for x in store.loci[j + k: j + k + step]]) \
+                            for k in xrange(0, width, step)]
+            for jj, pvalues in p.map(convert_block_to_percentile, run_args):
+                mask.write_columns(jj, pvalues)
+        mask.flush()
+        write_csv(filename, mask.iter_samples(), store.samples, final_columns)
+    finally:
+        p.close()
+        os.remove(maskbin)
+
+
 def data(args):
     """
     %prog data data.bin samples.ids STR.ids meta.tsv
@@ -756,18 +959,16 @@ def data(args):
 
     databin, sampleids, strids, metafile = args
     final_columns, percentiles = read_meta(metafile)
-    df, m, samples, loci = read_binfile(databin, sampleids, strids)
-
-    # Clean the data
-    m %= 1000  # Get the larger of the two alleles
-    m[m == 999] = -1  # Missing data
+    store = read_binfile(databin, sampleids, strids)
 
     final = set(final_columns)
     remove = []
-    for i, locus in enumerate(loci):
+    retain = []
+    for i, locus in enumerate(store.loci):
         if locus not in final:
             remove.append(locus)
             continue
+        retain.append(i)
 
     pf = "STRs_{}_SEARCH".format(timestamp())
     filteredstrids = "{}.STR.ids".format(pf)
@@ -778,19 +979,29 @@ def data(args):
                     format(len(remove), len(final_columns), filteredstrids))
 
     # Remove low-quality columns!
-    df.drop(remove, inplace=True, axis=1)
-    df.columns = final_columns
-
     filtered_bin = "{}.data.bin".format(pf)
     if need_update(databin, filtered_bin):
-        m = df.as_matrix()
-        m.tofile(filtered_bin)
+        filtered = STRMatrix.create(filtered_bin, store.samples, final_columns,
+                                    dtype=store.dtype)
+        retain = np.array(retain, dtype=int)
+        jj = 0
+        for j, block in store.iter_blocks():
+            idx = retain[(retain >= j) & (retain < j + block.shape[1])] - j
+            m = block[:, idx]
+            # Clean the data
+            m %= 1000  # Get the larger of the two alleles
+            m[m == 999] = -1  # Missing data
+            filtered.write_columns(jj, m)
+            jj += len(idx)
+        filtered.flush()
         logging.debug("Filtered binary matrix written to `{}`".format(filtered_bin))
 
     # Write data output
     filtered_tsv = "{}.data.tsv".format(pf)
     if not opts.notsv and need_update(databin, filtered_tsv):
-        df.to_csv(filtered_tsv, sep="\t", index_label="SampleKey")
+        filtered = STRMatrix(filtered_bin)
+        write_csv(filtered_tsv, filtered.iter_samples(), filtered.samples,
+                  filtered.loci)
 
 
 def mask(args):
@@ -813,7 +1024,7 @@ def mask(args):
 
     if len(args) == 4:
         databin, sampleids, strids, metafile = args
-        df, m, samples, loci = read_binfile(databin, sampleids, strids)
+        store = read_binfile(databin, sampleids, strids)
         mode = "STRs"
     elif len(args) == 2:
         databin, metafile = args
@@ -827,16 +1038,20 @@ def mask(args):
     final_columns, percentiles = read_meta(metafile)
 
     maskfile = pf + ".mask.tsv"
-    run_args = []
-    for i, locus in enumerate(loci):
-        a = m[:, i]
-        percentile = percentiles[locus]
-        run_args.append((i, a, percentile))
-
-    if mode == "TREDs" or need_update(databin, maskfile):
+    if mode == "TREDs":
+        run_args = []
+        for i, locus in enumerate(loci):
+            a = m[:, i]
+            percentile = percentiles[locus]
+            run_args.append((i, a, percentile))
         cpus = min(8, len(run_args))
         write_mask(cpus, samples, final_columns, run_args, filename=maskfile)
         logging.debug("File `{}` written.".format(maskfile))
+    elif need_update(databin, maskfile):
+        cpus = min(8, store.nloci)
+        write_mask_blocks(cpus, store, final_columns, percentiles,
+                          filename=maskfile)
+        logging.debug("File `{}` written.".format(maskfile))
 
 
 def counts_filter(countsd, nalleles, seqid, cutoff=.5):
@@ -855,52 +1070,58 @@ def counts_filter(countsd, nalleles, seqid, cutoff=.5):
     return "PASS"
 
 
-def read_binfile(binfile, sampleids, strids, dtype=np.int32):
-    m = np.fromfile(binfile, dtype=dtype)
-    samples = [x.strip() for x in open(sampleids)]
-    loci = [x.strip() for x in open(strids)]
-    nsamples, nloci = len(samples), len(loci)
-    print >> sys.stderr, "{} x {} entries imported".format(nsamples, nloci)
-
-    m.resize(nsamples, nloci)
-    df = pd.DataFrame(m, index=samples, columns=loci)
-    return df, m, samples, loci
+def read_binfile(binfile, sampleids=None, strids=None):
+    store = STRMatrix(binfile, sampleids=sampleids, strids=strids)
+    print >> sys.stderr, "{} x {} entries imported".\
+                format(store.nsamples, store.nloci)
+    return store
 
 
 def mergecsv(args):
     """
-    %prog mergecsv *.csv
+    %prog mergecsv [--strids STR.ids] *.csv
 
-    Combine CSV into binary array.
+    Combine CSV into binary array. Locus ids are read from --strids, if that
+    file does not exist the loci are numbered 0, 1, 2, ... instead.
     """
     p = OptionParser(mergecsv.__doc__)
+    p.add_option("--strids", default="STR.ids",
+                 help="Locus ids in the order of the csv columns")
     opts, args = p.parse_args(args)
 
     if len(args) < 1:
         sys.exit(not p.print_help())
 
     csvfiles = args
-    arrays = []
-    samplekeys = []
-    for csvfile in csvfiles:
-        samplekey = op.basename(csvfile).split(".")[0]
-        a = np.fromfile(csvfile, sep=",", dtype=np.int32)
-        x1 = a[::2]
-        x2 = a[1::2]
-        a = x1 * 1000 + x2
-        a[a < 0] = -1
-        arrays.append(a)
-        samplekeys.append(samplekey)
+    samplekeys = [op.basename(x).split(".")[0] for x in csvfiles]
+    if op.exists(opts.strids):
+        loci = [x.strip() for x in open(opts.strids)]
+    else:
+        nloci = len(read_csvrow(csvfiles[0]))
+        loci = [str(x) for x in xrange(nloci)]
+        logging.error("File `{}` not found. Loci numbered 0 to {}."\
+                        .format(opts.strids, nloci - 1))
+    store = STRMatrix.create("data.bin", samplekeys, loci)
+    for i, (samplekey, csvfile) in enumerate(zip(samplekeys, csvfiles)):
+        a = read_csvrow(csvfile)
+        store.set_sample(i, a)
         print >> sys.stderr, samplekey, a
-    print >> sys.stderr, "Merging"
-    b = np.concatenate(arrays)
-    b.tofile("data.bin")
+    store.flush()
 
     fw = open("samples", "w")
     print >> fw, "\n".join(samplekeys)
     fw.close()
 
 
+def read_csvrow(csvfile):
+    a = np.fromfile(csvfile, sep=",", dtype=np.int32)
+    x1 = a[::2]
+    x2 = a[1::2]
+    a = x1 * 1000 + x2
+    a[a < 0] = -1
+    return a
+
+
 def write_csv_ev(filename, filtered, cleanup, store=None):
     lv = LobSTRvcf()
     lv.parse(filename, filtered=filtered, cleanup=cleanup)
@@ -920,22 +1141,30 @@ def write_csv_ev(filename, filtered, cleanup, store=None):
         push_to_s3(store, csvfile)
         push_to_s3(store, evfile)
 
+    return lv.row
+
 
 def run_compile(arg):
-    filename, filtered, cleanup, store = arg
+    filename, filtered, cleanup, store, tobin = arg
     csvfile = filename + ".csv"
+    row = None
     try:
         if filename.startswith("s3://"):
             if check_exists_s3(csvfile):
                 logging.debug("{} exists. Skipped.".format(csvfile))
+                if tobin:
+                    row = read_csvrow(pull_from_s3(csvfile))
             else:
-                write_csv_ev(filename, filtered, cleanup, store=store)
+                row = write_csv_ev(filename, filtered, cleanup, store=store)
                 logging.debug("{} written and uploaded.".format(csvfile))
         else:
             if need_update(filename, csvfile):
-                write_csv_ev(filename, filtered, cleanup, store=None)
+                row = write_csv_ev(filename, filtered, cleanup, store=None)
+            elif tobin:
+                row = read_csvrow(csvfile)
     except Exception, e:
         logging.debug("Thread failed! Error: {}".format(e))
+    return filename, (row if tobin else None)
 
 
 def compilevcf(args):
@@ -948,6 +1177,8 @@ def compilevcf(args):
     p.add_option("--db", default="hg38", help="Use these lobSTR db")
     p.add_option("--nofilter", default=False, action="store_true",
                  help="Do not filter the variants")
+    p.add_option("--bin",
+                 help="Also write all genotypes into this binary matrix")
     p.set_home("lobstr")
     p.set_cpus()
     p.set_aws_opts(store="hli-mv-data-science/htang/str-data")
@@ -983,11 +1214,28 @@ def compilevcf(args):
         print >> fw, "\n".join(uids)
         fw.close()
 
-    run_args = [(x, filtered, cleanup, store) for x in vcffiles]
+    binfile = opts.bin
+    if binfile:
+        samplekeys = [op.basename(x).split(".")[0] for x in vcffiles]
+        loci = [x.strip() for x in open(stridsfile)]
+        matrix = STRMatrix.create(binfile, samplekeys, loci)
+        index = dict((x, i) for i, x in enumerate(vcffiles))
+
+    run_args = [(x, filtered, cleanup, store, bool(binfile)) for x in vcffiles]
     cpus = min(opts.cpus, len(run_args))
     p = Pool(processes=cpus)
-    for res in p.map_async(run_compile, run_args).get():
-        continue
+    for filename, row in imap_bounded(p, run_compile, run_args, 2 * cpus):
+        if not binfile:
+            continue
+        if row is None:
+            row = -np.ones(len(loci), dtype=np.int32)
+        matrix.set_sample(index[filename], row)
+    p.close()
+
+    if binfile:
+        matrix.flush()
+        logging.debug("Genotypes of {} samples written to `{}`".\
+                        format(len(vcffiles), binfile))
 
 
 def build_ysearch_link(r, ban=["DYS520", "DYS413a", "DYS413b"]):
@@ -1019,6 +1267,7 @@ def ystr(args):
 
     Print out Y-STR info given VCF. Marker name extracted from tabfile.
     """
+    import vcf
     from jcvi.utils.table import write_csv
 
     p = OptionParser(ystr.__doc__)